@@ -0,0 +1,301 @@
+import asyncio
+import struct
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from protocols import Protocol
+from server import Server, BYTES_RECEIVED, CONNECTIONS
+from sessions import Session, finish_file
+
+
+# Socket-like wrapper around an asyncio stream so the Server handlers can be reused as is
+class StreamConnection(Session):
+    def __init__(self, loop, writer, max_queue_bytes=4 * 1024 * 1024, overflow_policy=Session.SPILL, flush_window=0.002):
+        super().__init__(writer.get_extra_info("peername"), max_queue_bytes, overflow_policy, flush_window)
+        self.loop = loop
+        self.writer = writer
+
+        # Outgoing frames (and files) are queued and written by the connection's writer task
+        self.ready = asyncio.Event()
+
+    # Hand item over to the event loop (safe to call from handler threads)
+    def enqueue(self, item):
+        self.loop.call_soon_threadsafe(self.put, item)
+
+    # Queue file (preceded by its header frame) for sending from offset on with loop.sendfile and wait until
+    # it is sent (called from handler threads). With wait=False the writer closes the file once it is sent
+    def sendfile(self, file, header=b"", wait=True, offset=0):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+
+        done = Future() if wait else None
+        self.enqueue((header, file, done, offset))
+        return done.result() if wait else None
+
+    # Put item into the outbox (runs on the event loop)
+    def put(self, item):
+        if self.closed:
+            if isinstance(item, tuple):
+                finish_file(item[1], item[2], error=ConnectionError("Connection closed"))
+            return
+
+        self.outbox.append(item)
+        self.ready.set()
+
+    # Write queued frames to the stream, everything pending goes out in one write and one drain
+    async def write_loop(self):
+        while True:
+            await self.ready.wait()
+
+            # Short Nagle-like window: give a burst the chance to build up before flushing
+            if self.should_linger():
+                await asyncio.sleep(self.flush_window)
+
+            item, size = self.take_flush()
+            if not self.outbox:
+                self.ready.clear()
+
+            if item is None:
+                continue
+
+            if isinstance(item, tuple):
+                header, file, done, offset = item
+                try:
+                    self.writer.write(header)
+                    await self.writer.drain()
+                    finish_file(file, done, result=await self.loop.sendfile(self.writer.transport, file, offset))
+
+                except asyncio.CancelledError:
+                    finish_file(file, done, error=ConnectionError("Connection closed"))
+                    raise
+
+                except Exception as e:
+                    finish_file(file, done, error=e)
+
+                continue
+
+            self.writer.writelines(item)
+            self.writes += 1
+            await self.writer.drain()
+            self.release(size)
+
+    # Close connection (may be called from handler threads when the overflow policy disconnects)
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.condition.notify_all()
+
+        try:
+            self.loop.call_soon_threadsafe(self.close_stream)
+
+        except RuntimeError:
+            pass  # Event loop is already gone
+
+    # Close the stream and release handler threads waiting for files that will not be sent (runs on the event loop)
+    def close_stream(self):
+        self.writer.close()
+
+        while self.outbox:
+            item = self.outbox.popleft()
+            if isinstance(item, tuple):
+                finish_file(item[1], item[2], error=ConnectionError("Connection closed"))
+
+
+class AsyncServer(Server):
+    # Initialize asyncio server (idle connections cost a coroutine instead of a thread)
+    def __init__(self, host='0.0.0.0', port=12345, max_workers=32, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+        # Handlers and database calls are blocking, so they run in a bounded thread pool
+        self.max_workers = max_workers
+        self.loop = None
+        self.connections = {}  # {connection: handler task}
+
+    # Start server
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+
+        except Exception as e:
+            self.logger.error("Server error: %s", e)
+
+    # Shut server down (the event loop notices the state change and exits)
+    def stop(self):
+        if self.loop is None:
+            super().stop()
+        else:
+            self.running = False
+
+    # Run the event loop until the server is stopped
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_workers))
+
+        try:
+            # Bind server to given host and port | Listen to all incoming requests
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen()
+            self.server_socket.setblocking(False)
+
+            async_server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+            self.logger.info("Async server started on %s:%s", self.host, self.port)
+            self.start_metrics()
+            self.install_profile_signal()
+
+            async with async_server:
+                while self.running:
+                    await asyncio.sleep(1.0)  # Allow periodic check for shutdown
+
+        finally:
+            # Room cursors are moved while everyone is still registered as online
+            await self.loop.run_in_executor(None, self.advance_room_cursors, self.sessions.get_online_users())
+
+            # Close open connections and let their handlers finish before the loop goes away
+            handlers = list(self.connections.items())
+            for connection, _ in handlers:
+                connection.close()
+            await asyncio.gather(*(task for _, task in handlers), return_exceptions=True)
+
+            self.loop = None
+            super().stop()
+
+    # Read a single frame from the stream, returns None when the client disconnects or sends an oversized frame
+    async def read_message(self, reader):
+        try:
+            data_length = await reader.readexactly(Protocol.HEADER_SIZE)
+            length = struct.unpack("!I", data_length)[0]
+
+            # Refuse the frame before buffering it (one header must not make the server allocate up to 1 GiB).
+            # Its payload cannot be skipped safely, so the connection is closed
+            if length & Protocol.LENGTH_MASK > Protocol.MAX_FRAME_SIZE:
+                self.logger.warning("Frame of %s bytes exceeds %s bytes, closing connection", length & Protocol.LENGTH_MASK, Protocol.MAX_FRAME_SIZE)
+                return None
+
+            message_data = await reader.readexactly(length & Protocol.LENGTH_MASK)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        BYTES_RECEIVED.inc(amount=Protocol.HEADER_SIZE + len(message_data))
+        return Protocol.parse_message(message_data, length & Protocol.FLAGS_MASK)
+
+    # Client handling logic
+    async def handle_connection(self, reader, writer):
+        connection = StreamConnection(self.loop, writer, self.max_queue_bytes, self.overflow_policy, self.flush_window)
+        addr = connection.getpeername()
+        write_task = asyncio.create_task(connection.write_loop())
+        self.connections[connection] = asyncio.current_task()
+        self.logger.info("New connection from %s", addr)
+        CONNECTIONS.inc()
+
+        try:
+            while self.running:
+                try:
+                    message = await self.read_message(reader)
+
+                except ValueError as e:
+                    self.logger.error("Invalid message from %s: %s", addr, e)
+                    continue
+
+                if message is None:
+                    self.logger.info("Client %s disconnected (socket closed)", addr)
+                    break
+
+                self.message_logger.debug("Processing message from %s: %s", addr, message["type"])
+                start = time.perf_counter()
+                try:
+                    await self.dispatch(connection, reader, message)
+
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+
+                except Exception as e:
+                    self.logger.error("Error processing message from %s: %s", addr, e)
+                    await self.loop.run_in_executor(
+                        None, connection.sendall, Protocol.create_error_message(f"Error processing {message['type']}: {e}")
+                    )
+
+                self.record_frame(message["type"], time.perf_counter() - start)
+
+        except Exception as e:
+            self.logger.error("Error in handle_connection %s: %s", addr, e)
+
+        finally:
+            CONNECTIONS.dec()
+            self.remove_client(connection)
+            connection.close()
+            write_task.cancel()
+            self.connections.pop(connection, None)
+
+    # Pass message to the matching handler (raw file data is read from the stream first)
+    async def dispatch(self, connection, reader, message):
+        if message["type"] == Protocol.MESSAGE_TYPES["file"]:
+            await self.process_file_stream(connection, reader, message)
+        elif message["type"] == Protocol.MESSAGE_TYPES["file_chunk"]:
+            data = message["data"]
+            chunk = await reader.readexactly(data["size"])
+            BYTES_RECEIVED.inc(amount=len(chunk))
+            await self.loop.run_in_executor(
+                None, self.process_file_chunk, connection, data["transfer_id"], chunk, data.get("offset"), data.get("crc32")
+            )
+        else:
+            await self.loop.run_in_executor(None, self.process_message, connection, message)
+
+    # Start file transfer (single-frame file data is read and relayed in chunks)
+    async def process_file_stream(self, connection, reader, message):
+        data = message["data"]
+        filename = data.get("filename")
+        file_size = data.get("file_size")
+
+        if not filename or not file_size:
+            await self.loop.run_in_executor(None, connection.sendall, Protocol.create_error_message("Invalid file metadata"))
+            return
+
+        if data.get("transfer_id"):
+            # File data follows as FILE_CHUNK frames
+            await self.loop.run_in_executor(None, self.start_file_transfer, connection, data)
+            return
+
+        # Without the payload size the next frame can not be found, so the connection is dropped
+        remaining = data.get("compressed_size") if data.get("compression") else file_size
+        if not isinstance(remaining, int) or remaining < 0:
+            raise ConnectionError("File payload size unknown")
+
+        try:
+            transfer_id = await self.loop.run_in_executor(
+                None, self.start_file_transfer, connection, dict(data, transfer_id=uuid.uuid4().hex), False
+            )
+
+        except ConnectionError:
+            raise
+
+        except Exception as e:
+            # Payload is still read below (and dropped) to keep the stream in sync
+            self.logger.error("Error starting file transfer from %s: %s", connection.getpeername(), e)
+            await self.loop.run_in_executor(None, connection.sendall, Protocol.create_error_message(f"Error processing file: {e}"))
+            transfer_id = None
+
+        # Compressed data is decompressed as a stream while it arrives
+        while remaining:
+            try:
+                chunk = await reader.readexactly(min(remaining, Protocol.CHUNK_SIZE))
+
+            except asyncio.IncompleteReadError:
+                self.logger.error("Incomplete file data received from %s", connection.getpeername())
+                raise
+
+            remaining -= len(chunk)
+            BYTES_RECEIVED.inc(amount=len(chunk))
+            if transfer_id:
+                await self.loop.run_in_executor(None, self.process_file_chunk, connection, transfer_id, chunk)
+
+
+if __name__ == "__main__":
+    server = AsyncServer()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
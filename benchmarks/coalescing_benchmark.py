@@ -0,0 +1,84 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+# Allow running as "python benchmarks/coalescing_benchmark.py" from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols import Protocol, FrameReader
+from sessions import ThreadedSession
+
+
+# Outbound path configurations: (frames per write, flush window in seconds, BATCH frames enabled)
+CONFIGS = {
+    "per frame": (1, 0.0, False),
+    "gather": (ThreadedSession.MAX_FLUSH_FRAMES, 0.0, False),
+    "window": (ThreadedSession.MAX_FLUSH_FRAMES, 0.002, False),
+    "window+batch": (ThreadedSession.MAX_FLUSH_FRAMES, 0.002, True)
+}
+
+
+# Read frames until count messages arrived (BATCH frames count once per packed message)
+def consume(sock, count, done):
+    reader = FrameReader(sock)
+    received = 0
+
+    while received < count:
+        message = reader.read_frame()
+        if message is None:
+            break
+
+        if message["type"] == Protocol.MESSAGE_TYPES["batch"]:
+            received += len(message["data"]["messages"])
+        else:
+            received += 1
+
+    done.set()
+
+
+# Deliver bursts of messages through a session and count the write syscalls it needed
+# (frames of a burst trickle in with a small gap, as if they came from several senders)
+def measure(max_frames, flush_window, batching, bursts, burst_size, gap=0.0001):
+    server_sock, client_sock = socket.socketpair()
+    session = ThreadedSession(server_sock, flush_window=flush_window)
+    session.MAX_FLUSH_FRAMES = max_frames
+    if batching:
+        session.enable_batching()
+
+    done = threading.Event()
+    count = bursts * burst_size
+    threading.Thread(target=consume, args=(client_sock, count, done), daemon=True).start()
+
+    frame = Protocol.create_text_message("alice", "bob", "See you at the standup in 5 minutes", Protocol.CODEC_BINARY)
+    start = time.perf_counter()
+
+    for _ in range(bursts):
+        for _ in range(burst_size):
+            session.sendall(frame)
+            time.sleep(gap)
+
+        # Pause between bursts like a busy conversation does
+        time.sleep(0.005)
+
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    session.close()
+    client_sock.close()
+
+    return session.writes, count, elapsed
+
+
+def run(bursts=50, burst_sizes=(1, 10, 100)):
+    print(f"{'config':<14}{'burst':>7}{'messages':>10}{'writes':>8}{'msgs/write':>12}{'seconds':>9}")
+
+    for burst_size in burst_sizes:
+        for name, (max_frames, flush_window, batching) in CONFIGS.items():
+            writes, count, elapsed = measure(max_frames, flush_window, batching, bursts, burst_size)
+            print(f"{name:<14}{burst_size:>7}{count:>10}{writes:>8}{count / writes:>12.1f}{elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,52 @@
+import os
+import struct
+import sys
+import timeit
+
+# Allow running as "python benchmarks/codec_benchmark.py" from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols import Protocol
+
+
+# Typical frames of a chat session
+SAMPLES = {
+    "message": (Protocol.MESSAGE_TYPES["message"], {"sender": "alice", "receiver": "bob", "content": "See you at the standup in 5 minutes"}),
+    "file_chunk": (Protocol.MESSAGE_TYPES["file_chunk"], {"transfer_id": "9f1c2a7be4d04c6d8a1e0b5f3c7d9e21", "size": Protocol.CHUNK_SIZE}),
+    "contact_list": (Protocol.MESSAGE_TYPES["contact_list"], {"contacts": [f"user{i}" for i in range(100)]}),
+    "history": (Protocol.MESSAGE_TYPES["history"], {
+        "with": "bob",
+        "messages": [
+            {"id": 1000 + i, "sender": "alice", "receiver": "bob", "content": f"message number {i}", "timestamp": "2024-05-01 12:00:00"}
+            for i in range(50)
+        ],
+        "next_before_id": 1000
+    })
+}
+
+
+# Measure average time of one call in microseconds
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def run(number=20000):
+    print(f"{'frame':<14}{'codec':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+
+    for name, (message_type, data) in SAMPLES.items():
+        # Large frames get fewer iterations so the suite stays quick
+        iterations = number if name in ("message", "file_chunk") else number // 20
+
+        for codec in (Protocol.CODEC_JSON, Protocol.CODEC_BINARY):
+            frame = Protocol.encode_message(message_type, data, codec)
+            payload = frame[Protocol.HEADER_SIZE:]
+            flags = struct.unpack_from("!I", frame)[0] & Protocol.FLAGS_MASK
+
+            encode_time = measure(lambda: Protocol.encode_message(message_type, data, codec), iterations)
+            decode_time = measure(lambda: Protocol.parse_message(payload, flags), iterations)
+
+            print(f"{name:<14}{codec:<8}{len(frame):>8}{encode_time:>12.2f}{decode_time:>12.2f}")
+
+
+if __name__ == "__main__":
+    run()
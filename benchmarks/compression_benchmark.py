@@ -0,0 +1,98 @@
+import os
+import struct
+import sys
+import timeit
+
+# Allow running as "python benchmarks/compression_benchmark.py" from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocols import Protocol
+
+
+# Typical frames of a chat session (binary codec)
+FRAMES = {
+    "message": (Protocol.MESSAGE_TYPES["message"], {"sender": "alice", "receiver": "bob", "content": "See you at the standup in 5 minutes"}),
+    "long message": (Protocol.MESSAGE_TYPES["message"], {
+        "sender": "alice", "receiver": "bob",
+        "content": "Here is the stack trace from the failing build:\n" + "".join(
+            f'  File "/srv/app/handlers/module{i % 7}.py", line {100 + i}, in handle_request\n' for i in range(40)
+        )
+    }),
+    "contact_list": (Protocol.MESSAGE_TYPES["contact_list"], {"contacts": [f"user{i}" for i in range(100)]}),
+    "history": (Protocol.MESSAGE_TYPES["history"], {
+        "with": "bob",
+        "messages": [
+            {"id": 1000 + i, "sender": "alice", "receiver": "bob", "content": f"message number {i}", "timestamp": "2024-05-01 12:00:00"}
+            for i in range(50)
+        ],
+        "next_before_id": 1000
+    })
+}
+
+
+# Typical attachments: a log file, source code and already compressed (random) data
+def sample_files(size=1024 * 1024):
+    log_line = "2024-05-01 12:00:{:02d} INFO worker-{} request handled in {}ms path=/api/v1/items/{}\n"
+    log = "".join(log_line.format(i % 60, i % 8, i % 97, i) for i in range(size // 60)).encode()
+
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "protocols.py"), 'rb') as f:
+        source = f.read()
+
+    return {
+        "log": log[:size],
+        "source": (source * (size // len(source) + 1))[:size],
+        "random": os.urandom(size)
+    }
+
+
+# Measure average time of one call in milliseconds
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e3
+
+
+def run_frames(number=2000):
+    print(f"{'frame':<14}{'bytes':>8}{'zlib':>8}{'ratio':>8}{'compress us':>13}{'decode us':>11}")
+
+    for name, (message_type, data) in FRAMES.items():
+        frame = Protocol.encode_message(message_type, data, Protocol.CODEC_BINARY)
+        compressed = Protocol.compress_frame(frame)
+        flags = struct.unpack_from("!I", compressed)[0] & Protocol.FLAGS_MASK
+        payload = compressed[Protocol.HEADER_SIZE:]
+
+        compress_time = measure(lambda: Protocol.compress_frame(frame), number) * 1e3
+        decode_time = measure(lambda: Protocol.parse_message(payload, flags), number) * 1e3
+
+        print(f"{name:<14}{len(frame):>8}{len(compressed):>8}{len(compressed) / len(frame):>8.2f}{compress_time:>13.1f}{decode_time:>11.1f}")
+
+
+# Bytes on the wire for a chunked upload (FILE_CHUNK frames) and a single-frame file
+def run_files():
+    print(f"\n{'file':<8}{'mode':<14}{'raw bytes':>11}{'wire bytes':>12}{'ratio':>8}{'ms':>9}")
+
+    for name, data in sample_files().items():
+        def chunked(compression):
+            compressor = Protocol.create_compressor(compression) if compression else None
+            return sum(
+                len(Protocol.create_file_chunk("9f1c2a7be4d04c6d8a1e0b5f3c7d9e21", data[offset:offset + Protocol.CHUNK_SIZE], Protocol.CODEC_BINARY, offset, compressor))
+                for offset in range(0, len(data), Protocol.CHUNK_SIZE)
+            )
+
+        cases = {
+            "chunked": lambda: chunked(None),
+            "chunked zlib": lambda: chunked(Protocol.COMPRESSION_ZLIB),
+            "single zlib": lambda: len(Protocol.encode_file(name, data, "bob", Protocol.COMPRESSION_ZLIB)),
+            "single lzma": lambda: len(Protocol.encode_file(name, data, "bob", Protocol.COMPRESSION_LZMA))
+        }
+
+        for mode, func in cases.items():
+            wire = func()
+            print(f"{name:<8}{mode:<14}{len(data):>11}{wire:>12}{wire / len(data):>8.3f}{measure(func, 1):>9.1f}")
+
+
+def run():
+    run_frames()
+    run_files()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Allow running as "python benchmarks/load_benchmark.py" from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocols import Protocol
+
+
+# Server under test runs in its own process, so its RSS is not mixed up with the simulated clients
+SERVER_SCRIPT = """
+import logging, resource, sys
+sys.path.insert(0, sys.argv[1])
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+if sys.argv[2] == "async":
+    from async_server import AsyncServer as ServerClass
+else:
+    from server import Server as ServerClass
+server = ServerClass(host="127.0.0.1", port=int(sys.argv[3]))
+logging.getLogger().setLevel(logging.WARNING)
+try:
+    server.start()
+except KeyboardInterrupt:
+    pass
+"""
+
+
+# Raise the open files limit to the hard limit (every simulated user holds a socket)
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Get current resident set size of a process in KiB (Linux only, None elsewhere)
+def current_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+
+    except OSError:
+        return None
+
+
+# Get peak resident set size of the finished child processes in KiB
+def children_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+    return {
+        "count": len(samples),
+        "p50_ms": round(pick(0.5), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "p999_ms": round(pick(0.999), 3),
+        "max_ms": round(samples[-1] * 1000, 3)
+    }
+
+
+class SimulatedUser:
+    # Setup headless user (a protocol-only client, one asyncio connection)
+    def __init__(self, stats, name, codec):
+        self.stats = stats
+        self.name = name
+        self.codec = codec
+        self.reader = None
+        self.writer = None
+        self.incoming_files = {}  # {transfer_id: [send time, bytes missing]}
+
+    async def read_frame(self):
+        header = await self.reader.readexactly(Protocol.HEADER_SIZE)
+        length = struct.unpack("!I", header)[0]
+        payload = await self.reader.readexactly(length & Protocol.LENGTH_MASK)
+
+        return Protocol.parse_message(payload, length & Protocol.FLAGS_MASK)
+
+    # Connect, register and log in
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port, limit=1024 * 1024)
+
+        for request in (
+            Protocol.create_register_message(self.name, "password"),
+            Protocol.create_login_message(self.name, "password", codecs=[self.codec], batch=True)
+        ):
+            self.writer.write(request)
+            response = await self.read_frame()
+            if response["type"] != Protocol.MESSAGE_TYPES["success"]:
+                raise ConnectionError(f"{self.name}: {response['data']['message']}")
+
+    # Record delivery latencies of everything that arrives (content and filenames carry the send time)
+    async def receive(self):
+        try:
+            while True:
+                message = await self.read_frame()
+                messages = message["data"]["messages"] if message["type"] == Protocol.MESSAGE_TYPES["batch"] else [message]
+
+                for message in messages:
+                    await self.handle(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def handle(self, message):
+        data = message["data"]
+
+        if message["type"] == Protocol.MESSAGE_TYPES["message"]:
+            self.stats["message_latencies"].append(time.perf_counter() - float(data["content"].split(" ", 1)[0]))
+            self.stats["last_receive"] = time.perf_counter()
+
+        elif message["type"] == Protocol.MESSAGE_TYPES["file"] and data.get("transfer_id"):
+            self.incoming_files[data["transfer_id"]] = [float(data["filename"][:-4]), data["file_size"]]
+
+        elif message["type"] == Protocol.MESSAGE_TYPES["file_chunk"]:
+            await self.reader.readexactly(data["size"])
+            incoming = self.incoming_files.get(data["transfer_id"])
+
+            if incoming:
+                incoming[1] -= data["size"]
+                if incoming[1] <= 0:
+                    del self.incoming_files[data["transfer_id"]]
+                    self.stats["file_latencies"].append(time.perf_counter() - incoming[0])
+                    self.stats["last_receive"] = time.perf_counter()
+
+    def send_message(self, receiver, size):
+        content = f"{time.perf_counter()!r} "
+        content += "x" * max(size - len(content), 0)
+
+        self.writer.write(Protocol.create_text_message(self.name, receiver, content, self.codec))
+        self.stats["messages_sent"] += 1
+
+    # Upload file as FILE_CHUNK frames (the filename carries the send time)
+    def send_file(self, receiver, data):
+        transfer_id = uuid.uuid4().hex
+        self.writer.write(Protocol.create_file_header(receiver, f"{time.perf_counter()!r}.bin", len(data), transfer_id, codec=self.codec))
+
+        for offset in range(0, len(data), Protocol.CHUNK_SIZE):
+            self.writer.write(Protocol.create_file_chunk(transfer_id, data[offset:offset + Protocol.CHUNK_SIZE], self.codec))
+
+        self.stats["files_sent"] += 1
+
+    # Send messages (and now and then a file) to random users at the given average rate until the end time
+    async def drive(self, names, end, rate, message_size, file_ratio, file_data):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(min(random.expovariate(rate), max(end - loop.time(), 0)))
+            if loop.time() >= end:
+                break
+
+            receiver = random.choice(names)
+            while receiver == self.name and len(names) > 1:
+                receiver = random.choice(names)
+
+            if random.random() < file_ratio:
+                self.send_file(receiver, file_data)
+            else:
+                self.send_message(receiver, message_size)
+
+            await self.writer.drain()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def simulate(port, users, duration, rate, message_size, file_ratio, file_size, codec, connect_concurrency=100, drain_timeout=10.0):
+    stats = {"messages_sent": 0, "files_sent": 0, "message_latencies": [], "file_latencies": [], "last_receive": None}
+    clients = [SimulatedUser(stats, f"user{i:06d}", codec) for i in range(users)]
+    names = [client.name for client in clients]
+
+    # Register and log everybody in, a bounded number at a time (the accept backlog is limited)
+    limit = asyncio.Semaphore(connect_concurrency)
+
+    async def connect(client):
+        async with limit:
+            await client.connect(port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    login_seconds = time.perf_counter() - start
+
+    receivers = [asyncio.create_task(client.receive()) for client in clients]
+    file_data = os.urandom(file_size)
+
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    end = loop.time() + duration
+    await asyncio.gather(*(client.drive(names, end, rate, message_size, file_ratio, file_data) for client in clients))
+    send_seconds = time.perf_counter() - start
+
+    # Let the messages in flight arrive
+    deadline = time.perf_counter() + drain_timeout
+    while time.perf_counter() < deadline:
+        if len(stats["message_latencies"]) >= stats["messages_sent"] and len(stats["file_latencies"]) >= stats["files_sent"]:
+            break
+
+        await asyncio.sleep(0.1)
+
+    receive_seconds = (stats["last_receive"] or time.perf_counter()) - start
+
+    for client in clients:
+        client.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    received = len(stats["message_latencies"])
+
+    return {
+        "login_seconds": round(login_seconds, 3),
+        "send_seconds": round(send_seconds, 3),
+        "messages_sent": stats["messages_sent"],
+        "messages_received": received,
+        "files_sent": stats["files_sent"],
+        "files_received": len(stats["file_latencies"]),
+        "msgs_per_sec": round(received / receive_seconds, 1) if receive_seconds > 0 else 0.0,
+        "message_latency": percentiles(stats["message_latencies"]),
+        "file_latency": percentiles(stats["file_latencies"])
+    }
+
+
+# Start server in a scratch directory, simulate the users against it and collect the results
+def run(server="thread", users=1000, duration=20.0, rate=1.0, message_size=64, file_ratio=0.0, file_size=256 * 1024, codec=Protocol.CODEC_BINARY):
+    raise_file_limit()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="messenger-load-")
+
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, ROOT, server, str(port)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    try:
+        # Wait for the server to listen
+        deadline = time.monotonic() + 10.0
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+                break
+
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("Server did not start")
+                time.sleep(0.1)
+
+        results = asyncio.run(simulate(port, users, duration, rate, message_size, file_ratio, file_size, codec))
+        results["server_rss_kb"] = current_rss(process.pid)
+
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results["server_peak_rss_kb"] = children_peak_rss()
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+
+    except OSError:
+        commit = ""
+
+    return {
+        "commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "server": server, "users": users, "duration": duration, "rate": rate, "message_size": message_size,
+            "file_ratio": file_ratio, "file_size": file_size, "codec": codec
+        },
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a local server with simulated users and report throughput, latency and RSS")
+    parser.add_argument("--server", choices=("thread", "async"), default="thread")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of sending")
+    parser.add_argument("--rate", type=float, default=1.0, help="average messages per second per user")
+    parser.add_argument("--message-size", type=int, default=64, help="bytes of message content")
+    parser.add_argument("--file-ratio", type=float, default=0.0, help="share of sends that are file uploads")
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--codec", choices=Protocol.CODECS, default=Protocol.CODEC_BINARY)
+    parser.add_argument("--output", default="load_benchmark.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    report = run(
+        args.server, args.users, args.duration, args.rate, args.message_size,
+        args.file_ratio, args.file_size, args.codec
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,285 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+# Allow running as "python benchmarks/micro_benchmark.py" from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from logs import FORMAT, SampleFilter, SampledLogger, create_queue_handler
+from metrics import Registry
+from protocols import Protocol, FrameReader
+
+
+# Typical frames of a chat session
+FRAMES = {
+    "message": (Protocol.MESSAGE_TYPES["message"], {"sender": "alice", "receiver": "bob", "content": "See you at the standup in 5 minutes"}),
+    "contact_list": (Protocol.MESSAGE_TYPES["contact_list"], {"contacts": [f"user{i}" for i in range(50)], "next_after": "user49"}),
+    "history": (Protocol.MESSAGE_TYPES["history"], {
+        "with": "bob",
+        "messages": [
+            {"id": 1000 + i, "sender": "alice", "receiver": "bob", "content": f"message number {i}", "timestamp": "2024-05-01 12:00:00"}
+            for i in range(50)
+        ],
+        "next_before_id": 1000
+    })
+}
+
+WORDS = "deploy build server client release meeting lunch coffee standup bug fix test review merge branch".split()
+
+
+class Suite:
+    # Setup result collection (every measurement is one row: benchmark name, parameters, microseconds per call)
+    def __init__(self, number):
+        self.number = number
+        self.results = []
+
+    # Measure average time of one call in microseconds (best of the repeats)
+    def measure(self, name, params, func, number=None):
+        number = number or self.number
+        seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+        self.record(name, params, seconds)
+
+    def record(self, name, params, seconds):
+        self.results.append({"benchmark": name, "params": params, "us": round(seconds * 1e6, 2)})
+
+        described = " ".join(f"{key}={value}" for key, value in params.items())
+        print(f"{name:<24}{described:<64}{seconds * 1e6:>14.2f} us")
+
+
+# Encode and decode frames per codec and compression (decoding goes through a socketpair)
+def run_protocol(suite, codecs, compressions):
+    left, right = socket.socketpair()
+    reader = FrameReader(right)
+
+    try:
+        for name, (message_type, data) in FRAMES.items():
+            for codec in codecs:
+                for compression in compressions:
+                    params = {"frame": name, "codec": codec, "compression": compression or "none"}
+                    frame = Protocol.encode_message(message_type, data, codec)
+                    if compression:
+                        frame = Protocol.compress_frame(frame, compression)
+
+                    suite.measure("encode_message", params, lambda: Protocol.encode_message(message_type, data, codec))
+
+                    # Each round trip writes one frame and reads it back (small frames fit the socket buffer)
+                    def decode_message():
+                        left.sendall(frame)
+                        Protocol.decode_message(right, use_timeout=False)
+
+                    def read_frame():
+                        left.sendall(frame)
+                        reader.read_frame()
+
+                    suite.measure("decode_message", params, decode_message)
+                    suite.measure("FrameReader.read_frame", params, read_frame)
+
+    finally:
+        left.close()
+        right.close()
+
+
+# Cost of recording metrics on the hot path (what instrumentation adds to every frame and query)
+def run_metrics(suite):
+    registry = Registry()
+    counter = registry.counter("frames_total", "Frames", ("type",))
+    histogram = registry.histogram("handle_seconds", "Handling time", ("type",))
+    frame = Protocol.create_text_message("alice", "bob", "See you at the standup in 5 minutes", Protocol.CODEC_BINARY)
+
+    suite.measure("Counter.inc", {}, lambda: counter.inc("MESSAGE"))
+    suite.measure("Histogram.observe", {}, lambda: histogram.observe(0.0004, "MESSAGE"))
+    suite.measure("Protocol.frame_type", {}, lambda: Protocol.frame_type(frame))
+
+
+# Cost of one per-message log call for the thread that logs it: the old synchronous f-string INFO line,
+# the same line through the queue handler, and sampled DEBUG events with DEBUG off and on
+def run_logging(suite):
+    devnull = open(os.devnull, "w")
+    addr = ("127.0.0.1", 50000)
+
+    def logger(name, level, handler, rate=None):
+        log = logging.getLogger(f"micro_benchmark.{name}")
+        log.propagate = False
+        log.setLevel(level)
+        log.addHandler(handler)
+
+        return SampledLogger(log, SampleFilter(rate)) if rate else log
+
+    stream_handler = logging.StreamHandler(devnull)
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+    synchronous = logger("synchronous", logging.INFO, stream_handler)
+
+    queue_handler, listener = create_queue_handler(stream_handler)
+    listener.start()
+    queued = logger("queued", logging.INFO, queue_handler)
+    sampled_off = logger("sampled_off", logging.INFO, queue_handler, 100)
+    sampled_on = logger("sampled_on", logging.DEBUG, queue_handler, 100)
+
+    try:
+        suite.measure("log", {"handler": "stream", "style": "f-string", "level": "INFO"},
+                      lambda: synchronous.info(f"Processing message from {addr}: MESSAGE"))
+        suite.measure("log", {"handler": "queue", "style": "lazy", "level": "INFO"},
+                      lambda: queued.info("Processing message from %s: %s", addr, "MESSAGE"))
+        suite.measure("log", {"handler": "queue", "style": "lazy debug, 1/100", "level": "INFO"},
+                      lambda: sampled_off.debug("Processing message from %s: %s", addr, "MESSAGE"))
+        suite.measure("log", {"handler": "queue", "style": "lazy debug, 1/100", "level": "DEBUG"},
+                      lambda: sampled_on.debug("Processing message from %s: %s", addr, "MESSAGE"))
+
+    finally:
+        listener.stop()
+        devnull.close()
+
+
+# Encode and decode single-frame files of the given sizes (the sender runs in a thread, files exceed socket buffers)
+def run_files(suite, sizes, compressions):
+    for size in sizes:
+        text = " ".join(random.choices(WORDS, k=size // 5)).encode()[:size]
+        number = max(1, min(suite.number, 20 * 1024 * 1024 // size))
+
+        for compression in compressions:
+            params = {"size": size, "compression": compression or "none"}
+            encoded = Protocol.encode_file("notes.txt", text, "bob", compression)
+
+            suite.measure("encode_file", params, lambda: Protocol.encode_file("notes.txt", text, "bob", compression), number)
+
+            left, right = socket.socketpair()
+            try:
+                def decode_file():
+                    sender = threading.Thread(target=left.sendall, args=(encoded,))
+                    sender.start()
+                    Protocol.decode_file(right)
+                    sender.join()
+
+                suite.measure("decode_file", params, decode_file, number)
+
+            finally:
+                left.close()
+                right.close()
+
+
+# Fill a fresh database with rows users and rows messages (user 1 gets a long contact list)
+def seed_database(path, rows, durability, batch_size, flush_interval):
+    database = Database(path, durability=durability, batch_size=batch_size, flush_interval=flush_interval)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with database.pool.write() as conn:
+        conn.executemany(
+            "INSERT INTO users (username, password) VALUES (?, ?)",
+            ((f"user{i:07d}", "password") for i in range(1, rows + 1))
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO contacts (user_id, contact_id) VALUES (?, ?)",
+            [(1, i) for i in range(2, min(rows, 1000) + 1)] + [(i, random.randint(1, rows)) for i in range(2, rows + 1)]
+        )
+        conn.executemany(
+            "INSERT INTO messages (sender_id, receiver_id, message, delivered) VALUES (?, ?, ?, 1)",
+            ((random.randint(1, rows), random.randint(1, rows), " ".join(random.choices(WORDS, k=8))) for _ in range(rows))
+        )
+        conn.commit()
+
+    return database
+
+
+# Database operations against tables of the given sizes (indexes can be dropped to see what they are worth)
+def run_database(suite, row_counts, durability, batch_size, flush_interval, drop_indexes):
+    for rows in row_counts:
+        directory = tempfile.mkdtemp(prefix="messenger-bench-")
+
+        try:
+            start = time.perf_counter()
+            database = seed_database(os.path.join(directory, "bench.db"), rows, durability, batch_size, flush_interval)
+            print(f"seeded {rows} rows in {time.perf_counter() - start:.1f} s")
+
+            with database.pool.write() as conn:
+                for index in drop_indexes:
+                    conn.execute(f"DROP INDEX IF EXISTS {index}")
+                conn.commit()
+
+            params = {"rows": rows, "durability": durability, "batch_size": batch_size, "flush_interval": flush_interval, "dropped": ",".join(drop_indexes) or "none"}
+
+            # Stores are timed as a burst followed by a flush, so both modes pay for their commits
+            number = suite.number if durability == Database.ACK_ENQUEUE else max(1, suite.number // 100)
+            start = time.perf_counter()
+            for i in range(number):
+                database.store_message(1 + i % rows, 1 + (i * 7) % rows, "benchmark message about the deploy")
+            database.flush()
+            suite.record("store_message", params, (time.perf_counter() - start) / number)
+
+            users = [f"user{random.randint(1, rows):07d}" for _ in range(100)]
+            suite.measure("authenticate_user", params, lambda: database.authenticate_user(random.choice(users), "password"))
+            suite.measure("get_contacts", params, lambda: database.get_contacts(1, limit=Protocol.CONTACT_PAGE_SIZE))
+            suite.measure("get_contacts prefix", params, lambda: database.get_contacts(1, "user00001", limit=Protocol.CONTACT_PAGE_SIZE))
+            suite.measure("search_users", params, lambda: database.search_users(1, "user00012", limit=Protocol.CONTACT_PAGE_SIZE))
+            suite.measure("get_conversation", params, lambda: database.get_conversation(1, 2, limit=Protocol.HISTORY_PAGE_SIZE))
+            suite.measure("search_messages", params, lambda: database.search_messages(1, "deploy review", limit=Protocol.SEARCH_PAGE_SIZE))
+
+            database.close()
+
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(groups=("protocol", "metrics", "logging", "files", "database"), codecs=Protocol.CODECS, compressions=(None, Protocol.COMPRESSION_ZLIB),
+        file_sizes=(1024, 64 * 1024, 512 * 1024, 2 * 1024 * 1024), file_compressions=(None, Protocol.COMPRESSION_ZLIB, Protocol.COMPRESSION_LZMA),
+        row_counts=(1000, 10000, 100000), durability=Database.ACK_ENQUEUE, batch_size=500, flush_interval=0.02, drop_indexes=(), number=1000):
+    random.seed(42)
+    suite = Suite(number)
+
+    if "protocol" in groups:
+        run_protocol(suite, codecs, compressions)
+
+    if "metrics" in groups:
+        run_metrics(suite)
+
+    if "logging" in groups:
+        run_logging(suite)
+
+    if "files" in groups:
+        run_files(suite, file_sizes, file_compressions)
+
+    if "database" in groups:
+        run_database(suite, row_counts, durability, batch_size, flush_interval, list(drop_indexes))
+
+    return suite.results
+
+
+# "none" on the command line stands for no compression
+def compression_list(value):
+    return [None if name == "none" else name for name in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of Protocol and Database operations")
+    parser.add_argument("--groups", default="protocol,metrics,logging,files,database")
+    parser.add_argument("--codecs", default=",".join(Protocol.CODECS))
+    parser.add_argument("--compressions", type=compression_list, default=[None, Protocol.COMPRESSION_ZLIB], help="frame compressions, e.g. none,zlib")
+    parser.add_argument("--file-sizes", default="1024,65536,524288,2097152")
+    parser.add_argument("--file-compressions", type=compression_list, default=[None, Protocol.COMPRESSION_ZLIB, Protocol.COMPRESSION_LZMA])
+    parser.add_argument("--rows", default="1000,10000,100000", help="table sizes, e.g. 1000,1000000")
+    parser.add_argument("--durability", choices=(Database.ACK_ENQUEUE, Database.ACK_COMMIT), default=Database.ACK_ENQUEUE)
+    parser.add_argument("--batch-size", type=int, default=500, help="write-behind batch size")
+    parser.add_argument("--flush-interval", type=float, default=0.02, help="longest time a write-behind batch keeps collecting rows")
+    parser.add_argument("--drop-index", action="append", default=[], help="index to drop before measuring (repeatable)")
+    parser.add_argument("--number", type=int, default=1000, help="calls per measurement")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    results = run(
+        args.groups.split(","), args.codecs.split(","), args.compressions,
+        [int(size) for size in args.file_sizes.split(",")], args.file_compressions,
+        [int(rows) for rows in args.rows.split(",")], args.durability, args.batch_size, args.flush_interval, args.drop_index, args.number
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,44 @@
+import os
+import uuid
+
+
+class BlobStore:
+    # Setup content-addressed file store: every file is kept once, named by its SHA-256 hex digest
+    # and sharded into two levels of subdirectories (files/ab/cd/abcd...) to keep directories small
+    def __init__(self, directory="files"):
+        self.directory = directory
+        self.temp_directory = os.path.join(directory, "tmp")
+        os.makedirs(self.temp_directory, exist_ok=True)
+
+        # Partial uploads cannot be resumed after a restart, drop what they left behind
+        for name in os.listdir(self.temp_directory):
+            os.remove(os.path.join(self.temp_directory, name))
+
+    # Get path of the blob with the given digest
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    # Get fresh path for data that is still being received
+    def temp_path(self):
+        return os.path.join(self.temp_directory, f"{uuid.uuid4().hex}.part")
+
+    # Size of the stored blob, None if it is not stored
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+
+        except OSError:
+            return None
+
+    # Move received data into the store under its digest (data already stored is dropped instead)
+    def add(self, temp_path, digest):
+        path = self.path(digest)
+
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+        return path
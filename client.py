@@ -1,9 +1,13 @@
+import hashlib
 import socket
 import threading
 import os
+import uuid
+import zlib
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext
-from protocols import Protocol
+from tkinter import filedialog, messagebox, scrolledtext, simpledialog
+from protocols import Protocol, FrameReader
+from logs import configure_logging, get_message_logger
 import logging
 
 class Client:
@@ -14,15 +18,49 @@ class Client:
 
         # Setup client
         self.sock = None
+        self.reader = None
         self.username = None
+        self.codec = Protocol.CODEC_JSON # wire codec negotiated at login
+        self.compressions = [] # compression algorithms the server decodes (negotiated at login)
 
         # Setup state
         self.running = False
         self.receive_thread = None
 
-        # Setup logger
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+        # Setup outgoing frames lock (file uploads run in their own thread)
+        self.send_lock = threading.Lock()
+
+        # Setup incoming chunked files
+        self.incoming_files = {}  # {transfer_id: (file, save_path, file_size, filename)}
+        self.partial_downloads = {}  # {filename: save_path} files cut off by a disconnect or a corrupted chunk, the rest can be downloaded
+
+        # Setup uploads cut off by a disconnect, resumed after the next login
+        self.unfinished_uploads = {}  # {transfer_id: (receiver, file_path, filename, file_size)}
+
+        # Setup uploads waiting for the server to answer their hash announcement
+        self.file_acks = {}  # {transfer_id: [threading.Event, FILE_ACK data]}
+
+        # Setup history pagination cursors
+        self.history_cursors = {}  # {username: oldest loaded message id, None when fully loaded}
+
+        # Setup presence of contacts (snapshot at login, kept up to date by deltas from the server)
+        self.online_contacts = set()
+
+        # Setup contacts window state (names are loaded page by page)
+        self.contacts_window = None
+        self.contacts_listbox = None
+        self.contacts_prefix_entry = None
+        self.contacts_query = ("", False)  # (prefix, directory) of the list being shown
+        self.contacts_after = ""  # cursor of the next page, None when fully loaded
+
+        # Setup search pagination (last query and the offset of its next page, None when all hits are shown)
+        self.search_query = None
+        self.search_offset = None
+
+        # Setup logger (INFO unless MESSENGER_LOG_LEVEL says otherwise, see logs.py)
+        configure_logging()
         self.logger = logging.getLogger(__name__)
+        self.message_logger = get_message_logger(__name__)
 
         # Setup GUI
         self.root = tk.Tk()
@@ -70,7 +108,12 @@ class Client:
 
         # Buttons
         tk.Button(self.root, text="Send File", command=self.send_file).pack(pady=5)
+        tk.Button(self.root, text="Download File", command=self.download_file).pack(pady=5)
         tk.Button(self.root, text="View Contacts", command=self.view_contacts).pack(pady=5)
+        tk.Button(self.root, text="Load History", command=self.load_history).pack(pady=5)
+        tk.Button(self.root, text="Search", command=self.search_messages).pack(pady=5)
+        tk.Button(self.root, text="Create Room", command=self.create_room).pack(pady=5)
+        tk.Button(self.root, text="Join Room", command=self.join_room).pack(pady=5)
         tk.Button(self.root, text="Exit", command=self.exit).pack(pady=5)
 
         # Start receive thread after setting up main window
@@ -87,6 +130,7 @@ class Client:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(5.0)  # Timeout for initial connection
             self.sock.connect((self.host, self.port))
+            self.reader = FrameReader(self.sock)
 
             # Set running state to True
             self.running = True
@@ -95,7 +139,7 @@ class Client:
             return True
         
         except Exception as e:
-            self.logger.error(f"Failed to connect: {e}")
+            self.logger.error("Failed to connect: %s", e)
             self.root.after(0, lambda: messagebox.showerror("Connection Error", f"Failed to connect to server: {e}. Is the server running?"))
             self.sock = None
 
@@ -117,7 +161,7 @@ class Client:
     def receive_messages(self):
         while self.running:
             try:
-                message = Protocol.decode_message(self.sock, use_timeout=False)
+                message = self.reader.read_frame()
 
                 if not message:
                     self.logger.info("Disconnected from server: no data received")
@@ -127,14 +171,18 @@ class Client:
 
                 self.handle_server_message(message)
 
+            except ValueError as e:
+                self.logger.error("Invalid message received: %s", e)
+                continue
+
             except socket.error as e:
-                self.logger.error(f"Socket error receiving message: {e}")
+                self.logger.error("Socket error receiving message: %s", e)
                 self.running = False
                 self.root.after(0, lambda: self.handle_disconnection(f"Connection error: {e}"))
                 break
 
             except Exception as e:
-                self.logger.error(f"Unexpected error receiving message: {e}")
+                self.logger.error("Unexpected error receiving message: %s", e)
                 self.running = False
                 self.root.after(0, lambda: self.handle_disconnection(f"Unexpected error: {e}"))
                 break
@@ -146,10 +194,19 @@ class Client:
                 self.sock.close()
 
             except Exception as e:
-                self.logger.error(f"Error closing socket: {e}")
+                self.logger.error("Error closing socket: %s", e)
 
             self.sock = None
 
+        # Keep unfinished incoming files, the missing part can be downloaded later
+        for f, save_path, _, filename in self.incoming_files.values():
+            f.close()
+            self.partial_downloads[filename] = save_path
+        self.incoming_files.clear()
+
+        # Presence arrives as a fresh snapshot after the next login
+        self.online_contacts.clear()
+
         self.running = False
         self.root.after(0, lambda: messagebox.showerror("Error", message))
         self.root.after(0, self.setup_login_window)
@@ -158,7 +215,7 @@ class Client:
     def handle_server_message(self, message):
         msg_type = message["type"]
         data = message["data"]
-        self.logger.info(f"Received message: {message}")
+        self.message_logger.debug("Received %s message", msg_type)
 
         # Check incoming message type
         if msg_type == Protocol.MESSAGE_TYPES["success"]:
@@ -170,22 +227,105 @@ class Client:
         elif msg_type == Protocol.MESSAGE_TYPES["message"]:
             self.root.after(0, lambda: self.display_message(f"{data['sender']}: {data['content']}\n"))
 
+        elif msg_type == Protocol.MESSAGE_TYPES["room_message"]:
+            self.root.after(0, lambda: self.display_message(f"#{data['room']} {data['sender']}: {data['content']}\n"))
+
         elif msg_type == Protocol.MESSAGE_TYPES["file"]:
-            filename, file_data = Protocol.decode_file(self.sock)
+            filename = os.path.basename(data["filename"])
+            save_path = os.path.join("received_files", f"received_{filename}")
+            os.makedirs("received_files", exist_ok=True)
+
+            if data.get("transfer_id"):
+                # File data follows as FILE_CHUNK frames
+                self.incoming_files[data["transfer_id"]] = (open(save_path, 'wb'), save_path, data["file_size"], filename)
+                return
+
+            # Whole stored copy sent after this client fell behind a relayed transfer of the same file replaces it
+            for transfer_id, (f, path, _, _) in list(self.incoming_files.items()):
+                if path == save_path:
+                    f.close()
+                    del self.incoming_files[transfer_id]
+
+            # File data follows the FILE frame on the same connection, write it as it arrives
+            # (with an offset only the rest of a partially received file follows)
+            offset = data.get("offset", 0)
+            with open(save_path, 'r+b' if offset and os.path.exists(save_path) else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                for chunk in self.reader.read_chunks(data["file_size"] - offset):
+                    f.write(chunk)
+
+            self.partial_downloads.pop(filename, None)
+
+            self.root.after(0, lambda: self.display_message(f"Received file: {filename} (saved to {save_path})\n"))
+
+        elif msg_type == Protocol.MESSAGE_TYPES["file_chunk"]:
+            chunk = self.reader.read_exact(data["size"])
+            incoming = self.incoming_files.get(data["transfer_id"])
+
+            if not incoming:
+                return
+
+            f, save_path, file_size, filename = incoming
+
+            if "crc32" in data and zlib.crc32(chunk) != data["crc32"]:
+                # Rest of the transfer is dropped, the data checked so far is kept to be downloaded later
+                self.logger.error("Checksum mismatch in chunk at offset %s of %s", data["offset"], filename)
+                f.close()
+                del self.incoming_files[data["transfer_id"]]
+                self.partial_downloads[filename] = save_path
+                self.root.after(0, lambda: self.display_message(f"Receiving file {filename} failed: corrupted data\n"))
+                return
+
+            f.write(chunk)
+
+            # Last chunk received
+            if f.tell() >= file_size:
+                f.close()
+                del self.incoming_files[data["transfer_id"]]
+                self.root.after(0, lambda: self.display_message(f"Received file: {os.path.basename(save_path)} (saved to {save_path})\n"))
+
+        elif msg_type == Protocol.MESSAGE_TYPES["batch"]:
+            # Several frames the server flushed together, handled in order
+            for batched_message in data["messages"]:
+                self.handle_server_message(batched_message)
+
+        elif msg_type == Protocol.MESSAGE_TYPES["file_ack"]:
+            pending = self.file_acks.get(data["transfer_id"])
+
+            if pending:
+                pending[1] = data
+                pending[0].set()
 
-            if filename:
-                save_path = os.path.join("received_files", f"received_{filename}")
-                os.makedirs("received_files", exist_ok=True)
+        elif msg_type == Protocol.MESSAGE_TYPES["contact_list"]:
+            self.root.after(0, lambda: self.display_contacts(data))
 
-                # Start writing incoming files
-                with open(save_path, 'wb') as f:
-                    f.write(file_data)
+        elif msg_type == Protocol.MESSAGE_TYPES["presence"]:
+            self.root.after(0, lambda: self.update_presence(data))
 
-                self.root.after(0, lambda: self.display_message(f"Received file: {filename} (saved to {save_path})\n"))
+        elif msg_type == Protocol.MESSAGE_TYPES["offline_messages"]:
+            # Messages received while offline arrive in batches
+            # (room messages carry the room they were sent to)
+            lines = "".join(
+                f"[{m['timestamp']}] {'#' + m['room'] + ' ' if 'room' in m else ''}{m['sender']}: {m['content']}\n"
+                for m in data["messages"]
+            )
+            self.root.after(0, lambda: self.display_message(lines))
 
-        elif msg_type == Protocol.MESSAGE_TYPES["contact_list"]:
-            contacts = "\n".join(data["contacts"])
-            self.root.after(0, lambda: messagebox.showinfo("Contacts", f"Contacts:\n{contacts}"))
+        elif msg_type == Protocol.MESSAGE_TYPES["history"]:
+            self.history_cursors[data["with"]] = data["next_before_id"]
+
+            # Page is newest first, older pages go above what is already displayed
+            lines = "".join(f"[{m['timestamp']}] {m['sender']}: {m['content']}\n" for m in reversed(data["messages"]))
+            self.root.after(0, lambda: self.display_history(lines))
+
+        elif msg_type == Protocol.MESSAGE_TYPES["search"]:
+            self.search_offset = data["next_offset"]
+
+            lines = "".join(f"  [{m['timestamp']}] {m['sender']} -> {m['receiver']}: {m['content']}\n" for m in data["messages"])
+            more = " (search again for more)" if data["next_offset"] is not None else ""
+            text = f"Search results for '{data['query']}'{more}:\n" + (lines or "  No matches\n")
+            self.root.after(0, lambda: self.display_message(text))
 
     # Display message in GUI
     def display_message(self, text):
@@ -194,6 +334,25 @@ class Client:
         self.message_text.config(state='disabled')
         self.message_text.see(tk.END)
 
+    # Wait for the server response to a synchronous request (login/register)
+    def receive_response(self):
+        try:
+            self.sock.settimeout(5.0)
+            return self.reader.read_frame()
+
+        except (socket.timeout, ValueError):
+            return None
+
+        finally:
+            self.sock.settimeout(None)
+
+    # Display older messages at the top of the chat
+    def display_history(self, text):
+        self.message_text.config(state='normal')
+        self.message_text.insert("1.0", text)
+        self.message_text.config(state='disabled')
+        self.message_text.see("1.0")
+
     # User login handling logic + button event listener function
     def handle_login(self):
         username = self.username_entry.get()
@@ -207,12 +366,17 @@ class Client:
             return
         
         try:
-            self.sock.send(Protocol.create_login_message(username, password))
-            message = Protocol.decode_message(self.sock, use_timeout=True)
+            self.sock.send(Protocol.create_login_message(
+                username, password, codecs=Protocol.CODECS, batch=True, compressions=Protocol.COMPRESSIONS
+            ))
+            message = self.receive_response()
 
             if message and message["type"] == Protocol.MESSAGE_TYPES["success"]:
                 self.username = username
+                self.codec = message["data"].get("codec", Protocol.CODEC_JSON)
+                self.compressions = message["data"].get("compressions", [])
                 self.setup_main_window()
+                self.resume_uploads()
 
             else:
                 self.root.after(0, lambda: messagebox.showerror("Error", message["data"]["message"] if message else "No response from server"))
@@ -222,7 +386,7 @@ class Client:
                     self.sock = None
 
         except Exception as e:
-            self.logger.error(f"Login error: {e}")
+            self.logger.error("Login error: %s", e)
             self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send login request: {e}"))
 
             if self.sock:
@@ -243,7 +407,7 @@ class Client:
         
         try:
             self.sock.send(Protocol.create_register_message(username, password))
-            message = Protocol.decode_message(self.sock, use_timeout=True)
+            message = self.receive_response()
 
             if message and message["type"] == Protocol.MESSAGE_TYPES["success"]:
                 self.root.after(0, lambda: messagebox.showinfo("Success", "Registration successful! Please log in."))
@@ -256,7 +420,7 @@ class Client:
                 self.sock = None
 
         except Exception as e:
-            self.logger.error(f"Register error: {e}")
+            self.logger.error("Register error: %s", e)
             self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send register request: {e}"))
 
             if self.sock:
@@ -277,11 +441,16 @@ class Client:
             return
         
         try:
-            self.sock.send(Protocol.create_text_message(self.username, receiver, content))
+            # "#name" in the "To" field sends to a room
+            if receiver.startswith("#"):
+                self.send(Protocol.create_room_message(receiver[1:], content, codec=self.codec))
+                self.display_message(f"{receiver} {self.username}: {content}\n")
+            else:
+                self.send(Protocol.create_text_message(self.username, receiver, content, self.codec))
             self.message_entry.delete(0, tk.END)
             
         except Exception as e:
-            self.logger.error(f"Send message error: {e}")
+            self.logger.error("Send message error: %s", e)
             self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send message: {e}"))
 
     # Send file message handling logic + button event listener function
@@ -298,39 +467,332 @@ class Client:
         filename = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
 
-        if file_size > Protocol.MAX_FILE_SIZE:
-            messagebox.showerror("Error", "File size exceeds 2MB limit")
+        receiver = self.receiver_entry.get()
+
+        if not receiver:
+            messagebox.showerror("Error", "Please enter receiver")
             return
-        
+
+        # Stream file in the background so the GUI stays responsive
+        upload_thread = threading.Thread(target=self.upload_file, args=(receiver, file_path, filename, file_size))
+        upload_thread.daemon = True
+        upload_thread.start()
+
+    # Stream file to the server chunk by chunk (only one chunk is held in memory).
+    # The SHA-256 is announced first, files the server already stores are not uploaded again.
+    # Passing the transfer id of an interrupted upload continues it from where the server left off
+    def upload_file(self, receiver, file_path, filename, file_size, transfer_id=None):
+        resume = transfer_id is not None
+        transfer_id = transfer_id or uuid.uuid4().hex
+        pending = self.file_acks[transfer_id] = [threading.Event(), None]
+        self.unfinished_uploads[transfer_id] = (receiver, file_path, filename, file_size)
+
+        try:
+            compression = self.upload_compression(file_path)
+
+            if resume:
+                self.send(Protocol.create_file_resume_request(transfer_id))
+            else:
+                digest = hashlib.sha256()
+                with open(file_path, 'rb') as f:
+                    while chunk := f.read(Protocol.CHUNK_SIZE):
+                        digest.update(chunk)
+
+                self.send(Protocol.create_file_header(
+                    receiver, filename, file_size, transfer_id, codec=self.codec, sha256=digest.hexdigest(), compression=compression
+                ))
+
+            ack = self.wait_file_ack(pending)
+
+            if ack["offset"] is None:
+                # Server no longer has the interrupted upload, start over
+                del self.unfinished_uploads[transfer_id]
+                self.file_acks.pop(transfer_id, None)
+                return self.upload_file(receiver, file_path, filename, file_size)
+
+            if ack["exists"]:
+                del self.unfinished_uploads[transfer_id]
+                self.root.after(0, lambda: self.display_message(f"Sent file: {filename} (already stored on server)\n"))
+                return
+
+            # Send from the offset the server asked for until it confirms the whole file
+            # (after a corrupted chunk it asks to go back to the last good offset)
+            offset = ack["offset"]
+            compressor = Protocol.create_compressor(compression) if compression else None
+            with open(file_path, 'rb') as f:
+                while True:
+                    f.seek(offset)
+                    while offset < file_size and not pending[0].is_set():
+                        chunk = f.read(Protocol.CHUNK_SIZE)
+                        self.send(Protocol.create_file_chunk(transfer_id, chunk, self.codec, offset, compressor))
+                        offset += len(chunk)
+
+                    ack = self.wait_file_ack(pending, 30.0)
+                    if ack["offset"] is None:
+                        raise ConnectionError("Upload was dropped by the server")
+
+                    if ack["exists"]:
+                        break
+
+                    offset = ack["offset"]
+
+            del self.unfinished_uploads[transfer_id]
+            self.root.after(0, lambda: self.display_message(f"Sent file: {filename}\n"))
+
+        except Exception as e:
+            self.logger.error("Send file error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {e}"))
+
+        finally:
+            self.file_acks.pop(transfer_id, None)
+
+    # Pick compression of an upload: zlib if the server decodes it and the start of the file compresses well
+    # (the same file always gets the same answer, so a resumed upload continues the way it started)
+    def upload_compression(self, file_path):
+        if Protocol.COMPRESSION_ZLIB not in self.compressions:
+            return None
+
         with open(file_path, 'rb') as f:
-            file_data = f.read()
+            return Protocol.COMPRESSION_ZLIB if Protocol.is_compressible(f.read(Protocol.CHUNK_SIZE)) else None
+
+    # Wait for the next FILE_ACK of an upload
+    def wait_file_ack(self, pending, timeout=10.0):
+        if not pending[0].wait(timeout):
+            raise TimeoutError("No answer from server")
+
+        pending[0].clear()
+        return pending[1]
+
+    # Continue uploads that were cut off by a disconnect
+    def resume_uploads(self):
+        for transfer_id, (receiver, file_path, filename, file_size) in list(self.unfinished_uploads.items()):
+            upload_thread = threading.Thread(target=self.upload_file, args=(receiver, file_path, filename, file_size, transfer_id))
+            upload_thread.daemon = True
+            upload_thread.start()
+
+    # Send complete frame to the server (frames from different threads never interleave),
+    # large frames are compressed if the server decodes zlib
+    def send(self, data):
+        if Protocol.COMPRESSION_ZLIB in self.compressions:
+            data = Protocol.compress_frame(data)
+
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    # Download previously sent or received file handling logic + button event listener function
+    def download_file(self):
+        if not self.is_connected():
+            self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+            return
+
+        filename = simpledialog.askstring("Download File", "File name:", parent=self.root)
+
+        if not filename:
+            return
+
+        # Only the missing part of a file cut off by a disconnect is downloaded
+        save_path = self.partial_downloads.get(filename)
+        offset = os.path.getsize(save_path) if save_path and os.path.exists(save_path) else 0
+
+        try:
+            self.send(Protocol.create_download_request(filename, offset))
+
+        except Exception as e:
+            self.logger.error("Download file error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to request file: {e}"))
+
+    # Load next (older) page of the conversation with the user in the "To" field + button event listener function
+    def load_history(self):
+        if not self.is_connected():
+            self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+            return
 
         receiver = self.receiver_entry.get()
 
         if not receiver:
             messagebox.showerror("Error", "Please enter receiver")
             return
-        
+
+        if receiver in self.history_cursors and self.history_cursors[receiver] is None:
+            messagebox.showinfo("History", f"No older messages with {receiver}")
+            return
+
         try:
-            self.sock.send(Protocol.create_file_message(receiver, filename, file_data))
+            self.send(Protocol.create_history_request(receiver, self.history_cursors.get(receiver)))
 
         except Exception as e:
-            self.logger.error(f"Send file error: {e}")
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {e}"))
+            self.logger.error("Load history error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to request history: {e}"))
+
+    # Search messages handling logic + button event listener function
+    # (searching for the same query again shows the next page of hits)
+    def search_messages(self):
+        if not self.is_connected():
+            self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+            return
+
+        query = simpledialog.askstring("Search", "Search messages:", initialvalue=self.search_query or "", parent=self.root)
+
+        if not query:
+            return
+
+        offset = 0
+        if query == self.search_query:
+            if self.search_offset is None:
+                messagebox.showinfo("Search", f"No more results for '{query}'")
+                return
+
+            offset = self.search_offset
+
+        self.search_query = query
+
+        try:
+            self.send(Protocol.create_search_request(query, offset))
+
+        except Exception as e:
+            self.logger.error("Search error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to search messages: {e}"))
+
+    # Create room handling logic + button event listener function
+    def create_room(self):
+        if not self.is_connected():
+            self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+            return
+
+        room = simpledialog.askstring("Create Room", "Room name:", parent=self.root)
+
+        if not room:
+            return
+
+        try:
+            self.send(Protocol.create_room_create_request(room))
+
+        except Exception as e:
+            self.logger.error("Create room error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to create room: {e}"))
+
+    # Join room handling logic + button event listener function
+    def join_room(self):
+        if not self.is_connected():
+            self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+            return
+
+        room = simpledialog.askstring("Join Room", "Room name:", parent=self.root)
 
-    # Display contacts list handling logic + button event listener function
+        if not room:
+            return
+
+        try:
+            self.send(Protocol.create_room_join_request(room))
+
+        except Exception as e:
+            self.logger.error("Join room error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to join room: {e}"))
+
+    # Open contacts window + button event listener function. Contacts are loaded one page at a time,
+    # a prefix narrows the list and "Find Users" searches all users to add new contacts
     def view_contacts(self):
         if not self.is_connected():
             self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
             return
-        
+
+        if self.contacts_window is None or not self.contacts_window.winfo_exists():
+            self.contacts_window = tk.Toplevel(self.root)
+            self.contacts_window.title("Contacts")
+
+            frame = tk.Frame(self.contacts_window)
+            frame.pack(pady=5, padx=10, fill="x")
+            tk.Label(frame, text="Name starts with:").pack(side="left")
+            self.contacts_prefix_entry = tk.Entry(frame, width=15)
+            self.contacts_prefix_entry.pack(side="left", padx=5)
+            tk.Button(frame, text="Contacts", command=lambda: self.load_contacts(False)).pack(side="left")
+            tk.Button(frame, text="Find Users", command=lambda: self.load_contacts(True)).pack(side="left")
+
+            self.contacts_listbox = tk.Listbox(self.contacts_window, height=15)
+            self.contacts_listbox.pack(pady=5, padx=10, fill="both", expand=True)
+
+            frame = tk.Frame(self.contacts_window)
+            frame.pack(pady=5)
+            tk.Button(frame, text="Load More", command=self.load_more_contacts).pack(side="left", padx=5)
+            tk.Button(frame, text="Add Contact", command=self.add_contact).pack(side="left", padx=5)
+            tk.Button(frame, text="Message", command=self.message_contact).pack(side="left", padx=5)
+
+        self.load_contacts(False)
+
+    # Start a new contact list (own contacts or all users) from its first page
+    def load_contacts(self, directory):
+        self.contacts_query = (self.contacts_prefix_entry.get().strip(), directory)
+        self.contacts_after = ""
+        self.contacts_listbox.delete(0, tk.END)
+        self.load_more_contacts()
+
+    # Request next page of the contact list being shown
+    def load_more_contacts(self):
+        if self.contacts_after is None:
+            return
+
+        prefix, directory = self.contacts_query
+
         try:
-            self.sock.send(Protocol.create_contact_list_request())
+            self.send(Protocol.create_contact_list_request(prefix, self.contacts_after, directory=directory))
 
         except Exception as e:
-            self.logger.error(f"View contacts error: {e}")
+            self.logger.error("View contacts error: %s", e)
             self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to request contacts: {e}"))
 
+    # Append received page to the contacts window (pages of an outdated list are ignored)
+    def display_contacts(self, data):
+        if self.contacts_listbox is None or not self.contacts_listbox.winfo_exists():
+            return
+
+        if (data.get("prefix", ""), data.get("directory", False)) != self.contacts_query:
+            return
+
+        for name in data["contacts"]:
+            self.contacts_listbox.insert(tk.END, name)
+            if name in self.online_contacts:
+                self.contacts_listbox.itemconfig(tk.END, foreground="green")
+
+        self.contacts_after = data.get("next_after")
+
+    # Apply presence changes to the contacts window and note them in the chat
+    def update_presence(self, data):
+        self.online_contacts.update(data["online"])
+        self.online_contacts.difference_update(data["offline"])
+
+        if data["online"]:
+            self.display_message(f"Online: {', '.join(data['online'])}\n")
+
+        if data["offline"]:
+            self.display_message(f"Offline: {', '.join(data['offline'])}\n")
+
+        if self.contacts_listbox is not None and self.contacts_listbox.winfo_exists():
+            for index, name in enumerate(self.contacts_listbox.get(0, tk.END)):
+                self.contacts_listbox.itemconfig(index, foreground="green" if name in self.online_contacts else "black")
+
+    # Add selected user to the contact list
+    def add_contact(self):
+        selection = self.contacts_listbox.curselection()
+
+        if not selection:
+            messagebox.showerror("Error", "Please select a user")
+            return
+
+        try:
+            self.send(Protocol.create_contact_add_request(self.contacts_listbox.get(selection[0])))
+
+        except Exception as e:
+            self.logger.error("Add contact error: %s", e)
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to add contact: {e}"))
+
+    # Put selected contact into the "To" field
+    def message_contact(self):
+        selection = self.contacts_listbox.curselection()
+
+        if selection:
+            self.receiver_entry.delete(0, tk.END)
+            self.receiver_entry.insert(0, self.contacts_listbox.get(selection[0]))
+
 
     def exit(self):
         """Exit the application."""
@@ -339,7 +801,7 @@ class Client:
             try:
                 self.sock.close()
             except Exception as e:
-                self.logger.error(f"Error closing socket: {e}")
+                self.logger.error("Error closing socket: %s", e)
             self.sock = None
         self.root.quit()
 
@@ -1,200 +1,1039 @@
 import sqlite3 as sq
 import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from logs import configure_logging, get_message_logger
+from metrics import REGISTRY
+
+
+QUERY_SECONDS = REGISTRY.histogram("messenger_db_query_seconds", "Time spent in Database methods", ("method",))
+BATCH_ROWS = REGISTRY.histogram("messenger_db_batch_rows", "Rows committed per write-behind batch", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+BATCH_SECONDS = REGISTRY.histogram("messenger_db_batch_seconds", "Time to write and commit a write-behind batch")
+
+
+# Record time spent in the decorated Database method, labelled with its name
+def timed(method):
+    return QUERY_SECONDS.time(method.__name__)(method)
+
+
+class ConnectionPool:
+    # Setup one writer connection plus a pool of read connections (WAL lets readers run next to the writer)
+    def __init__(self, path, read_connections=4, cache_size=-16000):
+        self.path = path
+        self.cache_size = cache_size # negative value = size in KiB per connection
+
+        self.writer = self.connect()
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.write_lock = threading.Lock()
+
+        self.readers = queue.Queue()
+        for _ in range(read_connections):
+            self.readers.put(self.connect())
+
+    # Open tuned connection (statements are prepared once and reused from the per-connection cache)
+    def connect(self):
+        conn = sq.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA synchronous=NORMAL") # safe with WAL, no fsync on every commit
+        conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        conn.execute("PRAGMA busy_timeout=5000")
+
+        return conn
+
+    # Borrow read connection for the duration of the block
+    @contextmanager
+    def read(self):
+        conn = self.readers.get()
+        try:
+            yield conn
+
+        finally:
+            self.readers.put(conn)
+
+    # Get exclusive access to the writer connection, rolling back on errors
+    @contextmanager
+    def write(self):
+        with self.write_lock:
+            try:
+                yield self.writer
+
+            except Exception:
+                self.writer.rollback()
+                raise
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+
+class WriteBehindQueue:
+    # Setup background writer that groups inserts into transactions
+    def __init__(self, pool, batch_size=500, flush_interval=0.02):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # longest time a batch keeps collecting rows that keep arriving
+        self.logger = logging.getLogger(__name__)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="db-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue insert, the returned future resolves to True/False once the row is committed
+    def put(self, query, params):
+        pending = Future()
+        self.queue.put((query, params, pending))
+        return pending
+
+    # Wait until everything queued so far is committed
+    def flush(self):
+        if not self.thread.is_alive():
+            return True
+
+        pending = Future()
+        self.queue.put((None, None, pending))
+        return pending.result()
+
+    # Commit remaining rows and stop the writer thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        running = True
+
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # Group commit: take the rows that queued up meanwhile and commit as soon as the queue is drained
+            # (rows arriving during the commit form the next batch). A flush marker ends the batch right away
+            while batch[-1] is not None and batch[-1][0] is not None and len(batch) < self.batch_size:
+                if time.monotonic() >= deadline:
+                    break
+
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+
+            start = time.perf_counter()
+            with self.pool.write() as conn:
+                self.write_batch(conn, batch)
+
+            # Batches holding only flush markers wrote nothing
+            rows = sum(query is not None for query, _, _ in batch)
+            if rows:
+                BATCH_SECONDS.observe(time.perf_counter() - start)
+                BATCH_ROWS.observe(rows)
+
+    # Write batch in a single transaction (consecutive rows of the same query go through executemany)
+    def write_batch(self, conn, batch):
+        rows = [item for item in batch if item[0] is not None]
+
+        try:
+            group_start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i][0] != rows[group_start][0]:
+                    conn.executemany(rows[group_start][0], [params for _, params, _ in rows[group_start:i]])
+                    group_start = i
+
+            conn.commit()
+            results = [True] * len(rows)
+
+        except Exception as e:
+            # Retry rows one by one so a single bad row does not fail the whole batch
+            self.logger.error("Error writing batch of %s rows, retrying one by one: %s", len(rows), e)
+            conn.rollback()
+            results = [self.write_row(conn, query, params) for query, params, _ in rows]
+
+        for (_, _, pending), result in zip(rows, results):
+            pending.set_result(result)
+
+        # Flush markers resolve after everything queued before them
+        for query, _, pending in batch:
+            if query is None:
+                pending.set_result(True)
+
+    def write_row(self, conn, query, params):
+        try:
+            conn.execute(query, params)
+            conn.commit()
+            return True
+
+        except Exception as e:
+            self.logger.error("Error writing row: %s", e)
+            conn.rollback()
+            return False
+
+
+class UserCache:
+    # Setup bounded LRU directory of username <-> user id (users almost never change)
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.usernames = OrderedDict() # {user_id: username}, least recently used first
+        self.user_ids = {} # {username: user_id}
+
+        # Setup counters to confirm lookups are served from memory
+        self.hits = 0
+        self.misses = 0
+
+    def get_user_id(self, username):
+        with self.lock:
+            user_id = self.user_ids.get(username)
+            if user_id is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.usernames.move_to_end(user_id)
+            return user_id
+
+    def get_username(self, user_id):
+        with self.lock:
+            username = self.usernames.get(user_id)
+            if username is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.usernames.move_to_end(user_id)
+            return username
+
+    # Add user to the cache, evicting the least recently used one when full
+    def put(self, user_id, username):
+        with self.lock:
+            self._remove(user_id)
+            self.usernames[user_id] = username
+            self.user_ids[username] = user_id
+
+            while len(self.usernames) > self.capacity:
+                _, evicted = self.usernames.popitem(last=False)
+                self.user_ids.pop(evicted, None)
+
+    def _remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is not None:
+            self.user_ids.pop(username, None)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.usernames)}
 
 
 class Database:
-    def __init__(self):
-        # Configure logger for easier debugging
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Durability modes: return after the row is committed or right after it is queued
+    ACK_COMMIT = "commit"
+    ACK_ENQUEUE = "enqueue"
+
+    # Largest SQLite rowid, used as the open end of keyset pagination
+    MAX_ID = 2 ** 63 - 1
+
+    def __init__(self, path="database.db", durability=ACK_COMMIT, batch_size=500, flush_interval=0.02, read_connections=4, user_cache_size=10000):
+        # Configure logger (per-message events go to the sampled message logger at DEBUG)
+        configure_logging()
 
         self.logger = logging.getLogger(__name__)
-        self.conn = sq.connect("database.db", check_same_thread=False)
+        self.message_logger = get_message_logger(__name__)
+        self.pool = ConnectionPool(path, read_connections)
         # Initialize tables
         self.create_tables()
+
+        # Setup room message ids: handed out before the write-behind insert, so the server knows the id of
+        # a room message while it fans it out (this process is the only writer of the database)
+        self.room_message_lock = threading.Lock()
+        self.last_room_message_id = self.get_last_room_message_id()
+
+        # Setup write-behind queue for messages and files
+        self.durability = durability
+        self.writes = WriteBehindQueue(self.pool, batch_size, flush_interval)
+
+        # Setup username <-> user id cache for the message hot path (users are never renamed or deleted,
+        # so entries only leave it when evicted)
+        self.users = UserCache(user_cache_size)
+        REGISTRY.gauge("messenger_user_cache_hits", "User lookups served from the cache", lambda: self.users.hits)
+        REGISTRY.gauge("messenger_user_cache_misses", "User lookups that went to the database", lambda: self.users.misses)
+        REGISTRY.gauge("messenger_user_cache_size", "Users in the cache", lambda: len(self.users.usernames))
         self.logger.info("Database initialized")
 
     # Create necessary tables for data management
     def create_tables(self):
         try:
-            cursor = self.conn.cursor()
-
-            # Create users table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users
-                    (
-                           id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           username TEXT UNIQUE NOT NULL,
-                           password TEXT NOT NULL
-                    )
-            """)
-
-            # Create messages tables
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages
-                    (
-                           id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           sender_id INTEGER,
-                           receiver_id INTEGER,
-                           message TEXT NOT NULL,
-                           timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                           FOREIGN KEY (sender_id) REFERENCES users(id),
-                           FOREIGN KEY (receiver_id) REFERENCES users(id)
-                    )
-            """)
-
-            # Create files table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS files
-                    (
-                           id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           sender_id INTEGER,
-                           receiver_id INTEGER,
-                           filename TEXT NOT NULL,
-                           timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                           FOREIGN KEY (sender_id) REFERENCES users(id),
-                           FOREIGN KEY (receiver_id) REFERENCES users(id)
-                    )
-            """)
-
-            self.conn.commit()
+            with self.pool.write() as conn:
+                cursor = conn.cursor()
+
+                # Create users table
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS users
+                        (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               username TEXT UNIQUE NOT NULL,
+                               password TEXT NOT NULL
+                        )
+                """)
+
+                # Create messages tables
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS messages
+                        (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               sender_id INTEGER,
+                               receiver_id INTEGER,
+                               message TEXT NOT NULL,
+                               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                               delivered INTEGER NOT NULL DEFAULT 0,
+                               FOREIGN KEY (sender_id) REFERENCES users(id),
+                               FOREIGN KEY (receiver_id) REFERENCES users(id)
+                        )
+                """)
+
+                # Create files table
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS files
+                        (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               sender_id INTEGER,
+                               receiver_id INTEGER,
+                               filename TEXT NOT NULL,
+                               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                               delivered INTEGER NOT NULL DEFAULT 0,
+                               blob_hash TEXT,
+                               file_size INTEGER,
+                               FOREIGN KEY (sender_id) REFERENCES users(id),
+                               FOREIGN KEY (receiver_id) REFERENCES users(id)
+                        )
+                """)
+
+                # Create conversation index (history pages are one index seek per direction)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_messages_conversation
+                        ON messages (sender_id, receiver_id, id)
+                """)
+
+                # Add delivered flag to tables created before it existed (old rows count as delivered)
+                for table in ("messages", "files"):
+                    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+                    if "delivered" not in columns:
+                        cursor.execute(f"ALTER TABLE {table} ADD COLUMN delivered INTEGER NOT NULL DEFAULT 0")
+                        cursor.execute(f"UPDATE {table} SET delivered = 1")
+
+                # Add blob reference to files tables created before the blob store existed
+                # (old rows keep blob_hash NULL and are read from files/<filename>)
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(files)")]
+                if "blob_hash" not in columns:
+                    cursor.execute("ALTER TABLE files ADD COLUMN blob_hash TEXT")
+                    cursor.execute("ALTER TABLE files ADD COLUMN file_size INTEGER")
+
+                # Create offline queue indexes (only undelivered rows are indexed)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_messages_undelivered
+                        ON messages (receiver_id, id) WHERE delivered = 0
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_files_undelivered
+                        ON files (receiver_id, id) WHERE delivered = 0
+                """)
+
+                # Create blob index (who already holds the content of a file, see has_blob)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_files_blob
+                        ON files (blob_hash) WHERE blob_hash IS NOT NULL
+                """)
+
+                # Create rooms tables (room messages are stored once, each member keeps a delivery cursor)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS rooms
+                        (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               name TEXT UNIQUE NOT NULL,
+                               owner_id INTEGER,
+                               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                               FOREIGN KEY (owner_id) REFERENCES users(id)
+                        )
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS room_members
+                        (
+                               room_id INTEGER NOT NULL,
+                               user_id INTEGER NOT NULL,
+                               delivered_id INTEGER NOT NULL DEFAULT 0,
+                               PRIMARY KEY (room_id, user_id),
+                               FOREIGN KEY (room_id) REFERENCES rooms(id),
+                               FOREIGN KEY (user_id) REFERENCES users(id)
+                        ) WITHOUT ROWID
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS room_messages
+                        (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               room_id INTEGER NOT NULL,
+                               sender_id INTEGER,
+                               message TEXT NOT NULL,
+                               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                               FOREIGN KEY (room_id) REFERENCES rooms(id),
+                               FOREIGN KEY (sender_id) REFERENCES users(id)
+                        )
+                """)
+
+                # Create room indexes (rooms of a user, messages of a room after a cursor)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_room_members_user
+                        ON room_members (user_id, room_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_room_messages_room
+                        ON room_messages (room_id, id)
+                """)
+
+                # Create contacts table (one row per direction, a user's contacts are a primary key range)
+                contacts_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts'").fetchone()
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS contacts
+                        (
+                               user_id INTEGER NOT NULL,
+                               contact_id INTEGER NOT NULL,
+                               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                               PRIMARY KEY (user_id, contact_id),
+                               FOREIGN KEY (user_id) REFERENCES users(id),
+                               FOREIGN KEY (contact_id) REFERENCES users(id)
+                        ) WITHOUT ROWID
+                """)
+
+                # Create reverse contacts index (who has a user as contact, for presence updates)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_contacts_contact
+                        ON contacts (contact_id, user_id)
+                """)
+
+                # Before the contacts table existed everyone saw every user, start with the people they talked to
+                if not contacts_exist:
+                    cursor.execute("""
+                        INSERT OR IGNORE INTO contacts (user_id, contact_id)
+                        SELECT DISTINCT sender_id, receiver_id FROM messages WHERE sender_id != receiver_id
+                        UNION
+                        SELECT DISTINCT receiver_id, sender_id FROM messages WHERE sender_id != receiver_id
+                    """)
+
+                self.create_search_index(cursor)
+
+                conn.commit()
+
             self.logger.info("Database tables created")
         
         except Exception as e:
-            self.logger.error(f"Error creating tables: {str(e)}")
+            self.logger.error("Error creating tables: %s", str(e))
             raise
 
+    # Create full-text index of messages. The FTS5 table takes its content from a view over messages (the text
+    # is not stored twice) and indexes the participants as "u<id>" tokens, so scoping a search to the user's
+    # conversations is an index intersection instead of a filter over every hit. Triggers keep it in sync
+    def create_search_index(self, cursor):
+        cursor.execute("""
+            CREATE VIEW IF NOT EXISTS messages_search AS
+                SELECT id, message, 'u' || sender_id || ' u' || receiver_id AS participants FROM messages
+        """)
+
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                USING fts5(message, participants, content='messages_search', content_rowid='id')
+        """)
+
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, message, participants)
+                VALUES (new.id, new.message, 'u' || new.sender_id || ' u' || new.receiver_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+                VALUES ('delete', old.id, old.message, 'u' || old.sender_id || ' u' || old.receiver_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, sender_id, receiver_id ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+                VALUES ('delete', old.id, old.message, 'u' || old.sender_id || ' u' || old.receiver_id);
+                INSERT INTO messages_fts (rowid, message, participants)
+                VALUES (new.id, new.message, 'u' || new.sender_id || ' u' || new.receiver_id);
+            END
+        """)
+
+        # Index messages stored before the search index existed
+        if not exists:
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    # Turn user input into an FTS5 query: every word must match (a trailing * matches words starting with it),
+    # quoting keeps operators and punctuation in the input from being read as query syntax
+    @staticmethod
+    def build_search_query(text):
+        terms = []
+        for word in text.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+
+        return " ".join(terms)
+
     # Add (register) user to the database
+    @timed
     def add_user(self, username, password):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+            with self.pool.write() as conn:
+                cursor = conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+                conn.commit()
+
+            self.users.put(cursor.lastrowid, username)
 
-            self.conn.commit()
-            self.logger.info(f"User {username} added to database")
+            self.logger.info("User %s added to database", username)
             return True
 
         except sq.IntegrityError:
-            self.logger.error(f"Username {username} already exists")
+            self.logger.error("Username %s already exists", username)
             return False
 
         except Exception as e:
-             self.logger.error(f"Error adding user {username} : {str(e)}")
+             self.logger.error("Error adding user %s : %s", username, str(e))
              return False
 
     # Authenticate (login) user
+    @timed
     def authenticate_user(self, username, password):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE username = ? AND password = ?", (username, password))
-            result = cursor.fetchone()
+            with self.pool.read() as conn:
+                result = conn.execute("SELECT id FROM users WHERE username = ? AND password = ?", (username, password)).fetchone()
+
             # Fetch user id 
             user_id = result[0] if result else None
 
             if user_id:
-                self.logger.info(f"User {username} added to the database with ID {user_id}")
+                self.users.put(user_id, username)
+                self.logger.info("User %s added to the database with ID %s", username, user_id)
             else:
-                self.logger.warning(f"Authentication failed for user {username}")
+                self.logger.warning("Authentication failed for user %s", username)
             
             return user_id
         
         except Exception as e:
-            self.logger.error(f"Error authenticating user {username}: {str(e)}")
+            self.logger.error("Error authenticating user %s: %s", username, str(e))
             return None
         
-    # Fetch contacts from the database by user if
-    def get_contacts(self, user_id):
+    # Get bounds of the usernames starting with prefix (a range on the username index, unlike LIKE)
+    @staticmethod
+    def prefix_range(prefix):
+        return prefix, prefix + "\U0010ffff"
+
+    # Add contact to the user's contact list (adding an existing contact is not an error)
+    @timed
+    def add_contact(self, user_id, contact_id):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT username FROM users WHERE id != ?", (user_id,))
-            contacts = [row[0] for row in cursor.fetchall()]
+            with self.pool.write() as conn:
+                conn.execute("INSERT OR IGNORE INTO contacts (user_id, contact_id) VALUES (?, ?)", (user_id, contact_id))
+                conn.commit()
+
+            self.logger.info("User %s added to contacts of user %s", contact_id, user_id)
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error adding contact %s for user %s: %s", contact_id, user_id, e)
+            return False
+
+    # Fetch page of the user's contact names in alphabetical order. Pages are keyset paginated:
+    # pass the last name of the previous page as after to get the next page
+    @timed
+    def get_contacts(self, user_id, prefix="", after="", limit=50):
+        try:
+            low, high = self.prefix_range(prefix)
+
+            with self.pool.read() as conn:
+                contacts = [row[0] for row in conn.execute("""
+                    SELECT users.username FROM contacts
+                    JOIN users ON users.id = contacts.contact_id
+                    WHERE contacts.user_id = ? AND users.username > ? AND users.username >= ? AND users.username < ?
+                    ORDER BY users.username LIMIT ?
+                """, (user_id, after, low, high, limit))]
             
-            self.logger.debug(f"Retrieved contacts for user {user_id}: {contacts}")
+            self.logger.debug("Retrieved %s contacts for user %s", len(contacts), user_id)
 
-            return contacts if len(contacts) > 0 else []
+            return contacts
         
         except Exception as e:
-            self.logger.error(f"Error retrieving contacts for user {user_id}: {e}")
+            self.logger.error("Error retrieving contacts for user %s: %s", user_id, e)
+            return []
+
+    # Get ids of all contacts of the user
+    @timed
+    def get_contact_ids(self, user_id):
+        try:
+            with self.pool.read() as conn:
+                return [row[0] for row in conn.execute("SELECT contact_id FROM contacts WHERE user_id = ?", (user_id,))]
+
+        except Exception as e:
+            self.logger.error("Error retrieving contact ids of user %s: %s", user_id, e)
+            return []
+
+    # Get ids of the users that have the user as a contact
+    @timed
+    def get_watcher_ids(self, user_id):
+        try:
+            with self.pool.read() as conn:
+                return [row[0] for row in conn.execute("SELECT user_id FROM contacts WHERE contact_id = ?", (user_id,))]
+
+        except Exception as e:
+            self.logger.error("Error retrieving users watching user %s: %s", user_id, e)
+            return []
+
+    # Fetch page of all usernames starting with prefix (except the user's own), keyset paginated like
+    # get_contacts. The range is served from the index of the UNIQUE username column
+    @timed
+    def search_users(self, user_id, prefix="", after="", limit=50):
+        try:
+            low, high = self.prefix_range(prefix)
+
+            with self.pool.read() as conn:
+                usernames = [row[0] for row in conn.execute("""
+                    SELECT username FROM users
+                    WHERE username > ? AND username >= ? AND username < ? AND id != ?
+                    ORDER BY username LIMIT ?
+                """, (after, low, high, user_id, limit))]
+
+            self.logger.debug("Found %s users starting with %r", len(usernames), prefix)
+
+            return usernames
+
+        except Exception as e:
+            self.logger.error("Error searching users starting with %r: %s", prefix, e)
             return []
         
     # Fetch username from the database by user id
+    @timed
     def get_username(self, user_id):
+        username = self.users.get_username(user_id)
+        if username is not None:
+            return username
+
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-            result = cursor.fetchone()
+            with self.pool.read() as conn:
+                result = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
 
             username = result[0] if result else None
 
             if username:
-                self.logger.debug(f"Retrieved username for user {user_id}")
+                self.users.put(user_id, username)
+                self.message_logger.debug("Retrieved username for user %s", user_id)
             else:
-                self.logger.warning(f"No username found for user {user_id}")
+                self.logger.warning("No username found for user %s", user_id)
             
             return username
         
         except Exception as e:
-            self.logger.error(f"Error retrieving user_id for username {username}: {str(e)}")
+            self.logger.error("Error retrieving username for user %s: %s", user_id, str(e))
             return None
         
     # Get user id from the database by username
+    @timed
     def get_user_id(self, username):
+        user_id = self.users.get_user_id(username)
+        if user_id is not None:
+            return user_id
+
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            result = cursor.fetchone()
+            with self.pool.read() as conn:
+                result = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
 
-            user_id = result[0]
+            user_id = result[0] if result else None
 
             if user_id:
-                self.logger.debug(f"Retrieved id {user_id} for user {username}")
+                self.users.put(user_id, username)
+                self.message_logger.debug("Retrieved id %s for user %s", user_id, username)
 
             else:
-                self.logger.warning(f"No user id found for user {username}")
+                self.logger.warning("No user id found for user %s", username)
 
             return user_id
         
         except Exception as e:
-            self.logger.error(f"Error retrieving user id for user {username}: {e}")
+            self.logger.error("Error retrieving user id for user %s: %s", username, e)
             return None
 
-    # Store sent messages to the database
-    def store_message(self, sender_id, receiver_id, message):
+    # Get user cache hit/miss counters
+    def cache_stats(self):
+        return self.users.stats()
+
+    # Store sent messages to the database (batched by the write-behind queue)
+    @timed
+    def store_message(self, sender_id, receiver_id, message, delivered=False):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("INSERT INTO messages (sender_id, receiver_id, message) VALUES (?, ?, ?)", (sender_id, receiver_id, message))
+            pending = self.writes.put("INSERT INTO messages (sender_id, receiver_id, message, delivered) VALUES (?, ?, ?, ?)", (sender_id, receiver_id, message, int(delivered)))
+
+            if self.durability == self.ACK_COMMIT and not pending.result():
+                self.logger.error("Error storing message from user %s", sender_id)
+                return False
 
-            self.conn.commit()
-            self.logger.info(f"Stored message from user {sender_id} to user {receiver_id}")
+            self.message_logger.debug("Stored message from user %s to user %s", sender_id, receiver_id)
 
             return True
         
         except Exception as e:
-            self.logger.error(f"Error storing message from user {sender_id}: {str(e)}")
+            self.logger.error("Error storing message from user %s: %s", sender_id, str(e))
             return False
         
-    # Store sent files (filenames) to the database
-    def store_file(self, sender_id, receiver_id, filename):
+    # Store sent files (filenames and the blob holding their data) to the database (batched by the write-behind queue)
+    @timed
+    def store_file(self, sender_id, receiver_id, filename, delivered=False, blob_hash=None, file_size=None):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("INSERT INTO files (sender_id, receiver_id, filename) VALUES (?, ?, ?)", (sender_id, receiver_id, filename))
+            pending = self.writes.put(
+                "INSERT INTO files (sender_id, receiver_id, filename, delivered, blob_hash, file_size) VALUES (?, ?, ?, ?, ?, ?)",
+                (sender_id, receiver_id, filename, int(delivered), blob_hash, file_size)
+            )
 
-            self.conn.commit()
-            self.logger.info(f"Stored file {filename} sent from user {sender_id} to user {receiver_id}")
+            if self.durability == self.ACK_COMMIT and not pending.result():
+                self.logger.error("Error storing file %s from user %s", filename, sender_id)
+                return False
+
+            self.message_logger.debug("Stored file %s sent from user %s to user %s", filename, sender_id, receiver_id)
 
             return True
         
         except Exception as e:
-            self.logger.error(f"Error storing file {filename} from user {sender_id}: {str(e)}")
+            self.logger.error("Error storing file %s from user %s: %s", filename, sender_id, str(e))
+            return False
+
+    # Fetch messages that were stored while the user was offline, oldest first
+    @timed
+    def get_undelivered_messages(self, user_id):
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute("""
+                    SELECT id, sender_id, receiver_id, message, timestamp FROM messages
+                    WHERE receiver_id = ? AND delivered = 0
+                    ORDER BY id
+                """, (user_id,)).fetchall()
+
+            self.logger.debug("Retrieved %s undelivered messages for user %s", len(rows), user_id)
+
+            return rows
+
+        except Exception as e:
+            self.logger.error("Error retrieving undelivered messages for user %s: %s", user_id, str(e))
+            return []
+
+    # Fetch files that were stored while the user was offline, oldest first
+    @timed
+    def get_undelivered_files(self, user_id):
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute("""
+                    SELECT id, sender_id, receiver_id, filename, blob_hash FROM files
+                    WHERE receiver_id = ? AND delivered = 0
+                    ORDER BY id
+                """, (user_id,)).fetchall()
+
+            self.logger.debug("Retrieved %s undelivered files for user %s", len(rows), user_id)
+
+            return rows
+
+        except Exception as e:
+            self.logger.error("Error retrieving undelivered files for user %s: %s", user_id, str(e))
+            return []
+
+    # Mark messages and files as delivered in a single transaction
+    @timed
+    def mark_delivered(self, message_ids=(), file_ids=()):
+        try:
+            with self.pool.write() as conn:
+                conn.executemany("UPDATE messages SET delivered = 1 WHERE id = ?", [(i,) for i in message_ids])
+                conn.executemany("UPDATE files SET delivered = 1 WHERE id = ?", [(i,) for i in file_ids])
+                conn.commit()
+
+            self.logger.info("Marked %s messages and %s files as delivered", len(message_ids), len(file_ids))
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error marking messages as delivered: %s", str(e))
             return False
+
+    # Wait until all queued messages and files are committed
+    @timed
+    def flush(self):
+        return self.writes.flush()
         
+    # Fetch page of a conversation, newest first. Pages are keyset paginated: pass the id of the
+    # oldest message of the previous page as before_id to get the next (older) page
+    @timed
+    def get_conversation(self, user_a, user_b, before_id=None, limit=50):
+        try:
+            # Messages queued in enqueue mode must be visible before reading
+            if self.durability == self.ACK_ENQUEUE:
+                self.flush()
+
+            before_id = before_id if before_id is not None else self.MAX_ID
+            page_query = """
+                SELECT id, sender_id, receiver_id, message, timestamp FROM messages
+                WHERE sender_id = ? AND receiver_id = ? AND id < ?
+                ORDER BY id DESC LIMIT ?
+            """
+
+            with self.pool.read() as conn:
+                if user_a == user_b:
+                    rows = conn.execute(page_query, (user_a, user_b, before_id, limit)).fetchall()
+                else:
+                    # Both directions use the (sender_id, receiver_id, id) index, then the two pages are merged
+                    rows = conn.execute(f"""
+                        SELECT * FROM ({page_query})
+                        UNION ALL
+                        SELECT * FROM ({page_query})
+                        ORDER BY id DESC LIMIT ?
+                    """, (user_a, user_b, before_id, limit, user_b, user_a, before_id, limit, limit)).fetchall()
+
+            self.logger.debug("Retrieved %s messages between users %s and %s", len(rows), user_a, user_b)
+
+            return rows
+
+        except Exception as e:
+            self.logger.error("Error retrieving conversation between users %s and %s: %s", user_a, user_b, str(e))
+            return []
+
+    # Search messages the user sent or received, best matches first (bm25, newer first on ties).
+    # Ranked results are paginated by offset: pass the offset of the next page to get it
+    @timed
+    def search_messages(self, user_id, text, offset=0, limit=20):
+        try:
+            query = self.build_search_query(text)
+            if not query:
+                return []
+
+            # Messages queued in enqueue mode must be visible before reading
+            if self.durability == self.ACK_ENQUEUE:
+                self.flush()
+
+            with self.pool.read() as conn:
+                rows = conn.execute("""
+                    SELECT messages.id, messages.sender_id, messages.receiver_id, messages.message, messages.timestamp
+                    FROM messages_fts
+                    JOIN messages ON messages.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?
+                    ORDER BY bm25(messages_fts, 1.0, 0.0), messages.id DESC
+                    LIMIT ? OFFSET ?
+                """, (f"participants : u{int(user_id)} AND message : ({query})", limit, offset)).fetchall()
+
+            self.logger.debug("Found %s messages matching %r for user %s", len(rows), text, user_id)
+
+            return rows
+
+        except Exception as e:
+            self.logger.error("Error searching messages for user %s: %s", user_id, str(e))
+            return []
+
+    # Create room with its owner as the first member, returns the room id (None if the name is taken)
+    @timed
+    def create_room(self, name, owner_id):
+        try:
+            with self.pool.write() as conn:
+                cursor = conn.execute("INSERT INTO rooms (name, owner_id) VALUES (?, ?)", (name, owner_id))
+                conn.execute("INSERT INTO room_members (room_id, user_id) VALUES (?, ?)", (cursor.lastrowid, owner_id))
+                conn.commit()
+
+            self.logger.info("Room %s created by user %s", name, owner_id)
+
+            return cursor.lastrowid
+
+        except sq.IntegrityError:
+            self.logger.error("Room %s already exists", name)
+            return None
+
+        except Exception as e:
+            self.logger.error("Error creating room %s: %s", name, str(e))
+            return None
+
+    # Add user to a room (new members do not get the backlog queued as undelivered)
+    @timed
+    def join_room(self, room_id, user_id):
+        try:
+            with self.pool.write() as conn:
+                conn.execute("""
+                    INSERT OR IGNORE INTO room_members (room_id, user_id, delivered_id)
+                    VALUES (?, ?, (SELECT IFNULL(MAX(id), 0) FROM room_messages WHERE room_id = ?))
+                """, (room_id, user_id, room_id))
+                conn.commit()
+
+            self.logger.info("User %s joined room %s", user_id, room_id)
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error adding user %s to room %s: %s", user_id, room_id, str(e))
+            return False
+
+    # Get room id from the database by room name
+    @timed
+    def get_room_id(self, name):
+        try:
+            with self.pool.read() as conn:
+                result = conn.execute("SELECT id FROM rooms WHERE name = ?", (name,)).fetchone()
+
+            return result[0] if result else None
+
+        except Exception as e:
+            self.logger.error("Error retrieving room id for room %s: %s", name, str(e))
+            return None
+
+    # Get user ids of all members of a room
+    @timed
+    def get_room_members(self, room_id):
+        try:
+            with self.pool.read() as conn:
+                return [row[0] for row in conn.execute("SELECT user_id FROM room_members WHERE room_id = ?", (room_id,))]
+
+        except Exception as e:
+            self.logger.error("Error retrieving members of room %s: %s", room_id, str(e))
+            return []
+
+    # Get largest room message id ever handed out (AUTOINCREMENT ids of deleted messages are not reused)
+    def get_last_room_message_id(self):
+        with self.pool.read() as conn:
+            sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'room_messages'").fetchone()
+            latest = conn.execute("SELECT IFNULL(MAX(id), 0) FROM room_messages").fetchone()
+
+        return max(sequence[0] if sequence else 0, latest[0])
+
+    # Reserve id for the next room message (ids grow in the order they are reserved)
+    def next_room_message_id(self):
+        with self.room_message_lock:
+            self.last_room_message_id += 1
+            return self.last_room_message_id
+
+    # Store room message once for all members (batched by the write-behind queue), under the id
+    # reserved with next_room_message_id() or a new one
+    @timed
+    def store_room_message(self, room_id, sender_id, message, message_id=None):
+        try:
+            if message_id is None:
+                message_id = self.next_room_message_id()
+
+            pending = self.writes.put(
+                "INSERT INTO room_messages (id, room_id, sender_id, message) VALUES (?, ?, ?, ?)",
+                (message_id, room_id, sender_id, message)
+            )
+
+            if self.durability == self.ACK_COMMIT and not pending.result():
+                self.logger.error("Error storing room message from user %s", sender_id)
+                return False
+
+            self.message_logger.debug("Stored message from user %s to room %s", sender_id, room_id)
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error storing room message from user %s: %s", sender_id, str(e))
+            return False
+
+    # Fetch room messages past the user's delivery cursors, oldest first
+    @timed
+    def get_undelivered_room_messages(self, user_id):
+        try:
+            with self.pool.read() as conn:
+                rows = conn.execute("""
+                    SELECT room_messages.id, room_messages.room_id, rooms.name, room_messages.sender_id,
+                           room_messages.message, room_messages.timestamp
+                    FROM room_members
+                    JOIN room_messages ON room_messages.room_id = room_members.room_id
+                                      AND room_messages.id > room_members.delivered_id
+                    JOIN rooms ON rooms.id = room_members.room_id
+                    WHERE room_members.user_id = ?
+                    ORDER BY room_messages.id
+                """, (user_id,)).fetchall()
+
+            self.logger.debug("Retrieved %s undelivered room messages for user %s", len(rows), user_id)
+
+            return rows
+
+        except Exception as e:
+            self.logger.error("Error retrieving undelivered room messages for user %s: %s", user_id, str(e))
+            return []
+
+    # Move the user's delivery cursors forward to the given {room_id: message id}
+    @timed
+    def mark_room_messages_delivered(self, user_id, cursors):
+        try:
+            with self.pool.write() as conn:
+                conn.executemany("""
+                    UPDATE room_members SET delivered_id = MAX(delivered_id, ?)
+                    WHERE room_id = ? AND user_id = ?
+                """, [(message_id, room_id, user_id) for room_id, message_id in cursors.items()])
+
+                conn.commit()
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error moving room cursors of user %s: %s", user_id, str(e))
+            return False
+
+    # Get latest stored file with the given name that the user sent or received
+    @timed
+    def get_file(self, user_id, filename):
+        try:
+            with self.pool.read() as conn:
+                result = conn.execute("""
+                    SELECT id, sender_id, receiver_id, filename, blob_hash FROM files
+                    WHERE filename = ? AND (sender_id = ? OR receiver_id = ?)
+                    ORDER BY id DESC LIMIT 1
+                """, (filename, user_id, user_id)).fetchone()
+
+            if not result:
+                self.logger.warning("No file %s found for user %s", filename, user_id)
+
+            return result
+
+        except Exception as e:
+            self.logger.error("Error retrieving file %s for user %s: %s", filename, user_id, str(e))
+            return None
+
+    # Check whether the user sent or received a file with the given blob (only then may they reuse it
+    # without uploading, knowing a hash does not prove having the data)
+    @timed
+    def has_blob(self, user_id, blob_hash):
+        try:
+            with self.pool.read() as conn:
+                result = conn.execute("""
+                    SELECT 1 FROM files
+                    WHERE blob_hash = ? AND (sender_id = ? OR receiver_id = ?)
+                    LIMIT 1
+                """, (blob_hash, user_id, user_id)).fetchone()
+
+            return result is not None
+
+        except Exception as e:
+            self.logger.error("Error checking blob %s of user %s: %s", blob_hash, user_id, str(e))
+            return False
+
     # Close the connection with the database
     def close(self):
         try:
-            self.conn.close()
+            # Commit queued rows before closing
+            self.writes.close()
+            self.pool.close()
             self.logger.info("Database connection closed")
         
         except Exception as e:
-            self.logger.error(f"Error closing database: {str(e)}")
+            self.logger.error("Error closing database: %s", str(e))
     
             
             
\ No newline at end of file
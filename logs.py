@@ -0,0 +1,116 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Defaults, overridden by the environment (e.g. MESSENGER_LOG_LEVEL=DEBUG MESSENGER_LOG_SAMPLE=1 python server.py)
+DEFAULT_LEVEL = os.environ.get("MESSENGER_LOG_LEVEL", "INFO")
+DEFAULT_SAMPLE_RATE = int(os.environ.get("MESSENGER_LOG_SAMPLE", "100"))
+
+
+class SampleFilter(logging.Filter):
+    # Let through one record in every rate (a rate of 1 keeps everything)
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.counter = itertools.count()
+
+    def sample(self):
+        return self.rate <= 1 or next(self.counter) % self.rate == 0
+
+    def filter(self, record):
+        return self.sample()
+
+
+class SampledLogger(logging.LoggerAdapter):
+    # Logger that samples before the record is created (a filter only runs after the record is built,
+    # which is most of the cost of a log call)
+    def __init__(self, logger, sampler):
+        super().__init__(logger, None)
+        self.sampler = sampler
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level) and self.sampler.sample():
+            self.logger.log(level, msg, *args, **kwargs)
+
+    # Per-message events are logged at DEBUG, keep the disabled case to a single level check
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG) and self.sampler.sample():
+            self.logger.debug(msg, *args, **kwargs)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Hand records over as they are: the queue never leaves the process, so formatting the message
+    # (and any exception) is left to the listener thread instead of the thread that logged it
+    def prepare(self, record):
+        return record
+
+
+# Shared by every per-message logger, so configure_logging() can change the rate of loggers created before it
+SAMPLER = SampleFilter(DEFAULT_SAMPLE_RATE)
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+
+
+# Get logger for per-message events (frames processed, messages stored, ...). They are logged at DEBUG
+# and sampled, so at INFO they cost one level check and at DEBUG they do not flood the output
+def get_message_logger(name):
+    return SampledLogger(logging.getLogger(f"{name}.messages"), SAMPLER)
+
+
+# Create handler that queues records for a listener thread writing them with the given handler.
+# Returns (queue handler, listener), the listener still has to be started
+def create_queue_handler(handler):
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+
+    return DeferredQueueHandler(records), listener
+
+
+# Setup logging of the process: records are queued by the threads that log them and written to stream
+# (stderr by default) by a background thread. Safe to call more than once, later calls only change the
+# level and sample rate. Like logging.basicConfig it leaves alone a root logger the application configured
+def configure_logging(level=None, sample_rate=None, stream=None):
+    global _listener, _handler
+
+    root = logging.getLogger()
+
+    with _lock:
+        if _listener is None and not root.handlers:
+            handler = logging.StreamHandler(stream or sys.stderr)
+            handler.setFormatter(logging.Formatter(FORMAT))
+
+            _handler, _listener = create_queue_handler(handler)
+            root.addHandler(_handler)
+            _listener.start()
+            atexit.register(shutdown)
+
+            root.setLevel(level or DEFAULT_LEVEL)
+
+        elif level is not None:
+            root.setLevel(level)
+
+        if sample_rate is not None:
+            SAMPLER.rate = sample_rate
+
+
+# Write out queued records and stop the listener thread (records logged afterwards are dropped)
+def shutdown():
+    global _listener, _handler
+
+    with _lock:
+        if _listener is None:
+            return
+
+        logging.getLogger().removeHandler(_handler)
+        _listener.stop()
+        _listener = _handler = None
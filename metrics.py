@@ -0,0 +1,246 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Default histogram buckets in seconds (handler and query latencies)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Escape label value for the Prometheus text format
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Render label names and values as {name="value",...} (empty string without labels)
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+# Render a number the way Prometheus expects it (integers without a fraction)
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    # Setup monotonically increasing value per combination of label values
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # {label values: value}
+
+    # Add amount, label values are passed positionally in the order of the label names
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}" for labels, value in values)
+
+        return lines
+
+
+class Gauge:
+    # Setup value that goes up and down. With a function the value is read from it at scrape time,
+    # so state the server already keeps (sessions, queues) costs nothing on the hot path
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+
+        with self.lock:
+            return self.value
+
+    def render(self):
+        try:
+            value = self.get()
+
+        except Exception as e:
+            logging.getLogger(__name__).error("Error reading gauge %s: %s", self.name, e)
+            return []
+
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {format_value(value)}"]
+
+
+class Histogram:
+    # Setup distribution of observed values per combination of label values (fixed buckets, upper bounds)
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # {label values: [bucket counts (last one is +Inf), sum]}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            state[0][index] += 1
+            state[1] += value
+
+    # Time the calls of a function (used as a decorator, the label values are fixed)
+    def time(self, *label_values):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+
+                finally:
+                    self.observe(time.perf_counter() - start, *label_values)
+
+            return wrapper
+
+        return decorator
+
+    # Get number of observations and their sum
+    def get(self, *label_values):
+        with self.lock:
+            state = self.values.get(label_values)
+            return (sum(state[0]), state[1]) if state else (0, 0.0)
+
+    def render(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else format_value(float(bound))
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (le,))} {cumulative}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+
+        return lines
+
+
+class Registry:
+    # Setup collection of named metrics (a metric registered again under the same name replaces the old one)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # {name: metric}, in registration order
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def get(self, name):
+        with self.lock:
+            return self.metrics.get(name)
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry the server, sessions and database record into
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    # Setup HTTP endpoint serving the registry as Prometheus text on GET /metrics. Bind it to localhost
+    # (the default) or a private interface: the numbers describe the server's users and load
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9100):
+        self.registry = registry
+        self.logger = logging.getLogger(__name__)
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a log line each
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.logger.info("Metrics served on http://%s:%s/metrics", self.httpd.server_address[0], self.port)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.httpd.shutdown()
+            self.thread.join()
+
+        self.httpd.server_close()
@@ -0,0 +1,89 @@
+import heapq
+import logging
+import threading
+import time
+
+
+class PresenceTracker:
+    # Setup presence state of users. publish(user_id, online) pushes a change to the user's watchers,
+    # is_online(user_id) tells if the user has a session right now. Users going offline are announced
+    # only after the grace period, so a reconnect within it (a flap) is never announced at all
+    def __init__(self, publish, is_online, grace=5.0):
+        self.publish = publish
+        self.is_online = is_online
+        self.grace = grace
+        self.logger = logging.getLogger(__name__)
+
+        # Changes are published under the lock, so watchers always see them in order
+        self.condition = threading.Condition()
+        self.announced = set()  # users announced as online
+        self.pending = {}  # {user_id: deadline} users whose offline announcement waits for the grace period
+        self.deadlines = []  # heap of (deadline, user_id), entries no longer in pending are skipped
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, name="presence")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # User got their first session
+    def online(self, user_id):
+        with self.condition:
+            # Back within the grace period: watchers never saw the user leave
+            if self.pending.pop(user_id, None) is not None or user_id in self.announced:
+                return
+
+            self.announced.add(user_id)
+            self.notify(user_id, True)
+
+    # User lost their last session
+    def offline(self, user_id):
+        with self.condition:
+            if self.closed or user_id not in self.announced:
+                return
+
+            deadline = time.monotonic() + self.grace
+            self.pending[user_id] = deadline
+            heapq.heappush(self.deadlines, (deadline, user_id))
+            self.condition.notify()
+
+    def notify(self, user_id, online):
+        try:
+            self.publish(user_id, online)
+
+        except Exception as e:
+            self.logger.error("Error publishing presence of user %s: %s", user_id, e)
+
+    # Announce users whose grace period is over
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+
+                deadline, user_id = self.deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+
+                heapq.heappop(self.deadlines)
+                if self.pending.get(user_id) != deadline:
+                    continue
+
+                del self.pending[user_id]
+
+                # A session that registered without going through online() still counts
+                if self.is_online(user_id):
+                    continue
+
+                self.announced.discard(user_id)
+                self.notify(user_id, False)
+
+    # Stop announcing (on shutdown everybody goes offline at once, nobody is left to tell)
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.thread.join()
@@ -0,0 +1,159 @@
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    # Setup sampling profiler: while running, a background thread snapshots the stacks of all other threads
+    # every interval seconds (sys._current_frames), so the profiled code runs unchanged. Nothing runs while
+    # it is stopped. Threads waiting for I/O or a lock are sampled too, with the waiting call on top
+    FORMATS = ("collapsed", "pstats")
+
+    def __init__(self, directory="profiles", interval=0.01, output_format="collapsed"):
+        if output_format not in self.FORMATS:
+            raise ValueError(f"Unknown profile format {output_format!r}")
+
+        self.directory = directory
+        self.interval = interval
+        self.output_format = output_format
+        self.logger = logging.getLogger(__name__)
+
+        # Reentrant: the signal handler that starts a profile may interrupt the main thread holding the lock
+        self.lock = threading.RLock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def is_running(self):
+        with self.lock:
+            return self.thread is not None
+
+    # Start sampling for the given number of seconds, returns False if a profile is already being taken
+    def start(self, seconds):
+        with self.lock:
+            if self.thread is not None:
+                return False
+
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, args=(seconds,), name="profiler")
+            self.thread.daemon = True
+            self.thread.start()
+
+        return True
+
+    # End the running profile early (it is still written out)
+    def stop(self):
+        self.stop_event.set()
+
+        with self.lock:
+            thread = self.thread
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self, seconds):
+        self.logger.info("Profiling all threads for %s seconds (one sample every %s seconds)", seconds, self.interval)
+
+        try:
+            stacks, samples = self.sample(seconds)
+            path = self.write(stacks, samples)
+            self.logger.info("Profile of %s samples written to %s", samples, path)
+
+        except Exception as e:
+            self.logger.error("Error taking profile: %s", e)
+
+        finally:
+            with self.lock:
+                self.thread = None
+
+    # Collect stacks until the time is up, returns ({stack: count}, number of samples).
+    # A stack is a tuple of (filename, line, function) from the outermost frame to the innermost
+    def sample(self, seconds):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    # co_qualname only exists on Python 3.11+
+                    stack.append((code.co_filename, code.co_firstlineno, getattr(code, "co_qualname", code.co_name)))
+                    frame = frame.f_back
+
+                stacks[tuple(reversed(stack))] += 1
+
+            samples += 1
+            self.stop_event.wait(self.interval)
+
+        return stacks, samples
+
+    # Write profile to a new file in the profile directory, returns its path
+    def write(self, stacks, samples):
+        os.makedirs(self.directory, exist_ok=True)
+        extension = "folded" if self.output_format == "collapsed" else "pstats"
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{extension}")
+
+        if self.output_format == "collapsed":
+            self.write_collapsed(path, stacks)
+        else:
+            self.write_pstats(path, stacks)
+
+        return path
+
+    # One line per distinct stack, "outer;...;inner count" (input of flamegraph.pl, speedscope and others)
+    @staticmethod
+    def write_collapsed(path, stacks):
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                frames = ";".join(f"{os.path.basename(filename)}:{function}" for filename, _, function in stack)
+                f.write(f"{frames} {count}\n")
+
+    # Stats in the format pstats.Stats loads (times are sample counts times the interval). A function's own
+    # time counts the samples it was on top of the stack, its cumulative time the samples it was on the stack
+    def write_pstats(self, path, stacks):
+        stats = {}  # {function: [primitive calls, calls, own time, cumulative time, {caller: [...]}]}
+
+        def entry(table, function):
+            if function not in table:
+                table[function] = [0, 0, 0.0, 0.0, {}] if table is stats else [0, 0, 0.0, 0.0]
+            return table[function]
+
+        for stack, count in stacks.items():
+            seconds = count * self.interval
+            seen = set()
+
+            for depth, function in enumerate(stack):
+                stat = entry(stats, function)
+
+                # Recursive functions are counted once per sample
+                if function not in seen:
+                    seen.add(function)
+                    stat[0] += count
+                    stat[1] += count
+                    stat[3] += seconds
+
+                if depth == len(stack) - 1:
+                    stat[2] += seconds
+
+                if depth:
+                    caller = entry(stat[4], stack[depth - 1])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[3] += seconds
+                    if depth == len(stack) - 1:
+                        caller[2] += seconds
+
+        with open(path, "wb") as f:
+            marshal.dump({
+                function: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                for function, (cc, nc, tt, ct, callers) in stats.items()
+            }, f)
@@ -1,26 +1,208 @@
 import json
+import lzma
 import struct
 import socket
+import time
+import zlib
+
+
+# Packed layout of a hot-path frame: a header with the type code, the byte length of every string field and
+# the int fields (32 bit unsigned), then the UTF-8 strings, then the optional int fields if they are present.
+# Every layout is a precompiled struct, so a frame is encoded and decoded with one pack/unpack call
+class BinarySchema:
+    def __init__(self, type_code, length_flags, strings, ints=(), optional=()):
+        self.type_code = type_code
+        self.length_flags = length_flags
+        self.strings = strings
+        self.ints = ints
+        self.optional = optional
+
+        layout = "H" * len(strings) + "I" * len(ints)
+        self.frame_header = struct.Struct("!IB" + layout) # with the length prefix, for encoding
+        self.header = struct.Struct("!B" + layout)
+        self.optional_ints = struct.Struct("!" + "I" * len(optional))
+
+    # Encode data as a complete frame, returns None if the data does not fit the schema
+    def encode(self, data):
+        required = len(self.strings) + len(self.ints)
+        if len(data) == required:
+            tail = b""
+        elif self.optional and len(data) == required + len(self.optional):
+            tail = None
+        else:
+            return None
+
+        try:
+            encoded = [data[name].encode("utf-8") for name in self.strings]
+            if tail is None:
+                tail = self.optional_ints.pack(*[data[name] for name in self.optional])
+
+            size = self.header.size + sum(map(len, encoded)) + len(tail)
+            header = self.frame_header.pack(
+                size | self.length_flags, self.type_code, *map(len, encoded), *[data[name] for name in self.ints]
+            )
+
+        # Missing field, wrong type or value out of range
+        except (KeyError, AttributeError, struct.error):
+            return None
+
+        return b"".join((header, *encoded, tail))
+
+    # Decode payload (bytes, type code first) into the data dictionary, raises ValueError if it does not fit the schema
+    def decode(self, payload):
+        try:
+            fields = self.header.unpack_from(payload)
+        except struct.error:
+            raise ValueError("Truncated binary frame")
+
+        data = {}
+        offset = self.header.size
+        index = 1
+
+        for name in self.strings:
+            end = offset + fields[index]
+            data[name] = payload[offset:end].decode("utf-8")
+            offset = end
+            index += 1
+
+        for name in self.ints:
+            data[name] = fields[index]
+            index += 1
+
+        remaining = len(payload) - offset
+        if remaining:
+            if not self.optional or remaining != self.optional_ints.size:
+                raise ValueError("Binary frame does not match its schema")
+
+            data.update(zip(self.optional, self.optional_ints.unpack_from(payload, offset)))
+
+        return data
 
 
 class Protocol:
-    # Set maximum file size that user can send at once = 2MB
+    # Set maximum file size that can be sent as a single (non-chunked) frame = 2MB
     MAX_FILE_SIZE = 2048 * 1024
 
+    # Set chunk size for streamed file transfers (no size limit, memory stays bounded)
+    CHUNK_SIZE = 64 * 1024
+
+    # Set how long the server keeps interrupted uploads around for FILE_RESUME (seconds)
+    RESUME_TIMEOUT = 3600
+
+    # Set default and maximum number of messages per history page
+    HISTORY_PAGE_SIZE = 50
+    MAX_HISTORY_PAGE_SIZE = 200
+
+    # Set default and maximum number of names per contact list page
+    CONTACT_PAGE_SIZE = 50
+    MAX_CONTACT_PAGE_SIZE = 200
+
+    # Set default and maximum number of hits per search page
+    SEARCH_PAGE_SIZE = 20
+    MAX_SEARCH_PAGE_SIZE = 100
+
+    # Set maximum number of queued messages sent in one frame after login
+    OFFLINE_BATCH_SIZE = 500
+
+    # Size of the length prefix in front of every frame
+    HEADER_SIZE = 4
+
+    # Set wire codecs. The high bit of the length prefix marks binary frames, so every frame
+    # can be decoded without knowing which codec the connection negotiated
+    CODEC_JSON = "json"
+    CODEC_BINARY = "binary"
+    CODECS = (CODEC_BINARY, CODEC_JSON) # in order of preference
+    BINARY_FLAG = 0x80000000
+    LENGTH_MASK = 0x3FFFFFFF
+    MAX_FRAME_SIZE = 16 * 1024 * 1024 # larger length prefixes are refused (file data never travels inside a frame)
+    JSON_TYPE_PREFIX = b'{"type": "' # JSON frames start with the type (see encode_message)
+
+    # Set compression algorithms (in order of preference) and the id byte in front of a compressed payload.
+    # The second bit of the length prefix marks compressed frames. "zlib" is raw deflate so chunked files can
+    # be flushed at chunk boundaries, "lzma" compresses better but only whole payloads (single-frame files)
+    COMPRESSED_FLAG = 0x40000000
+    FLAGS_MASK = BINARY_FLAG | COMPRESSED_FLAG
+    COMPRESSION_ZLIB = "zlib"
+    COMPRESSION_LZMA = "lzma"
+    COMPRESSIONS = {COMPRESSION_ZLIB: 1, COMPRESSION_LZMA: 2}
+    COMPRESSION_NAMES = {code: name for name, code in COMPRESSIONS.items()}
+
+    # Set size below which frames and files are sent as they are (compression would not pay off)
+    COMPRESS_THRESHOLD = 512
+
+    # Set maximum size a compressed payload may expand to (guards against decompression bombs)
+    MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
     # Set message types to differntiate methods
     MESSAGE_TYPES = {
         "login": "LOGIN",
         "register": "REGISTER",
         "message": "MESSAGE",
         "file": "FILE",
+        "file_chunk": "FILE_CHUNK",
+        "file_ack": "FILE_ACK",
+        "file_resume": "FILE_RESUME",
+        "download": "DOWNLOAD",
+        "history": "HISTORY",
+        "search": "SEARCH",
+        "offline_messages": "OFFLINE_MESSAGES",
         "contact_list": "CONTACT_LIST",
+        "contact_add": "CONTACT_ADD",
+        "presence": "PRESENCE",
+        "batch": "BATCH",
+        "room_create": "ROOM_CREATE",
+        "room_join": "ROOM_JOIN",
+        "room_message": "ROOM_MESSAGE",
         "error": "ERROR",
         "success": "SUCCESS"
     }
 
-    # Encode message into JSON string for future socket transfering
+    # Set one-byte type codes of the binary codec (0 means the type name follows as a string)
+    TYPE_CODES = {
+        "LOGIN": 1,
+        "REGISTER": 2,
+        "MESSAGE": 3,
+        "FILE": 4,
+        "CONTACT_LIST": 5,
+        "ERROR": 6,
+        "SUCCESS": 7,
+        "FILE_CHUNK": 8,
+        "DOWNLOAD": 9,
+        "HISTORY": 10,
+        "OFFLINE_MESSAGES": 11,
+        "BATCH": 12,
+        "ROOM_CREATE": 13,
+        "ROOM_JOIN": 14,
+        "ROOM_MESSAGE": 15,
+        "FILE_ACK": 16,
+        "FILE_RESUME": 17,
+        "SEARCH": 18,
+        "CONTACT_ADD": 19,
+        "PRESENCE": 20
+    }
+    TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+    # Set layouts of hot-path frames, the only ones the binary codec encodes (generic data like HISTORY or
+    # CONTACT_LIST is sent as JSON, Python's C json module beats any pure Python encoding for it).
+    # The high bit of the type code marks schema frames
+    SCHEMA_FLAG = 0x80
+    BINARY_SCHEMAS = {
+        "MESSAGE": BinarySchema(TYPE_CODES["MESSAGE"] | SCHEMA_FLAG, BINARY_FLAG, ("sender", "receiver", "content")),
+        "FILE_CHUNK": BinarySchema(TYPE_CODES["FILE_CHUNK"] | SCHEMA_FLAG, BINARY_FLAG, ("transfer_id",), ("size",), ("offset", "crc32")),
+        "ROOM_MESSAGE": BinarySchema(TYPE_CODES["ROOM_MESSAGE"] | SCHEMA_FLAG, BINARY_FLAG, ("room", "sender", "content"))
+    }
+    SCHEMA_TYPES = {schema.type_code: (message_type, schema) for message_type, schema in BINARY_SCHEMAS.items()}
+
+    # Encode message into JSON string (or binary frame) for future socket transfering. On binary connections
+    # only the schema frames are binary, everything else (and data that does not fit the schema) is JSON
     @staticmethod
-    def encode_message(message_type, data):
+    def encode_message(message_type, data, codec=CODEC_JSON):
+        if codec == Protocol.CODEC_BINARY:
+            schema = Protocol.BINARY_SCHEMAS.get(message_type)
+            frame = schema.encode(data) if schema is not None else None
+            if frame is not None:
+                return frame
+
         message = {
             "type": message_type,
             "data": data
@@ -30,7 +212,7 @@ class Protocol:
         length = struct.pack("!I", len(message_json))
 
         return length + message_json
-    
+
     # Decode message from a socket (from JSON format)
     @staticmethod
     def decode_message(sock, use_timeout=True):
@@ -39,30 +221,221 @@ class Protocol:
                 sock.settimeout(5.0) # Set timeout in case of synchronous calls
             
             # Receive bytes responsible for the incoming message length to set buffer size
-            data_length = sock.recv(4)
+            data_length = Protocol.recv_exact(sock, Protocol.HEADER_SIZE)
 
             if not data_length:
                 return None
             
             # Set buffer size
             length = struct.unpack("!I", data_length)[0]
-            message_data = sock.recv(length) # Fetch exactly needed number of bytes
+            message_data = Protocol.recv_exact(sock, length & Protocol.LENGTH_MASK) # Fetch exactly needed number of bytes
 
-            if not message_data:
+            if message_data is None:
                 return None
             
-            return json.loads(message_data.decode("utf-8"))
+            return Protocol.parse_message(message_data, length & Protocol.FLAGS_MASK)
         
-        except (socket.timeout, socket.error, json.JSONDecodeError) as e:
+        except (socket.timeout, socket.error, ValueError) as e:
             return None
         
         finally:
             if use_timeout:
                 sock.settimeout(None) # Reset timeout
 
-    # Encode file similar to messages
+    # Receive exactly size bytes from a socket (TCP may return less per recv call)
     @staticmethod
-    def encode_file(filename, file_data, receiver=None):
+    def recv_exact(sock, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+
+        while received < size:
+            count = sock.recv_into(view[received:])
+            if not count:
+                return None
+            received += count
+
+        return data
+
+    # Parse frame payload (without the length prefix) into a message dictionary,
+    # flags are the BINARY_FLAG and COMPRESSED_FLAG bits of the length prefix
+    @staticmethod
+    def parse_message(message_data, flags=0):
+        if flags & Protocol.COMPRESSED_FLAG:
+            message_data = Protocol.decompress_payload(message_data)
+
+        if flags & Protocol.BINARY_FLAG:
+            return Protocol.parse_binary_message(message_data)
+
+        return json.loads(str(message_data, "utf-8"))
+
+    # Parse binary payload: a schema frame or a BATCH frame
+    @staticmethod
+    def parse_binary_message(message_data):
+        if not message_data:
+            raise ValueError("Empty binary frame")
+
+        try:
+            schema_type = Protocol.SCHEMA_TYPES.get(message_data[0])
+            if schema_type is not None:
+                # Slicing bytes is much cheaper than slicing a memoryview of the read buffer
+                message_type, schema = schema_type
+                return {"type": message_type, "data": schema.decode(bytes(message_data))}
+
+            if message_data[0] == Protocol.TYPE_CODES["BATCH"]:
+                return Protocol.parse_batch(memoryview(message_data))
+
+        # Callers skip frames raising ValueError, anything else would drop the connection
+        except (struct.error, IndexError, KeyError, TypeError) as e:
+            raise ValueError(f"Malformed binary frame: {e}")
+
+        raise ValueError(f"Unknown binary message type code {message_data[0]}")
+
+    # Parse frames packed into a BATCH frame (complete frames of either codec follow the type code)
+    @staticmethod
+    def parse_batch(view):
+        messages = []
+        offset = 1
+
+        while offset < len(view):
+            if offset + Protocol.HEADER_SIZE > len(view):
+                raise ValueError("Truncated frame in batch")
+
+            length = struct.unpack_from("!I", view, offset)[0]
+            start = offset + Protocol.HEADER_SIZE
+            offset = start + (length & Protocol.LENGTH_MASK)
+            if offset > len(view):
+                raise ValueError("Truncated frame in batch")
+
+            messages.append(Protocol.parse_message(view[start:offset], length & Protocol.FLAGS_MASK))
+
+        return {"type": Protocol.MESSAGE_TYPES["batch"], "data": {"messages": messages}}
+
+    # Create header of a BATCH frame, the batched frames follow it unchanged
+    @staticmethod
+    def create_batch_header(frames_size):
+        return struct.pack("!IB", (frames_size + 1) | Protocol.BINARY_FLAG, Protocol.TYPE_CODES["BATCH"])
+
+    # Check that data is exactly one frame (file data sent right after a header must not be batched)
+    @staticmethod
+    def is_single_frame(data):
+        if len(data) < Protocol.HEADER_SIZE:
+            return False
+
+        return struct.unpack_from("!I", data)[0] & Protocol.LENGTH_MASK == len(data) - Protocol.HEADER_SIZE
+
+    # Peek at the message type of an encoded frame without decoding it (for counting outgoing frames).
+    # Returns None when that would take decoding, e.g. for compressed frames
+    @staticmethod
+    def frame_type(data):
+        if len(data) <= Protocol.HEADER_SIZE:
+            return None
+
+        length = struct.unpack_from("!I", data)[0]
+        if length & Protocol.COMPRESSED_FLAG:
+            return None
+
+        if length & Protocol.BINARY_FLAG:
+            return Protocol.TYPE_NAMES.get(data[Protocol.HEADER_SIZE] & ~Protocol.SCHEMA_FLAG)
+
+        # JSON frames are encoded with the type first
+        start = Protocol.HEADER_SIZE + len(Protocol.JSON_TYPE_PREFIX)
+        if data[Protocol.HEADER_SIZE:start] != Protocol.JSON_TYPE_PREFIX:
+            return None
+
+        end = data.find(b'"', start, start + 32)
+        return bytes(data[start:end]).decode("ascii", "replace") if end != -1 else None
+
+    # Create compressor for the algorithm (zlib streams are raw deflate)
+    @staticmethod
+    def create_compressor(compression):
+        if compression == Protocol.COMPRESSION_LZMA:
+            return lzma.LZMACompressor()
+
+        return zlib.compressobj(6, zlib.DEFLATED, -15)
+
+    # Create decompressor for the algorithm, raises ValueError for unknown algorithms
+    @staticmethod
+    def create_decompressor(compression):
+        if compression == Protocol.COMPRESSION_LZMA:
+            return lzma.LZMADecompressor()
+
+        if compression == Protocol.COMPRESSION_ZLIB:
+            return zlib.decompressobj(-15)
+
+        raise ValueError(f"Unknown compression {compression}")
+
+    # Compress complete data with the algorithm
+    @staticmethod
+    def compress(data, compression):
+        compressor = Protocol.create_compressor(compression)
+
+        return compressor.compress(data) + compressor.flush()
+
+    # Decompress complete data, refusing to expand past MAX_DECOMPRESSED_SIZE
+    @staticmethod
+    def decompress(data, compression):
+        decompressor = Protocol.create_decompressor(compression)
+        try:
+            result = decompressor.decompress(data, Protocol.MAX_DECOMPRESSED_SIZE + 1)
+
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Corrupted {compression} data: {e}")
+
+        if len(result) > Protocol.MAX_DECOMPRESSED_SIZE:
+            raise ValueError("Compressed data expands past the size limit")
+
+        return result
+
+    # Check if data is worth compressing by compressing a sample of it quickly
+    # (already compressed formats such as images and archives are sent as they are)
+    @staticmethod
+    def is_compressible(sample):
+        if len(sample) < Protocol.COMPRESS_THRESHOLD:
+            return False
+
+        return len(zlib.compress(sample[:Protocol.CHUNK_SIZE], 1)) < len(sample[:Protocol.CHUNK_SIZE]) * 0.9
+
+    # Compress a complete frame if it is large enough and shrinks, otherwise return it unchanged.
+    # Frames followed by raw data and frames that are already compressed are left alone
+    @staticmethod
+    def compress_frame(frame, compression=COMPRESSION_ZLIB):
+        if len(frame) < Protocol.HEADER_SIZE + Protocol.COMPRESS_THRESHOLD or not Protocol.is_single_frame(frame):
+            return frame
+
+        header = struct.unpack_from("!I", frame)[0]
+        if header & Protocol.COMPRESSED_FLAG:
+            return frame
+
+        payload = Protocol.compress(memoryview(frame)[Protocol.HEADER_SIZE:], compression)
+        if len(payload) + 1 >= len(frame) - Protocol.HEADER_SIZE:
+            return frame
+
+        flags = (header & Protocol.BINARY_FLAG) | Protocol.COMPRESSED_FLAG
+
+        return struct.pack("!IB", (len(payload) + 1) | flags, Protocol.COMPRESSIONS[compression]) + payload
+
+    # Restore payload of a compressed frame (the algorithm id byte comes first)
+    @staticmethod
+    def decompress_payload(message_data):
+        if not len(message_data):
+            raise ValueError("Empty compressed frame")
+
+        compression = Protocol.COMPRESSION_NAMES.get(message_data[0])
+        if compression is None:
+            raise ValueError(f"Unknown compression id {message_data[0]}")
+
+        return Protocol.decompress(message_data[1:], compression)
+
+    # Pick the compression algorithms of ours that the peer supports
+    @staticmethod
+    def negotiate_compression(peer_compressions):
+        return [compression for compression in Protocol.COMPRESSIONS if compression in (peer_compressions or ())]
+
+    # Encode file similar to messages. With a compression the file data is sent compressed
+    # (if that makes it smaller), the header announces the compressed size next to the file size
+    @staticmethod
+    def encode_file(filename, file_data, receiver=None, compression=None):
         # Check if file size is more than the maximum set size (2MB)
         if len(file_data) > Protocol.MAX_FILE_SIZE:
             raise ValueError("File size exceeds 2MB limit")
@@ -75,6 +448,14 @@ class Protocol:
         if receiver:
             data["receiver"] = receiver
 
+        if compression and Protocol.is_compressible(file_data):
+            compressed = Protocol.compress(file_data, compression)
+
+            if len(compressed) < len(file_data):
+                data["compression"] = compression
+                data["compressed_size"] = len(compressed)
+                file_data = compressed
+
         metadata = Protocol.encode_message(Protocol.MESSAGE_TYPES["file"], data)
 
         return metadata + file_data
@@ -89,26 +470,48 @@ class Protocol:
         
         file_size = message["data"]["file_size"]
         filename = message["data"]["filename"]
-        file_data = b""
-        
-        # Send file data until every "chunk" of data is send
-        while len(file_data) < file_size:
-            chunk = sock.recv(file_size - len(file_data))
-        
-            if not chunk:
-                raise ConnectionError("Incomplete file data received")
-        
-            file_data += chunk
+        compression = message["data"].get("compression")
+
+        # Receive file data until every "chunk" of data is received
+        file_data = Protocol.recv_exact(sock, message["data"]["compressed_size"] if compression else file_size)
+
+        if file_data is None:
+            raise ConnectionError("Incomplete file data received")
+
+        if compression:
+            file_data = Protocol.decompress(file_data, compression)
+
+            if len(file_data) != file_size:
+                raise ValueError("Decompressed file does not match its announced size")
         
         return filename, file_data
 
-    # Create login request (handshake) message
+    # Create login request (handshake) message, codecs lists the wire codecs the client can use,
+    # compressions the compression algorithms it can decode and batch tells the server that the client
+    # unpacks BATCH frames
     @staticmethod
-    def create_login_message(username, password):
-        return Protocol.encode_message(
-            Protocol.MESSAGE_TYPES["login"],
-            {"username": username, "password": password}
-        )
+    def create_login_message(username, password, codecs=None, batch=False, compressions=None):
+        data = {"username": username, "password": password}
+
+        if codecs:
+            data["codecs"] = list(codecs)
+
+        if compressions:
+            data["compressions"] = list(compressions)
+
+        if batch:
+            data["batch"] = True
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["login"], data)
+
+    # Pick the first codec of ours that the peer supports
+    @staticmethod
+    def negotiate_codec(peer_codecs):
+        for codec in Protocol.CODECS:
+            if codec in (peer_codecs or ()):
+                return codec
+
+        return Protocol.CODEC_JSON
 
     # Create register request (handshake) message
     @staticmethod
@@ -118,20 +521,51 @@ class Protocol:
             {"username": username, "password": password}
         )
     
-    # Create contact list request (handshake) message
+    # Create contact list request for one page of names in alphabetical order. after is the next_after of the
+    # previous page, prefix keeps only names starting with it and directory lists all users instead of contacts
+    @staticmethod
+    def create_contact_list_request(prefix=None, after=None, limit=None, directory=False):
+        data = {}
+
+        if prefix:
+            data["prefix"] = prefix
+
+        if after:
+            data["after"] = after
+
+        if limit:
+            data["limit"] = limit
+
+        if directory:
+            data["directory"] = True
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["contact_list"], data)
+
+    # Create presence update: contacts that came online and contacts that went offline
+    # (sent as a snapshot of the online contacts at login, then as deltas)
+    @staticmethod
+    def create_presence_message(online=(), offline=(), codec=CODEC_JSON):
+        return Protocol.encode_message(
+            Protocol.MESSAGE_TYPES["presence"],
+            {"online": list(online), "offline": list(offline)},
+            codec
+        )
+
+    # Create request to add a user to the contact list
     @staticmethod
-    def create_contact_list_request():
+    def create_contact_add_request(username):
         return Protocol.encode_message(
-            Protocol.MESSAGE_TYPES["contact_list"],
-            {}
+            Protocol.MESSAGE_TYPES["contact_add"],
+            {"username": username}
         )
 
     # Create send text message request (handshake) message
     @staticmethod
-    def create_text_message(sender, receiver, content):
+    def create_text_message(sender, receiver, content, codec=CODEC_JSON):
         return Protocol.encode_message(
             Protocol.MESSAGE_TYPES["message"],
-            {"sender": sender, "receiver": receiver, "content": content}
+            {"sender": sender, "receiver": receiver, "content": content},
+            codec
         )
 
     # Create send file message request (handshake) message
@@ -139,6 +573,138 @@ class Protocol:
     def create_file_message(receiver, filename, file_data):
         return Protocol.encode_file(filename, file_data, receiver=receiver)
 
+    # Create file header. With a transfer id the file data follows as FILE_CHUNK frames,
+    # otherwise raw file data follows the header directly. Announcing the SHA-256 of the file makes the server
+    # answer with FILE_ACK first, so the upload can be skipped if it already stores the same content
+    # A header with an offset announces only the data from that offset on (the rest of a partial download).
+    # With a compression the chunks carry zlib data flushed at every chunk boundary (see create_file_chunk)
+    @staticmethod
+    def create_file_header(receiver, filename, file_size, transfer_id=None, sender=None, codec=CODEC_JSON, sha256=None, offset=None, compression=None):
+        data = {
+            "filename": filename,
+            "file_size": file_size,
+            "receiver": receiver
+        }
+
+        if compression:
+            data["compression"] = compression
+
+        if offset:
+            data["offset"] = offset
+
+        if transfer_id:
+            data["transfer_id"] = transfer_id
+
+        if sender:
+            data["sender"] = sender
+
+        if sha256:
+            data["sha256"] = sha256
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["file"], data, codec)
+
+    # Create chunk of a chunked file transfer (frame is followed by the raw chunk bytes).
+    # The offset of the chunk in the file and its CRC32 let the server detect lost or corrupted chunks.
+    # With the transfer's compressor the chunk is compressed and flushed, so every chunk can be decompressed
+    # on its own after a rewind (offset and CRC32 still refer to the uncompressed data)
+    @staticmethod
+    def create_file_chunk(transfer_id, chunk, codec=CODEC_JSON, offset=None, compressor=None):
+        payload = chunk
+        if compressor is not None:
+            payload = compressor.compress(chunk) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+        data = {"transfer_id": transfer_id, "size": len(payload)}
+
+        if offset is not None:
+            data["offset"] = offset
+            data["crc32"] = zlib.crc32(chunk)
+
+        header = Protocol.encode_message(Protocol.MESSAGE_TYPES["file_chunk"], data, codec)
+
+        return header + payload
+
+    # Create upload status of a transfer: offset is the number of bytes the server already has (the sender
+    # continues from there, None if the server does not know the transfer) and exists means the file is complete
+    @staticmethod
+    def create_file_ack(transfer_id, exists, offset=None, codec=CODEC_JSON):
+        return Protocol.encode_message(
+            Protocol.MESSAGE_TYPES["file_ack"],
+            {"transfer_id": transfer_id, "exists": exists, "offset": offset},
+            codec
+        )
+
+    # Create request for the upload status of an interrupted transfer (answered with FILE_ACK)
+    @staticmethod
+    def create_file_resume_request(transfer_id):
+        return Protocol.encode_message(
+            Protocol.MESSAGE_TYPES["file_resume"],
+            {"transfer_id": transfer_id}
+        )
+
+    # Create download request for a stored file (offset skips the part that was already received)
+    @staticmethod
+    def create_download_request(filename, offset=0):
+        data = {"filename": filename}
+
+        if offset:
+            data["offset"] = offset
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["download"], data)
+
+    # Create conversation history request (before_id is the oldest message id already loaded)
+    @staticmethod
+    def create_history_request(with_user, before_id=None, limit=None):
+        data = {"with": with_user}
+
+        if before_id is not None:
+            data["before_id"] = before_id
+
+        if limit:
+            data["limit"] = limit
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["history"], data)
+
+    # Create search request over the user's messages (offset is the next_offset of the previous page)
+    @staticmethod
+    def create_search_request(query, offset=0, limit=None):
+        data = {"query": query}
+
+        if offset:
+            data["offset"] = offset
+
+        if limit:
+            data["limit"] = limit
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["search"], data)
+
+    # Create room create request (the creator becomes its first member)
+    @staticmethod
+    def create_room_create_request(room):
+        return Protocol.encode_message(
+            Protocol.MESSAGE_TYPES["room_create"],
+            {"room": room}
+        )
+
+    # Create room join request
+    @staticmethod
+    def create_room_join_request(room):
+        return Protocol.encode_message(
+            Protocol.MESSAGE_TYPES["room_join"],
+            {"room": room}
+        )
+
+    # Create room message (clients leave the sender out, the server fills it in for the members)
+    @staticmethod
+    def create_room_message(room, content, sender=None, codec=CODEC_JSON):
+        data = {"room": room}
+
+        if sender:
+            data["sender"] = sender
+
+        data["content"] = content
+
+        return Protocol.encode_message(Protocol.MESSAGE_TYPES["room_message"], data, codec)
+
     # Create error message request (handshake) message
     @staticmethod
     def create_error_message(error_message):
@@ -149,8 +715,130 @@ class Protocol:
 
     # Create success message request (handshake) message
     @staticmethod
-    def create_success_message(message):
+    def create_success_message(message, **extra):
         return Protocol.encode_message(
             Protocol.MESSAGE_TYPES["success"],
-            {"message": message}
-        )
\ No newline at end of file
+            {"message": message, **extra}
+        )
+
+
+# Buffered frame reader, one per connection. Reads with recv_into into a reusable buffer,
+# so short reads never split a frame and several pipelined frames are served from one recv
+class FrameReader:
+    # A peer that sends nothing for raw_timeout seconds in the middle of raw data (socket timeouts only wake
+    # the reader up) is given up on
+    def __init__(self, sock, buffer_size=64 * 1024, raw_timeout=60.0):
+        self.sock = sock
+        self.raw_timeout = raw_timeout
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first unread byte
+        self.end = 0 # end of received data
+        self.bytes_received = 0 # total received from the socket (frames and raw data)
+
+    # Number of received bytes that were not consumed yet
+    def buffered(self):
+        return self.end - self.start
+
+    # Make sure at least size bytes are buffered, returns False if the peer closed the connection
+    def fill(self, size):
+        if self.end - self.start >= size:
+            return True
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        # Not enough room left at the end of the buffer, move pending data to the front (or grow)
+        if self.start + size > len(self.buffer):
+            pending = self.end - self.start
+
+            if size > len(self.buffer):
+                buffer = bytearray(max(size, len(self.buffer) * 2))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+
+            self.start, self.end = 0, pending
+
+        while self.end - self.start < size:
+            count = self.sock.recv_into(self.view[self.end:])
+            if not count:
+                return False
+            self.end += count
+            self.bytes_received += count
+
+        return True
+
+    # Return next complete message, None when the connection is closed between frames
+    def read_frame(self):
+        if not self.fill(Protocol.HEADER_SIZE):
+            if self.buffered():
+                raise ConnectionError("Connection closed in the middle of a frame")
+            return None
+
+        length = struct.unpack_from("!I", self.buffer, self.start)[0]
+        flags = length & Protocol.FLAGS_MASK
+        length &= Protocol.LENGTH_MASK
+
+        # Refuse the frame before growing the buffer for it, its payload cannot be skipped safely
+        if length > Protocol.MAX_FRAME_SIZE:
+            raise ConnectionError(f"Frame of {length} bytes exceeds {Protocol.MAX_FRAME_SIZE} bytes")
+
+        if not self.fill(Protocol.HEADER_SIZE + length):
+            raise ConnectionError("Connection closed in the middle of a frame")
+
+        payload_start = self.start + Protocol.HEADER_SIZE
+        self.start = payload_start + length
+
+        # Frame is consumed before parsing so a malformed payload does not break framing
+        return Protocol.parse_message(self.view[payload_start:self.start], flags)
+
+    # Fill the given writable view with raw bytes (e.g. file data following a FILE frame). A socket
+    # timeout does not interrupt it: the bytes received so far only live in the view, so giving up
+    # halfway would leave the rest of the payload to be read as frames. Only raw_timeout seconds
+    # without any data end it (with ConnectionError, the stream cannot be resynchronized)
+    def read_into(self, view):
+        size = len(view)
+
+        # Serve already buffered bytes first, then receive the rest directly into the target
+        received = min(size, self.buffered())
+        view[:received] = self.view[self.start:self.start + received]
+        self.start += received
+        last_data = time.monotonic()
+
+        while received < size:
+            try:
+                count = self.sock.recv_into(view[received:])
+
+            except socket.timeout:
+                if time.monotonic() - last_data >= self.raw_timeout:
+                    raise ConnectionError(f"No data for {self.raw_timeout} seconds in the middle of raw data")
+                continue
+
+            last_data = time.monotonic()
+            if not count:
+                raise ConnectionError("Incomplete data received")
+            received += count
+            self.bytes_received += count
+
+    # Read exactly size raw bytes
+    def read_exact(self, size):
+        data = bytearray(size)
+        self.read_into(memoryview(data))
+
+        return data
+
+    # Read size raw bytes as a sequence of chunks sharing one buffer (each chunk is
+    # only valid until the next one is read)
+    def read_chunks(self, size, chunk_size=Protocol.CHUNK_SIZE):
+        buffer = memoryview(bytearray(min(size, chunk_size)))
+        remaining = size
+
+        while remaining:
+            chunk = buffer[:min(remaining, chunk_size)]
+            self.read_into(chunk)
+            remaining -= len(chunk)
+
+            yield chunk
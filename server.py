@@ -1,24 +1,64 @@
+import signal
 import socket
 import threading
 import time
-from protocols import Protocol
+from protocols import Protocol, FrameReader
 from database import Database
+from sessions import Session, SessionRegistry, ThreadedSession
+from transfers import FileTransfer
+from blobs import BlobStore
+from presence import PresenceTracker
+from metrics import REGISTRY, MetricsServer
+from logs import configure_logging, get_message_logger
+from profiler import SamplingProfiler
 import logging
 import os
+import uuid
+import zlib
+
+
+FRAMES_RECEIVED = REGISTRY.counter("messenger_frames_received_total", "Frames received by message type", ("type",))
+BYTES_RECEIVED = REGISTRY.counter("messenger_bytes_received_total", "Bytes received from clients (frames and file data)")
+HANDLE_SECONDS = REGISTRY.histogram("messenger_handle_seconds", "Time to handle a received frame by message type", ("type",))
+CONNECTIONS = REGISTRY.gauge("messenger_connections", "Open client connections")
+FILE_BYTES_RECEIVED = REGISTRY.counter("messenger_file_bytes_received_total", "File data received in uploads (after decompression)")
+FILE_TRANSFERS = REGISTRY.counter("messenger_file_transfers_total", "Finished file uploads by result", ("result",))
+
 
 class Server:
     # Initialize server class
-    def __init__(self, host='0.0.0.0', port=12345):
+    def __init__(self, host='0.0.0.0', port=12345, max_queue_bytes=4 * 1024 * 1024, overflow_policy=Session.SPILL, flush_window=0.002, presence_grace=5.0, metrics_port=None, metrics_host='127.0.0.1',
+                 profile_seconds=30.0, profile_interval=0.01, profile_format="collapsed"):
         # Setup connection
         self.host = host # listen from all ports
         self.port = port
 
+        # Setup outbound queues (each connection buffers at most max_queue_bytes for a slow receiver)
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
+
+        # Setup coalescing of outgoing frames (seconds a lone frame waits for more frames to share its write)
+        self.flush_window = flush_window
+
         # Setup server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        # Setup clients manager
-        self.clients = {}  # {client_socket: user_id}
+        # Setup clients manager (user id <-> sockets index, thread safe)
+        self.sessions = SessionRegistry()
+
+        # Setup unfinished file transfers
+        self.transfers = {}  # {client_socket: {transfer_id: FileTransfer}}
+        self.suspended_transfers = {}  # {transfer_id: FileTransfer} interrupted uploads waiting for FILE_RESUME
+        self.transfers_lock = threading.Lock()
+
+        # Setup users that missed live room messages (their room cursors stay put until next login)
+        self.room_lagging = set()
+
+        # Setup last room message id sent live to each user, per room (moved into the room cursors once
+        # the user's last session is gone)
+        self.room_cursors = {}  # {user_id: {room_id: message id}}
+        self.room_cursors_lock = threading.Lock()
 
         # Setup running state
         self.running = True
@@ -26,15 +66,32 @@ class Server:
         # Setup database
         self.database = Database()
 
-        # Setup thread locks (prevent race condition)
-        self.lock = threading.Lock()
-
-        # Setup logger
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+        # Setup logger (per-frame events go to the sampled message logger at DEBUG)
+        configure_logging()
         self.logger = logging.getLogger(__name__)
+        self.message_logger = get_message_logger(__name__)
 
-        # Setup folder for receiving files
+        # Setup folder for receiving files (file data is stored once per content, see BlobStore)
         os.makedirs('files', exist_ok=True)
+        self.blobs = BlobStore('files')
+
+        # Setup presence updates (going offline is announced after presence_grace seconds, quick reconnects never are)
+        self.presence = PresenceTracker(self.publish_presence, self.sessions.is_online, presence_grace)
+
+        # Setup metrics (state the server already keeps is read at scrape time). With a metrics_port
+        # they are served as Prometheus text on http://metrics_host:metrics_port/metrics
+        REGISTRY.gauge("messenger_sessions", "Logged in connections", lambda: len(self.sessions))
+        REGISTRY.gauge("messenger_online_users", "Users with at least one logged in connection", lambda: len(self.sessions.get_online_users()))
+        REGISTRY.gauge("messenger_send_queue_bytes", "Bytes waiting in the outbound queues of logged in connections", lambda: sum(self.queue_sizes()))
+        REGISTRY.gauge("messenger_send_queue_max_bytes", "Bytes waiting in the fullest outbound queue", lambda: max(self.queue_sizes(), default=0))
+        REGISTRY.gauge("messenger_file_transfers_active", "Uploads in flight", self.active_transfers)
+        REGISTRY.gauge("messenger_file_transfers_suspended", "Interrupted uploads waiting to be resumed", lambda: len(self.suspended_transfers))
+        self.metrics_server = MetricsServer(REGISTRY, metrics_host, metrics_port) if metrics_port is not None else None
+
+        # Setup on-demand profiling: SIGUSR1 (kill -USR1 <pid>) samples all threads for profile_seconds and
+        # writes collapsed stacks or a pstats file to profiles/. Nothing runs until it is triggered
+        self.profile_seconds = profile_seconds
+        self.profiler = SamplingProfiler("profiles", profile_interval, profile_format)
         
 
     # Start server
@@ -43,7 +100,9 @@ class Server:
             # Bind server to given host and port | Listen to all incoming requests
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen()
-            self.logger.info(f"Server started on {self.host}:{self.port}")
+            self.logger.info("Server started on %s:%s", self.host, self.port)
+            self.start_metrics()
+            self.install_profile_signal()
 
             while self.running:
                 self.server_socket.settimeout(1.0)  # Allow periodic check for shutdown
@@ -51,10 +110,13 @@ class Server:
                 try:
                     # Accept incoming client requests and fetch client data
                     client_socket, addr = self.server_socket.accept()
-                    self.logger.info(f"New connection from {addr}")
+                    self.logger.info("New connection from %s", addr)
+
+                    # Outgoing frames are written by the session's own writer thread
+                    session = ThreadedSession(client_socket, self.max_queue_bytes, self.overflow_policy, self.flush_window)
 
                     # Create and start client thread
-                    client_thread = threading.Thread(target=self.handle_client, args=(client_socket, addr))
+                    client_thread = threading.Thread(target=self.handle_client, args=(session, addr))
                     client_thread.daemon = True
                     client_thread.start()
 
@@ -62,10 +124,10 @@ class Server:
                     continue
 
                 except Exception as e:
-                    self.logger.error(f"Error accepting connection: {e}")
+                    self.logger.error("Error accepting connection: %s", e)
 
         except Exception as e:
-            self.logger.error(f"Server error: {e}")
+            self.logger.error("Server error: %s", e)
 
         finally:
             self.stop()
@@ -74,127 +136,462 @@ class Server:
     def stop(self):
         # Set running state to False
         self.running = False
+        self.presence.close()
 
-        with self.lock:
-            for client_socket in self.clients:
-                try:
-                    client_socket.close() # close client socket
+        # Room messages seen live count as delivered for everyone still online
+        self.advance_room_cursors(self.sessions.get_online_users())
 
-                except Exception as e:
-                    self.logger.error(f"Error closing client socket: {e}")
+        for client_socket in self.sessions.clear():
+            try:
+                client_socket.close() # close client socket
 
-            self.clients.clear() # clear client handler
+            except Exception as e:
+                self.logger.error("Error closing client socket: %s", e)
+
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+        self.profiler.stop()
 
         # Close server socket
         self.server_socket.close()
         self.database.close()
         self.logger.info("Server stopped")
 
-    def process_file_message(self, client_socket, message):
-        try:
-            sender_id = self.clients.get(client_socket)
-            if not sender_id:
-                client_socket.send(Protocol.create_error_message("Not authenticated"))
-                return
+    # Serve metrics over HTTP if a port was configured
+    def start_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.start()
+
+    # Profile the running server for the configured number of seconds (from SIGUSR1 or an admin tool),
+    # returns False if a profile is already being taken
+    def start_profiling(self, seconds=None):
+        started = self.profiler.start(seconds or self.profile_seconds)
+        if not started:
+            self.logger.warning("Profile already being taken, ignoring request")
 
+        return started
+
+    # Let SIGUSR1 start a profile (signals can only be handled by the main thread, on Unix)
+    def install_profile_signal(self):
+        if not hasattr(signal, "SIGUSR1") or threading.current_thread() is not threading.main_thread():
+            self.logger.debug("Profiling signal not available, use start_profiling()")
+            return
+
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.start_profiling())
+
+    # Get sizes of the outbound queues of logged in connections
+    def queue_sizes(self):
+        return [sock.queue_size() for sock in self.sessions.get_online_sockets()]
+
+    # Get number of uploads in flight
+    def active_transfers(self):
+        with self.transfers_lock:
+            return sum(len(transfers) for transfers in self.transfers.values())
+
+    # Count handled frame and its handling time (type names the protocol does not know share one label)
+    def record_frame(self, message_type, seconds):
+        label = message_type if message_type in Protocol.TYPE_CODES else "UNKNOWN"
+        FRAMES_RECEIVED.inc(label)
+        HANDLE_SECONDS.observe(seconds, label)
+
+    # File message handling logic (chunked transfers start here, single-frame files are relayed in chunks)
+    def process_file_message(self, client_socket, message, reader):
+        try:
             # Extract metadata
             data = message["data"]
             filename = data.get("filename")
             file_size = data.get("file_size")
-            receiver = data.get("receiver")
 
             if not filename or not file_size:
-                client_socket.send(Protocol.create_error_message("Invalid file metadata"))
+                client_socket.sendall(Protocol.create_error_message("Invalid file metadata"))
                 return
 
-            # Read file data directly from the socket
-            file_data = b""
-            while len(file_data) < file_size:
-                chunk = client_socket.recv(file_size - len(file_data))
-                if not chunk:
-                    self.logger.error(f"Incomplete file data received from {client_socket.getpeername()}")
-                    client_socket.send(Protocol.create_error_message("Incomplete file data"))
-                    return
-                file_data += chunk
-
-            receiver_id = self.database.get_user_id(receiver) if receiver else None
-            if not receiver_id:
-                client_socket.send(Protocol.create_error_message(f"User {receiver} not found"))
+            if data.get("transfer_id"):
+                # File data follows as FILE_CHUNK frames
+                self.start_file_transfer(client_socket, data)
                 return
 
-            # Save file
-            file_path = os.path.join('files', filename)
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+            # Without the payload size the next frame can not be found, so the connection is dropped
+            payload_size = data.get("compressed_size") if data.get("compression") else file_size
+            if not isinstance(payload_size, int) or payload_size < 0:
+                raise ConnectionError("File payload size unknown")
+
+            # Read file data from the connection's buffered reader one chunk at a time
+            # (the data follows the header anyway, so there is no hash-announce handshake).
+            # Compressed data is decompressed as a stream while it arrives
+            try:
+                transfer_id = self.start_file_transfer(client_socket, dict(data, transfer_id=uuid.uuid4().hex), handshake=False)
+
+            except Exception as e:
+                # Payload is still read below (and dropped) to keep the stream in sync
+                self.logger.error("Error starting file transfer from %s: %s", client_socket.getpeername(), e)
+                client_socket.sendall(Protocol.create_error_message(f"Error processing file: {e}"))
+                transfer_id = None
+
+            try:
+                for chunk in reader.read_chunks(payload_size):
+                    if transfer_id:
+                        self.process_file_chunk(client_socket, transfer_id, chunk)
 
-            self.database.store_file(sender_id, receiver_id, filename)
+            except ConnectionError:
+                self.logger.error("Incomplete file data received from %s", client_socket.getpeername())
+                return
 
-            # Forward file to receiver
-            for sock, uid in self.clients.items():
-                if uid == receiver_id:
-                    sock.send(Protocol.create_file_message(
-                        receiver, filename, file_data
-                    ))
+        except ConnectionError:
+            raise
 
         except Exception as e:
-            self.logger.error(f"Error processing file message from {client_socket.getpeername()}: {e}")
-            client_socket.send(Protocol.create_error_message(f"Error processing file: {e}"))
+            self.logger.error("Error processing file message from %s: %s", client_socket.getpeername(), e)
+            client_socket.sendall(Protocol.create_error_message(f"Error processing file: {e}"))
+
+    # Open incoming file transfer and announce it to the receiver, returns transfer id on success.
+    # If the sender announced the SHA-256 of a file that is already stored, the stored copy is delivered
+    # instead and the sender is told to skip the upload
+    def start_file_transfer(self, client_socket, data, handshake=True):
+        sender_id = self.sessions.get_user_id(client_socket)
+        if not sender_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return None
+
+        receiver = data.get("receiver")
+        receiver_id = self.database.get_user_id(receiver) if receiver else None
+        if not receiver_id:
+            client_socket.sendall(Protocol.create_error_message(f"User {receiver} not found"))
+            return None
+
+        digest = data.get("sha256") if handshake else None
+        codec = self.sessions.get_codec(client_socket)
+
+        # Upload is skipped only for content the sender already sent or received
+        if digest and self.blobs.size(digest) == data["file_size"] and self.database.has_blob(sender_id, digest):
+            self.deliver_stored_blob(sender_id, receiver_id, os.path.basename(data["filename"]), digest, data["file_size"])
+            client_socket.sendall(Protocol.create_file_ack(data["transfer_id"], True, data["file_size"], codec))
+            return None
+
+        transfer = FileTransfer(
+            data["transfer_id"], sender_id, receiver_id, data["filename"], data["file_size"],
+            self.sessions.get_sockets(receiver_id), self.blobs, data.get("sha256"), data.get("compression")
+        )
+        transfer.resumable = handshake
+
+        with self.transfers_lock:
+            self.transfers.setdefault(client_socket, {})[transfer.transfer_id] = transfer
+
+        if digest:
+            client_socket.sendall(Protocol.create_file_ack(transfer.transfer_id, False, 0, codec))
+
+        # Receiver gets the header right away so chunks can be relayed while the upload is in flight
+        sender = self.database.get_username(sender_id)
+        self.relay_file_frame(transfer, lambda codec: Protocol.create_file_header(
+            receiver, transfer.filename, transfer.file_size, transfer.transfer_id, sender=sender, codec=codec
+        ))
+
+        return transfer.transfer_id
+
+    # Record a new file that reuses an already stored blob and send it to the receiver's online sessions
+    def deliver_stored_blob(self, sender_id, receiver_id, filename, digest, file_size):
+        delivered = self.send_stored_blob(self.sessions.get_sockets(receiver_id), sender_id, receiver_id, filename, digest, file_size)
+        self.database.store_file(sender_id, receiver_id, filename, delivered=delivered, blob_hash=digest, file_size=file_size)
+        self.logger.info("File %s already stored as %s, upload skipped", filename, digest)
+
+    # Send stored blob as a whole file to the given sessions, returns True if any of them got it queued
+    def send_stored_blob(self, sockets, sender_id, receiver_id, filename, digest, file_size):
+        receiver = self.database.get_username(receiver_id)
+        sender = self.database.get_username(sender_id)
+        delivered = False
+
+        for sock in sockets:
+            file = open(self.blobs.path(digest), 'rb')
+            try:
+                # Queued without waiting (the writer closes the file), so a slow receiver does not hold up the sender
+                sock.sendfile(file, Protocol.create_file_header(
+                    receiver, filename, file_size, sender=sender, codec=self.sessions.get_codec(sock)
+                ), wait=False)
+                delivered = True
+
+            except OSError as e:
+                file.close()
+                self.logger.error("Error sending stored file %s to %s: %s", filename, sock.getpeername(), e)
+
+        return delivered
+
+    # Write received chunk to disk and relay it to the receiver. Chunks sent with their offset and CRC32 are
+    # checked: a corrupted chunk makes the server ask the sender to continue from the last good offset
+    def process_file_chunk(self, client_socket, transfer_id, chunk, offset=None, crc32=None):
+        with self.transfers_lock:
+            transfer = self.transfers.get(client_socket, {}).get(transfer_id)
+
+        if transfer is None:
+            self.logger.debug("Dropping chunk of unknown transfer %s", transfer_id)
+            return
+
+        start = transfer.received
+
+        if offset is not None and offset != start:
+            # Chunk the sender wrote before it was asked to go back, the resent data follows
+            self.logger.debug("Dropping chunk at offset %s of transfer %s (expected %s)", offset, transfer_id, start)
+            return
+
+        try:
+            chunk = transfer.decompress(chunk)
+            error = None if crc32 is None or zlib.crc32(chunk) == crc32 else ValueError("checksum mismatch")
+
+        except ValueError as e:
+            error = e
+
+        if error is not None and crc32 is not None:
+            self.logger.warning("Corrupted chunk at offset %s of transfer %s: %s", offset, transfer_id, error)
+            transfer.reset_decompressor()
+            client_socket.sendall(Protocol.create_file_ack(transfer_id, False, start, self.sessions.get_codec(client_socket)))
+            return
+
+        try:
+            if error is not None:
+                raise error
+
+            transfer.write(chunk)
+            FILE_BYTES_RECEIVED.inc(amount=len(chunk))
+
+        except Exception as e:
+            self.logger.error("Error writing chunk of transfer %s: %s", transfer_id, e)
+            self.discard_transfer(client_socket, transfer_id)
+            transfer.abort()
+            FILE_TRANSFERS.inc("failed")
+            client_socket.sendall(Protocol.create_error_message(f"Error processing file: {e}"))
+            return
+
+        self.relay_file_frame(transfer, lambda codec: Protocol.create_file_chunk(transfer_id, chunk, codec, start))
+
+        if transfer.is_complete():
+            self.discard_transfer(client_socket, transfer_id)
+
+            try:
+                digest = transfer.finish()
+
+            except ValueError as e:
+                self.logger.error("Error finishing transfer %s: %s", transfer_id, e)
+                FILE_TRANSFERS.inc("failed")
+                client_socket.sendall(Protocol.create_error_message(f"Error processing file: {e}"))
+                return
+
+            FILE_TRANSFERS.inc("completed")
+
+            # Receiver sessions that fell behind and are still connected get the whole stored file instead
+            lagging = [sock for sock in transfer.lagging if self.sessions.get_user_id(sock) == transfer.receiver_id]
+            delivered = self.send_stored_blob(
+                lagging, transfer.sender_id, transfer.receiver_id, transfer.filename, digest, transfer.file_size
+            ) or bool(transfer.receivers)
+
+            self.database.store_file(
+                transfer.sender_id, transfer.receiver_id, transfer.filename, delivered=delivered,
+                blob_hash=digest, file_size=transfer.file_size
+            )
+
+            # Senders that track offsets wait for the server to confirm the whole file arrived
+            if offset is not None:
+                client_socket.sendall(Protocol.create_file_ack(
+                    transfer_id, True, transfer.file_size, self.sessions.get_codec(client_socket)
+                ))
+
+    # Send frame to every receiver session of the transfer, dropping the ones that went away or fell behind
+    # (create_frame builds the frame for a codec, each codec is encoded once)
+    def relay_file_frame(self, transfer, create_frame):
+        frames = {}
+
+        for sock in list(transfer.receivers):
+            codec = self.sessions.get_codec(sock)
+            if codec not in frames:
+                frames[codec] = create_frame(codec)
+
+            try:
+                # Never wait for a slow receiver, it gets the stored file later instead
+                if not sock.offer(frames[codec]):
+                    self.logger.warning("Receiver %s fell behind transfer %s", sock.getpeername(), transfer.transfer_id)
+                    transfer.receivers.remove(sock)
+                    transfer.lagging.append(sock)
+
+            except OSError as e:
+                self.logger.error("Error relaying transfer %s: %s", transfer.transfer_id, e)
+                transfer.receivers.remove(sock)
+
+    # Forget transfer of the given socket
+    def discard_transfer(self, client_socket, transfer_id):
+        with self.transfers_lock:
+            socket_transfers = self.transfers.get(client_socket, {})
+            socket_transfers.pop(transfer_id, None)
+
+            if not socket_transfers:
+                self.transfers.pop(client_socket, None)
+
+    # Keep unfinished transfers of a disconnected socket so the sender can resume them
+    def suspend_transfers(self, client_socket):
+        with self.transfers_lock:
+            socket_transfers = self.transfers.pop(client_socket, {})
+
+            for transfer in socket_transfers.values():
+                if transfer.resumable:
+                    self.logger.info("Suspending unfinished transfer %s at %s bytes", transfer.transfer_id, transfer.received)
+                    transfer.suspend()
+                    self.suspended_transfers[transfer.transfer_id] = transfer
+
+        for transfer in socket_transfers.values():
+            if not transfer.resumable:
+                self.logger.info("Aborting unfinished transfer %s", transfer.transfer_id)
+                transfer.abort()
+
+        self.purge_suspended_transfers()
+
+    # Abort suspended transfers that were not resumed in time
+    def purge_suspended_transfers(self):
+        with self.transfers_lock:
+            expired = [
+                transfer for transfer in self.suspended_transfers.values()
+                if transfer.is_expired(Protocol.RESUME_TIMEOUT)
+            ]
+            for transfer in expired:
+                del self.suspended_transfers[transfer.transfer_id]
+
+        for transfer in expired:
+            self.logger.info("Aborting expired transfer %s", transfer.transfer_id)
+            transfer.abort()
+
+    # Transfer resume handling logic (answers with the offset the sender continues from, None if unknown)
+    def handle_file_resume(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        self.purge_suspended_transfers()
+        transfer_id = data.get("transfer_id")
+        codec = self.sessions.get_codec(client_socket)
+
+        with self.transfers_lock:
+            transfer = self.suspended_transfers.get(transfer_id)
+
+            if transfer is not None and transfer.sender_id == user_id:
+                del self.suspended_transfers[transfer_id]
+                transfer.resume()
+                self.transfers.setdefault(client_socket, {})[transfer_id] = transfer
+            else:
+                transfer = None
+
+        if transfer is None:
+            client_socket.sendall(Protocol.create_file_ack(transfer_id, False, None, codec))
+            return
+
+        self.logger.info("Resuming transfer %s at %s bytes", transfer_id, transfer.received)
+        client_socket.sendall(Protocol.create_file_ack(transfer_id, False, transfer.received, codec))
 
     # Client handling logic
     def handle_client(self, client_socket, addr):
+        # Buffered reader keeps partially received frames between timeouts
+        reader = FrameReader(client_socket.sock)
+        client_socket.sock.settimeout(10.0)
+        CONNECTIONS.inc()
+        counted = 0  # bytes received that were already counted
+
         try:
             while self.running:
-                client_socket.settimeout(10.0)
                 try:
-                    message = Protocol.decode_message(client_socket, use_timeout=True)
+                    message = reader.read_frame()
                     if message is None:
-                        try:
-                            data = client_socket.recv(1, socket.MSG_PEEK)
-                            if not data:
-                                self.logger.info(f"Client {addr} disconnected (socket closed)")
-                                break
-                            else:
-                                self.logger.debug(f"Client {addr} still connected, received empty message")
-                                continue
-                        except socket.error as e:
-                            self.logger.info(f"Client {addr} disconnected (socket error: {e})")
-                            break
-
-                    self.logger.info(f"Processing message from {addr}: {message['type']}")
+                        self.logger.info("Client %s disconnected (socket closed)", addr)
+                        break
+
+                    self.message_logger.debug("Processing message from %s: %s", addr, message["type"])
+                    start = time.perf_counter()
                     if message["type"] == Protocol.MESSAGE_TYPES["file"]:
-                        # For file messages, pass the socket to handle_file to read the file data
-                        self.process_file_message(client_socket, message)
+                        # For file messages, pass the reader on to read the file data
+                        self.process_file_message(client_socket, message, reader)
+                    elif message["type"] == Protocol.MESSAGE_TYPES["file_chunk"]:
+                        data = message["data"]
+                        chunk = reader.read_exact(data["size"])
+                        self.process_file_chunk(client_socket, data["transfer_id"], chunk, data.get("offset"), data.get("crc32"))
                     else:
                         self.process_message(client_socket, message)
 
+                    self.record_frame(message["type"], time.perf_counter() - start)
+                    BYTES_RECEIVED.inc(amount=reader.bytes_received - counted)
+                    counted = reader.bytes_received
+
                 except socket.timeout:
-                    self.logger.debug(f"Client {addr} socket timeout, continuing to wait")
+                    self.logger.debug("Client %s socket timeout, continuing to wait", addr)
+                    continue
+                except ValueError as e:
+                    # Malformed frame was consumed as a whole, so the stream is still in sync
+                    self.logger.error("Invalid message from %s: %s", addr, e)
                     continue
-                except Exception as e:
-                    self.logger.error(f"Error processing message from {addr}: {e}")
-                    try:
-                        client_socket.recv(1, socket.MSG_PEEK)
-                        self.logger.debug(f"Client {addr} socket still open, continuing")
-                        continue
-                    except socket.error:
-                        self.logger.info(f"Client {addr} disconnected (socket error after exception: {e})")
-                        break
 
         except Exception as e:
-            self.logger.error(f"Error in handle_client {addr}: {e}")
+            self.logger.error("Error in handle_client %s: %s", addr, e)
         finally:
+            CONNECTIONS.dec()
             self.remove_client(client_socket)
             try:
                 client_socket.close()
             except Exception as e:
-                self.logger.error(f"Error closing client socket {addr}: {e}")
+                self.logger.error("Error closing client socket %s: %s", addr, e)
 
     # Remove (kick) client logic and close its connection
     def remove_client(self, client_socket):
-        with self.lock:
-            if client_socket in self.clients:
-                self.logger.info(f"Removing client {client_socket.getpeername()}")
-                del self.clients[client_socket]
+        self.suspend_transfers(client_socket)
+
+        user_id = self.sessions.remove(client_socket)
+        if user_id is not None:
+            self.logger.info("Removing client %s", client_socket.getpeername())
+
+            # Room messages seen live count as delivered once the user's last session is gone
+            # (on shutdown stop() does it for everyone at once)
+            if self.running and not self.sessions.is_online(user_id):
+                self.advance_room_cursors([user_id])
+                self.presence.offline(user_id)
+
+    # Push presence change of a user to the online sessions of everyone who has them as a contact
+    def publish_presence(self, user_id, online):
+        username = self.database.get_username(user_id)
+        frames = {}
+
+        for watcher_id in self.database.get_watcher_ids(user_id):
+            for sock in self.sessions.get_sockets(watcher_id):
+                codec = self.sessions.get_codec(sock)
+                if codec not in frames:
+                    frames[codec] = Protocol.create_presence_message([username] if online else (), () if online else [username], codec)
+
+                try:
+                    sock.send(frames[codec])
+
+                except OSError as e:
+                    self.logger.error("Error sending presence to %s: %s", sock.getpeername(), e)
+
+    # Send the user's contacts that are online right now, if any (changes follow as deltas)
+    def send_presence_snapshot(self, client_socket, user_id):
+        online = [
+            self.database.get_username(contact_id)
+            for contact_id in self.database.get_contact_ids(user_id)
+            if self.sessions.is_online(contact_id)
+        ]
+
+        if online:
+            client_socket.sendall(Protocol.create_presence_message(online, codec=self.sessions.get_codec(client_socket)))
+
+    # Move room cursors of users that saw every room message live past the last room message sent to them
+    # (messages stored after that stay queued for their next login)
+    def advance_room_cursors(self, user_ids):
+        for user_id in user_ids:
+            with self.room_cursors_lock:
+                cursors = self.room_cursors.pop(user_id, None)
+
+            if cursors and user_id not in self.room_lagging:
+                self.database.mark_room_messages_delivered(user_id, cursors)
+
+    # Remember room message as sent live to the user
+    def record_room_cursor(self, user_id, room_id, message_id):
+        with self.room_cursors_lock:
+            cursors = self.room_cursors.setdefault(user_id, {})
+            cursors[room_id] = max(cursors.get(room_id, 0), message_id)
 
     # Handle incoming message (message type, sender/receiver information, etc.)
     def process_message(self, client_socket, message):
@@ -209,13 +606,41 @@ class Server:
             elif msg_type == Protocol.MESSAGE_TYPES["message"]:
                 self.handle_message(client_socket, data)
             elif msg_type == Protocol.MESSAGE_TYPES["contact_list"]:
-                self.handle_contact_list(client_socket)
+                self.handle_contact_list(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["contact_add"]:
+                self.handle_contact_add(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["download"]:
+                self.handle_download(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["file_resume"]:
+                self.handle_file_resume(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["history"]:
+                self.handle_history(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["search"]:
+                self.handle_search(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["room_create"]:
+                self.handle_room_create(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["room_join"]:
+                self.handle_room_join(client_socket, data)
+            elif msg_type == Protocol.MESSAGE_TYPES["room_message"]:
+                self.handle_room_message(client_socket, data)
             else:
-                client_socket.send(Protocol.create_error_message("Unknown message type"))
+                client_socket.sendall(Protocol.create_error_message("Unknown message type"))
+
+        except ConnectionError:
+            # Requesting connection is gone (e.g. dropped for not reading its replies), stop reading from it
+            raise
 
         except Exception as e:
-            self.logger.error(f"Error in process_message for {client_socket.getpeername()}: {e}")
+            self.logger.error("Error in process_message for %s: %s", client_socket.getpeername(), e)
     
+    # Compress frame sent to many sessions once up front (sessions leave compressed frames alone)
+    def fan_out_frame(self, frame, compression):
+        return Protocol.compress_frame(frame, compression) if compression else frame
+
+    # Encode message with the codec the socket negotiated at login
+    def encode_for(self, client_socket, message_type, data):
+        return Protocol.encode_message(message_type, data, self.sessions.get_codec(client_socket))
+
     # User login handling logic
     def handle_login(self, client_socket, data):
         # Fetch user information from the frontend form
@@ -226,15 +651,37 @@ class Server:
         user_id = self.database.authenticate_user(username, password)
 
         if user_id:
-            with self.lock:
-                # Set client to client handler dictionary
-                self.clients[client_socket] = user_id
+            # Register socket as one of the user's sessions, using the best codec both sides support
+            codec = Protocol.negotiate_codec(data.get("codecs"))
+            first_session = not self.sessions.is_online(user_id)
+            self.sessions.add(client_socket, user_id, codec)
 
-            client_socket.send(Protocol.create_success_message(f"User {username} logged in"))
-            self.logger.info(f"User {username} logged in from {client_socket.getpeername()}")
+            compressions = Protocol.negotiate_compression(data.get("compressions"))
+
+            client_socket.sendall(Protocol.create_success_message(
+                f"User {username} logged in", codec=codec, compressions=compressions
+            ))
+            self.logger.info("User %s logged in from %s", username, client_socket.getpeername())
+
+            # Frames after the login reply may be packed into BATCH frames if the client unpacks them
+            if data.get("batch"):
+                client_socket.enable_batching()
+
+            # Large frames after the login reply are compressed if the client decodes zlib
+            if Protocol.COMPRESSION_ZLIB in compressions:
+                client_socket.enable_compression(Protocol.COMPRESSION_ZLIB)
+
+            self.flush_offline_queue(client_socket, user_id)
+
+            # Other sessions of the user already see room messages live
+            if first_session:
+                self.flush_room_queue(client_socket, user_id)
+
+            self.send_presence_snapshot(client_socket, user_id)
+            self.presence.online(user_id)
 
         else:
-            client_socket.send(Protocol.create_error_message("Invalid username or password"))
+            client_socket.sendall(Protocol.create_error_message("Invalid username or password"))
 
     # User register handling logic
     def handle_register(self, client_socket, data):
@@ -244,18 +691,97 @@ class Server:
 
         # Call database method and check if user was added successfully
         if self.database.add_user(username, password):
-            client_socket.send(Protocol.create_success_message(f"User {username} registered"))
-            self.logger.info(f"User {username} registered from {client_socket.getpeername()}")
+            client_socket.sendall(Protocol.create_success_message(f"User {username} registered"))
+            self.logger.info("User %s registered from %s", username, client_socket.getpeername())
 
         else:
-            client_socket.send(Protocol.create_error_message("Username already exists"))
+            client_socket.sendall(Protocol.create_error_message("Username already exists"))
+
+    # Deliver messages and files stored while the user was offline, then mark them delivered at once
+    def flush_offline_queue(self, client_socket, user_id):
+        # Rows still sitting in the write-behind queue must be visible first
+        self.database.flush()
+
+        rows = self.database.get_undelivered_messages(user_id)
+        files = self.database.get_undelivered_files(user_id)
+
+        if not rows and not files:
+            return
+
+        # Send queued messages in a few large frames instead of one frame per message
+        for start in range(0, len(rows), Protocol.OFFLINE_BATCH_SIZE):
+            messages = [
+                {
+                    "id": message_id,
+                    "sender": self.database.get_username(sender_id),
+                    "receiver": self.database.get_username(receiver_id),
+                    "content": content,
+                    "timestamp": timestamp
+                }
+                for message_id, sender_id, receiver_id, content, timestamp in rows[start:start + Protocol.OFFLINE_BATCH_SIZE]
+            ]
+
+            client_socket.sendall(self.encode_for(
+                client_socket,
+                Protocol.MESSAGE_TYPES["offline_messages"],
+                {"messages": messages}
+            ))
+
+        for _, sender_id, receiver_id, filename, blob_hash in files:
+            file_path = self.stored_file_path(filename, blob_hash)
+
+            if not os.path.exists(file_path):
+                self.logger.warning("Queued file %s is missing, skipping", filename)
+                continue
+
+            self.send_stored_file(
+                client_socket, file_path, filename,
+                self.database.get_username(receiver_id), self.database.get_username(sender_id)
+            )
+
+        self.database.mark_delivered([row[0] for row in rows], [row[0] for row in files])
+        self.logger.info("Delivered %s queued messages and %s queued files to user %s", len(rows), len(files), user_id)
+
+    # Deliver room messages past the user's room cursors, then move the cursors past them
+    def flush_room_queue(self, client_socket, user_id):
+        self.room_lagging.discard(user_id)
+        rows = self.database.get_undelivered_room_messages(user_id)
+
+        if not rows:
+            return
+
+        # Room messages go out as offline message batches, each message tagged with its room
+        cursors = {}
+        for start in range(0, len(rows), Protocol.OFFLINE_BATCH_SIZE):
+            messages = [
+                {
+                    "id": message_id,
+                    "room": room,
+                    "sender": self.database.get_username(sender_id),
+                    "content": content,
+                    "timestamp": timestamp
+                }
+                for message_id, _, room, sender_id, content, timestamp in rows[start:start + Protocol.OFFLINE_BATCH_SIZE]
+            ]
+
+            client_socket.sendall(self.encode_for(
+                client_socket,
+                Protocol.MESSAGE_TYPES["offline_messages"],
+                {"messages": messages}
+            ))
+
+        for message_id, room_id, *_ in rows:
+            cursors[room_id] = message_id
+
+        self.database.mark_room_messages_delivered(user_id, cursors)
+        self.logger.info("Delivered %s queued room messages to user %s", len(rows), user_id)
 
     # Message handling logic
     def handle_message(self, client_socket, data):
-        sender_id = self.clients.get(client_socket)
+        sender_id = self.sessions.get_user_id(client_socket)
 
         if not sender_id:
-            client_socket.send(Protocol.create_error_message("Not authenticated"))
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
             return
         
         sender = self.database.get_username(sender_id)
@@ -265,65 +791,298 @@ class Server:
         receiver_id = self.database.get_user_id(receiver)
 
         if receiver_id:
+            # Encode the message once per codec in use by the receiver's sessions
+            # (send only queues the frame, a slow receiver never blocks the sender)
+            delivered = False
+            frames = {}
+            for sock in self.sessions.get_sockets(receiver_id):
+                key = (self.sessions.get_codec(sock), sock.compression)
+                if key not in frames:
+                    frames[key] = self.fan_out_frame(Protocol.create_text_message(sender, receiver, content, key[0]), key[1])
+
+                try:
+                    delivered = sock.send(frames[key]) or delivered
+
+                except OSError as e:
+                    self.logger.error("Error sending message to %s: %s", sock.getpeername(), e)
+
             # Call database method to store message if there is a valid receiver id
-            self.database.store_message(sender_id, receiver_id, content)
+            # (messages for offline users, or spilled by a full outbound queue, stay queued until they log in)
+            self.database.store_message(sender_id, receiver_id, content, delivered=delivered)
+
+        else:
+            client_socket.sendall(Protocol.create_error_message(f"User {receiver} not found"))
+
+    # Room create handling logic
+    def handle_room_create(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        room = data.get("room")
+
+        if not room:
+            client_socket.sendall(Protocol.create_error_message("Invalid room name"))
+            return
 
-            for sock, uid in self.clients.items():
-                if uid == receiver_id:
-                    sock.send(Protocol.create_text_message(sender, receiver, content))
+        if self.database.create_room(room, user_id):
+            client_socket.sendall(Protocol.create_success_message(f"Room {room} created", room=room))
 
         else:
-            client_socket.send(Protocol.create_error_message(f"User {receiver} not found"))
+            client_socket.sendall(Protocol.create_error_message(f"Room {room} already exists"))
 
-    # File handling logic
-    def handle_file(self, client_socket, data):
-        sender_id = self.clients.get(client_socket)
+    # Room join handling logic
+    def handle_room_join(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
 
-        if not sender_id:
-            client_socket.send(Protocol.create_error_message("Not authenticated"))
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
             return
-        
-        filename, file_data = Protocol.decode_file(client_socket)
-        
-        if not filename:
-            client_socket.send(Protocol.create_error_message("Invalid file data"))
+
+        room = data.get("room")
+        room_id = self.database.get_room_id(room)
+
+        if not room_id:
+            client_socket.sendall(Protocol.create_error_message(f"Room {room} not found"))
             return
 
-        receiver = data.get("receiver")
-        receiver_id = self.database.get_user_id(receiver) if receiver else None
-        
-        if receiver_id:
-            # Browse to files
-            file_path = os.path.join('files', filename)
-        
-            # Start writing file to the local file
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-        
-            self.database.store_file(sender_id, receiver_id, filename)
-        
-            for sock, uid in self.clients.items():
-                if uid == receiver_id:
-                    sock.send(Protocol.create_file_message(receiver, filename, file_data))
+        if self.database.join_room(room_id, user_id):
+            client_socket.sendall(Protocol.create_success_message(f"Joined room {room}", room=room))
 
         else:
-            client_socket.send(Protocol.create_error_message(f"User {receiver} not found"))
+            client_socket.sendall(Protocol.create_error_message(f"Failed to join room {room}"))
 
-    def handle_contact_list(self, client_socket):
-        user_id = self.clients.get(client_socket)
+    # Room message handling logic (the frame is encoded once per codec and the message is stored once)
+    def handle_room_message(self, client_socket, data):
+        sender_id = self.sessions.get_user_id(client_socket)
+
+        if not sender_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        room = data.get("room")
+        content = data.get("content")
+        room_id = self.database.get_room_id(room)
+        members = self.database.get_room_members(room_id) if room_id else []
+
+        if sender_id not in members:
+            client_socket.sendall(Protocol.create_error_message(f"You are not a member of room {room}"))
+            return
+
+        sender = self.database.get_username(sender_id)
+        message_id = self.database.next_room_message_id()
+
+        # Write the same bytes to every online session of every member except the sending one
+        frames = {}
+        for member_id in members:
+            delivered = False
+            member_sockets = [sock for sock in self.sessions.get_sockets(member_id) if sock is not client_socket]
+
+            for sock in member_sockets:
+                key = (self.sessions.get_codec(sock), sock.compression)
+                if key not in frames:
+                    frames[key] = self.fan_out_frame(Protocol.create_room_message(room, content, sender, key[0]), key[1])
+
+                try:
+                    delivered = sock.send(frames[key]) or delivered
+
+                except OSError as e:
+                    self.logger.error("Error sending room message to %s: %s", sock.getpeername(), e)
+
+            # Member missed the message live, it comes from the room queue on their next login
+            # (the sender has it already)
+            if delivered or member_id == sender_id:
+                self.record_room_cursor(member_id, room_id, message_id)
+            elif member_sockets:
+                self.room_lagging.add(member_id)
+
+        self.database.store_room_message(room_id, sender_id, content, message_id)
+
+    # Contact list handling logic (one page of contacts, or of all users in directory mode, per request)
+    def handle_contact_list(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
 
         if not user_id:
-            client_socket.send(Protocol.create_error_message("Not authenticated"))
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
             return
+
+        prefix = data.get("prefix") or ""
+        after = data.get("after") or ""
+        directory = bool(data.get("directory"))
+        limit = min(max(int(data.get("limit", Protocol.CONTACT_PAGE_SIZE)), 1), Protocol.MAX_CONTACT_PAGE_SIZE)
+
+        if directory:
+            contacts = self.database.search_users(user_id, prefix, after, limit)
+        else:
+            contacts = self.database.get_contacts(user_id, prefix, after, limit)
         
-        contacts = self.database.get_contacts(user_id)
-        
-        client_socket.send(Protocol.encode_message(
+        client_socket.sendall(self.encode_for(
+            client_socket,
             Protocol.MESSAGE_TYPES["contact_list"],
-            {"contacts": contacts}
+            {
+                "contacts": contacts,
+                "prefix": prefix,
+                "directory": directory,
+                # Cursor of the next page, None when there is nothing left
+                "next_after": contacts[-1] if len(contacts) == limit else None
+            }
         ))
+
+    # Contact add handling logic
+    def handle_contact_add(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        username = data.get("username")
+        contact_id = self.database.get_user_id(username) if username else None
+
+        if not contact_id or contact_id == user_id:
+            client_socket.sendall(Protocol.create_error_message(f"User {username} not found"))
+            return
+
+        if self.database.add_contact(user_id, contact_id):
+            client_socket.sendall(Protocol.create_success_message(f"Contact {username} added", contact=username))
+
+            # The new contact's changes arrive as deltas from now on, start from where they are
+            if self.sessions.is_online(contact_id):
+                client_socket.sendall(Protocol.create_presence_message([username], codec=self.sessions.get_codec(client_socket)))
+
+        else:
+            client_socket.sendall(Protocol.create_error_message(f"Failed to add contact {username}"))
    
 
+    # Conversation history handling logic (one page per request)
+    def handle_history(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        other = data.get("with")
+        other_id = self.database.get_user_id(other) if other else None
+
+        if not other_id:
+            client_socket.sendall(Protocol.create_error_message(f"User {other} not found"))
+            return
+
+        limit = min(max(int(data.get("limit", Protocol.HISTORY_PAGE_SIZE)), 1), Protocol.MAX_HISTORY_PAGE_SIZE)
+        rows = self.database.get_conversation(user_id, other_id, data.get("before_id"), limit)
+
+        messages = [
+            {
+                "id": message_id,
+                "sender": self.database.get_username(sender_id),
+                "receiver": self.database.get_username(receiver_id),
+                "content": content,
+                "timestamp": timestamp
+            }
+            for message_id, sender_id, receiver_id, content, timestamp in rows
+        ]
+
+        client_socket.sendall(self.encode_for(
+            client_socket,
+            Protocol.MESSAGE_TYPES["history"],
+            {
+                "with": other,
+                "messages": messages,
+                # Cursor of the next (older) page, None when there is nothing left
+                "next_before_id": messages[-1]["id"] if len(messages) == limit else None
+            }
+        ))
+
+    # Message search handling logic (one ranked page per request, only the user's own conversations)
+    def handle_search(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        query = data.get("query") or ""
+        offset = max(int(data.get("offset", 0)), 0)
+        limit = min(max(int(data.get("limit", Protocol.SEARCH_PAGE_SIZE)), 1), Protocol.MAX_SEARCH_PAGE_SIZE)
+        rows = self.database.search_messages(user_id, query, offset, limit)
+
+        messages = [
+            {
+                "id": message_id,
+                "sender": self.database.get_username(sender_id),
+                "receiver": self.database.get_username(receiver_id),
+                "content": content,
+                "timestamp": timestamp
+            }
+            for message_id, sender_id, receiver_id, content, timestamp in rows
+        ]
+
+        client_socket.sendall(self.encode_for(
+            client_socket,
+            Protocol.MESSAGE_TYPES["search"],
+            {
+                "query": query,
+                "messages": messages,
+                # Offset of the next page, None when there are no more hits
+                "next_offset": offset + len(messages) if len(messages) == limit else None
+            }
+        ))
+
+    # Stored file download handling logic
+    def handle_download(self, client_socket, data):
+        user_id = self.sessions.get_user_id(client_socket)
+
+        if not user_id:
+            client_socket.sendall(Protocol.create_error_message("Not authenticated"))
+            return
+
+        filename = os.path.basename(data.get("filename", ""))
+        offset = data.get("offset", 0)
+        stored_file = self.database.get_file(user_id, filename) if filename else None
+        file_path = self.stored_file_path(filename, stored_file[4]) if stored_file else None
+
+        if not stored_file or not os.path.exists(file_path):
+            client_socket.sendall(Protocol.create_error_message(f"File {filename} not found"))
+            return
+
+        _, sender_id, receiver_id, _, _ = stored_file
+        self.send_stored_file(
+            client_socket, file_path, filename,
+            self.database.get_username(receiver_id), self.database.get_username(sender_id), offset
+        )
+
+    # Get path of a stored file (files stored before the blob store have no hash and live under their name)
+    def stored_file_path(self, filename, blob_hash):
+        if blob_hash:
+            return self.blobs.path(blob_hash)
+
+        return os.path.join('files', filename)
+
+    # Send stored file: header first, then file data via kernel sendfile so it never passes through Python buffers
+    # (with an offset only the rest of the file from there is sent)
+    def send_stored_file(self, client_socket, file_path, filename, receiver, sender, offset=0):
+        f = open(file_path, 'rb')
+        try:
+            file_size = os.fstat(f.fileno()).st_size
+            offset = min(max(offset, 0), file_size)
+
+            # Header and file data are queued together so no other frame can get between them. Queued without
+            # waiting (the writer closes the file and logs the outcome), so a receiver that does not read holds
+            # up neither this thread nor, in the async server, an executor worker
+            client_socket.sendfile(f, Protocol.create_file_header(
+                receiver, filename, file_size, sender=sender, codec=self.sessions.get_codec(client_socket), offset=offset
+            ), wait=False, offset=offset)
+
+        except Exception:
+            f.close()
+            raise
+
+        self.logger.info("Queued stored file %s for %s", filename, client_socket.getpeername())
+
+
 if __name__ == "__main__":
     server = Server()
     try:
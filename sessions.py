@@ -0,0 +1,442 @@
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from logs import get_message_logger
+from metrics import REGISTRY
+from protocols import Protocol
+
+
+FRAMES_SENT = REGISTRY.counter("messenger_frames_sent_total", "Frames queued for sending by message type (OTHER when it takes decoding to tell, e.g. compressed frames)", ("type",))
+BYTES_SENT = REGISTRY.counter("messenger_bytes_sent_total", "Bytes queued for sending (frames as they go on the wire and file data)")
+
+
+# Report outcome of a queued file to the waiting caller, or log it and close the file if nobody waits for it
+def finish_file(file, done, result=None, error=None):
+    if result:
+        BYTES_SENT.inc(amount=result)
+
+    if done is None:
+        if error is not None:
+            logging.getLogger(__name__).info("Error sending file %s: %s", getattr(file, "name", file), error)
+        else:
+            get_message_logger(__name__).debug("Sent %s bytes of file %s", result, getattr(file, "name", file))
+
+        file.close()
+    elif error is not None:
+        done.set_exception(error)
+    else:
+        done.set_result(result)
+
+
+class SessionRegistry:
+    # Setup indexes of logged in connections (a user can be logged in from several devices)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_ids = {}  # {client_socket: user_id}
+        self.sockets = {}  # {user_id: {client_socket, ...}}
+        self.codecs = {}  # {client_socket: wire codec negotiated at login}
+
+    # Register socket as a session of the given user
+    def add(self, client_socket, user_id, codec=Protocol.CODEC_JSON):
+        with self.lock:
+            self.codecs[client_socket] = codec
+
+            previous_id = self.user_ids.get(client_socket)
+            if previous_id is not None:
+                self._unlink(client_socket, previous_id)
+
+            self.user_ids[client_socket] = user_id
+            self.sockets.setdefault(user_id, set()).add(client_socket)
+
+    # Remove socket from the registry and return the user id it belonged to
+    def remove(self, client_socket):
+        with self.lock:
+            user_id = self.user_ids.pop(client_socket, None)
+            self.codecs.pop(client_socket, None)
+            if user_id is not None:
+                self._unlink(client_socket, user_id)
+
+            return user_id
+
+    # Drop socket from the user index (caller must hold the lock)
+    def _unlink(self, client_socket, user_id):
+        user_sockets = self.sockets.get(user_id)
+        if user_sockets is None:
+            return
+
+        user_sockets.discard(client_socket)
+        if not user_sockets:
+            del self.sockets[user_id]
+
+    # Get user id of a logged in socket
+    def get_user_id(self, client_socket):
+        with self.lock:
+            return self.user_ids.get(client_socket)
+
+    # Get codec the socket negotiated at login (JSON until then)
+    def get_codec(self, client_socket):
+        with self.lock:
+            return self.codecs.get(client_socket, Protocol.CODEC_JSON)
+
+    # Get snapshot of all sessions of a user (safe to send to without holding the lock)
+    def get_sockets(self, user_id):
+        with self.lock:
+            return list(self.sockets.get(user_id, ()))
+
+    def is_online(self, user_id):
+        with self.lock:
+            return user_id in self.sockets
+
+    # Get snapshot of all logged in sockets
+    def get_online_sockets(self):
+        with self.lock:
+            return list(self.user_ids)
+
+    # Get snapshot of the ids of all logged in users
+    def get_online_users(self):
+        with self.lock:
+            return list(self.sockets)
+
+    # Remove every session and return their sockets
+    def clear(self):
+        with self.lock:
+            client_sockets = list(self.user_ids)
+            self.user_ids.clear()
+            self.sockets.clear()
+            self.codecs.clear()
+
+            return client_sockets
+
+    def __len__(self):
+        with self.lock:
+            return len(self.user_ids)
+
+
+class Session:
+    # Overflow policies applied when a frame does not fit into the outbound queue
+    DROP = "drop" # discard the frame, the receiver misses it
+    DISCONNECT = "disconnect" # close the slow connection
+    SPILL = "spill" # leave the message undelivered so it is flushed from the offline store on next login
+
+    # Outbox marker after which queued frames may be packed into BATCH frames
+    START_BATCHING = object()
+
+    # Seconds a reply waits for room in the queue before the connection is given up as not reading
+    REPLY_TIMEOUT = 10.0
+
+    # Limits of a single flush (IOV_MAX is 1024 on most systems)
+    MAX_FLUSH_FRAMES = 512
+    MAX_FLUSH_BYTES = 256 * 1024
+
+    # Setup bounded outbound queue state (subclasses provide the writer)
+    def __init__(self, peername, max_queue_bytes=4 * 1024 * 1024, overflow_policy=SPILL, flush_window=0.002):
+        self.peername = peername
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow_policy = overflow_policy
+        self.logger = logging.getLogger(__name__)
+        self.message_logger = get_message_logger(__name__)
+
+        self.condition = threading.Condition()
+        self.outbox = deque()
+        self.queued_bytes = 0
+        self.closed = False
+
+        # Coalescing state: how long a lone frame waits for company (Nagle-like), when the last flush
+        # was taken and write counters
+        self.flush_window = flush_window
+        self.last_flush = 0.0
+        self.batching = False
+        self.writes = 0
+        self.frames_written = 0
+
+        # Compression algorithm for large frames (None until the peer asks for it at login)
+        self.compression = None
+
+    # Reserve room for a frame in the outbound queue, returns False if it does not fit
+    # (with block=True waits up to timeout seconds for room instead)
+    def reserve(self, size, block=False, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Connection closed")
+
+                # A single frame larger than the limit is accepted when the queue is empty
+                if self.queued_bytes == 0 or self.queued_bytes + size <= self.max_queue_bytes:
+                    self.queued_bytes += size
+                    return True
+
+                if not block:
+                    return False
+
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                self.condition.wait(remaining)
+
+    # Give back room after frames were written
+    def release(self, size):
+        with self.condition:
+            self.queued_bytes -= size
+            self.condition.notify_all()
+
+    # Queue frame without waiting, returns False if the queue is full
+    def offer(self, data):
+        data = self.compress(data)
+        if not self.reserve(len(data)):
+            return False
+
+        self.count(data)
+
+        self.enqueue(bytes(data))
+        return True
+
+    # Queue frame without waiting, applying the overflow policy when the queue is full.
+    # Returns True if the frame counts as delivered (queued or deliberately dropped)
+    def send(self, data):
+        if self.offer(data):
+            return True
+
+        # Under overload this fires for every frame, so it is sampled
+        self.message_logger.warning("Outbound queue of %s is full (%s bytes), applying %s policy", self.peername, self.queued_bytes, self.overflow_policy)
+
+        if self.overflow_policy == self.DROP:
+            return True
+
+        if self.overflow_policy == self.DISCONNECT:
+            self.close()
+
+        return False
+
+    # Queue frame, waiting for room in the queue (like socket.sendall this blocks the caller). Used for replies
+    # to the connection that made the request, which must never be dropped by the overflow policy. A peer that
+    # does not make room within REPLY_TIMEOUT is disconnected, so no handler thread waits on it for good
+    def sendall(self, data):
+        data = self.compress(data)
+        if not self.reserve(len(data), block=True, timeout=self.REPLY_TIMEOUT):
+            self.logger.warning("Outbound queue of %s stayed full for %s seconds, disconnecting", self.peername, self.REPLY_TIMEOUT)
+            self.close()
+            raise ConnectionError("Connection closed (outbound queue stayed full)")
+
+        self.count(data)
+        self.enqueue(bytes(data))
+
+    # Compress large frames if the peer negotiated compression (small frames are returned as they are)
+    def compress(self, data):
+        if self.compression is None:
+            return data
+
+        return Protocol.compress_frame(data, self.compression)
+
+    # Count queued frame by its message type
+    def count(self, data):
+        FRAMES_SENT.inc(Protocol.frame_type(data) or "OTHER")
+        BYTES_SENT.inc(amount=len(data))
+
+    # Compress frames queued from now on with the given algorithm (the peer can decode it)
+    def enable_compression(self, compression):
+        self.compression = compression
+
+    # Let the writer pack frames queued from now on into BATCH frames (the peer asked for them at login)
+    def enable_batching(self):
+        self.enqueue(self.START_BATCHING)
+
+    def getpeername(self):
+        return self.peername
+
+    # Number of bytes waiting to be written
+    def queue_size(self):
+        with self.condition:
+            return self.queued_bytes
+
+    # Check if a lone frame should wait for the flush window before it is written. Like Nagle's algorithm
+    # it only waits while a burst is going on (last flush within the window), so a lone reply goes out at once
+    def should_linger(self):
+        return (
+            self.flush_window > 0 and len(self.outbox) == 1 and isinstance(self.outbox[0], bytes)
+            and time.monotonic() - self.last_flush < self.flush_window
+        )
+
+    # Take the next unit of work off the outbox: a (header, file, done, offset) tuple, or a list of buffers
+    # gathering consecutive frames (runs of whole frames are packed into BATCH frames if enabled).
+    # Returns (item, queued size)
+    def take_flush(self):
+        while self.outbox and self.outbox[0] is self.START_BATCHING:
+            self.outbox.popleft()
+            self.batching = True
+
+        if not self.outbox:
+            return None, 0
+
+        self.last_flush = time.monotonic()
+
+        if isinstance(self.outbox[0], tuple):
+            return self.outbox.popleft(), 0
+
+        buffers = []
+        size = 0
+        run = []
+
+        while self.outbox and len(run) + len(buffers) < self.MAX_FLUSH_FRAMES and size < self.MAX_FLUSH_BYTES:
+            item = self.outbox[0]
+            if item is self.START_BATCHING:
+                self.outbox.popleft()
+                self.batching = True
+                continue
+
+            if isinstance(item, tuple):
+                break
+
+            self.outbox.popleft()
+            self.frames_written += 1
+            size += len(item)
+
+            if self.batching and Protocol.is_single_frame(item):
+                run.append(item)
+            else:
+                self.pack_run(buffers, run)
+                buffers.append(item)
+
+        self.pack_run(buffers, run)
+
+        return buffers, size
+
+    # Move a run of whole frames into buffers, behind one BATCH header if there is more than one
+    def pack_run(self, buffers, run):
+        if len(run) > 1:
+            buffers.append(Protocol.create_batch_header(sum(len(frame) for frame in run)))
+
+        buffers.extend(run)
+        run.clear()
+
+
+class ThreadedSession(Session):
+    # Setup socket session whose outbound frames are written by its own writer thread
+    def __init__(self, sock, max_queue_bytes=4 * 1024 * 1024, overflow_policy=Session.SPILL, flush_window=0.002):
+        super().__init__(sock.getpeername(), max_queue_bytes, overflow_policy, flush_window)
+        self.sock = sock
+
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def enqueue(self, item):
+        with self.condition:
+            self.outbox.append(item)
+            self.condition.notify_all()
+
+    # Queue file (preceded by its header frame) to be sent from offset on with socket.sendfile and wait until
+    # it is sent. With wait=False the call returns right away and the writer closes the file once it is sent
+    def sendfile(self, file, header=b"", wait=True, offset=0):
+        done = Future() if wait else None
+
+        with self.condition:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+
+            self.outbox.append((header, file, done, offset))
+            self.condition.notify_all()
+
+        return done.result() if wait else None
+
+    # Write queued frames, gathering everything that is pending into one sendmsg call
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.outbox and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    break
+
+                # Short Nagle-like window: give a burst the chance to build up before flushing
+                if self.should_linger():
+                    deadline = time.monotonic() + self.flush_window
+                    while not self.closed and len(self.outbox) < self.MAX_FLUSH_FRAMES:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+
+                        self.condition.wait(remaining)
+
+                    if self.closed:
+                        break
+
+                item, size = self.take_flush()
+
+            if item is None:
+                continue
+
+            try:
+                if isinstance(item, tuple):
+                    header, file, done, offset = item
+                    try:
+                        self.sock.sendall(header)
+                        sent = self.sock.sendfile(file, offset)
+                        finish_file(file, done, result=sent)
+
+                    except Exception as e:
+                        finish_file(file, done, error=e)
+                        raise
+
+                else:
+                    self.send_buffers(item)
+                    self.release(size)
+
+            except Exception as e:
+                self.logger.info("Error writing to %s: %s", self.peername, e)
+                self.close()
+                break
+
+        # Release threads waiting for files that will not be sent
+        with self.condition:
+            pending = [item for item in self.outbox if isinstance(item, tuple)]
+            self.outbox.clear()
+
+        for _, file, done, _ in pending:
+            finish_file(file, done, error=ConnectionError("Connection closed"))
+
+    # Write buffers with scatter/gather sendmsg, continuing after partial writes
+    def send_buffers(self, buffers):
+        if not hasattr(self.sock, "sendmsg"):
+            self.writes += 1
+            self.sock.sendall(b"".join(buffers))
+            return
+
+        index = 0
+        while index < len(buffers):
+            sent = self.sock.sendmsg(buffers[index:])
+            self.writes += 1
+
+            # Skip fully written buffers and cut the partially written one
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+
+            if sent:
+                buffers[index] = memoryview(buffers[index])[sent:]
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.condition.notify_all()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+        except OSError:
+            pass
+
+        self.sock.close()
@@ -0,0 +1,108 @@
+import hashlib
+import lzma
+import os
+import time
+import zlib
+from protocols import Protocol
+
+
+class FileTransfer:
+    # Setup incoming chunked file (chunks go straight to disk, nothing is kept in memory)
+    def __init__(self, transfer_id, sender_id, receiver_id, filename, file_size, receivers, blobs, sha256=None, compression=None):
+        self.transfer_id = transfer_id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.filename = os.path.basename(filename)
+        self.file_size = file_size
+        self.received = 0
+
+        # Sockets the chunks are relayed to while the upload is in flight, and the ones that fell behind
+        # (they are sent the stored file once the upload is complete)
+        self.receivers = receivers
+        self.lagging = []
+
+        # Hash the data as it arrives, the digest names the blob (checked against the announced one)
+        self.blobs = blobs
+        self.expected_digest = sha256
+        self.hash = hashlib.sha256()
+        self.digest = None
+
+        # Data arrives compressed with this algorithm (None for raw data). Chunks of chunked transfers are
+        # flushed one by one, so a fresh decompressor can pick up after a rewind
+        self.compression = compression
+        self.decompressor = Protocol.create_decompressor(compression) if compression else None
+
+        # Write to a temporary file until the last chunk arrives
+        self.temp_path = blobs.temp_path()
+        self.file = open(self.temp_path, 'wb')
+
+        # Time the sender disconnected (None while the upload is active), only transfers
+        # with a sender-chosen id can be resumed
+        self.suspended_at = None
+        self.resumable = True
+
+    # Restore data of a compressed chunk (raw chunks are returned as they are), raises ValueError for corrupted data
+    def decompress(self, chunk):
+        if self.decompressor is None:
+            return chunk
+
+        try:
+            # Data expanding past the announced size is cut off here and rejected by write
+            return self.decompressor.decompress(chunk, self.file_size - self.received + 1)
+
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Corrupted {self.compression} data in transfer {self.transfer_id}: {e}")
+
+    # Start decompressing anew at a chunk boundary (after a rewind or a resume)
+    def reset_decompressor(self):
+        if self.compression:
+            self.decompressor = Protocol.create_decompressor(self.compression)
+
+    # Append chunk to the file
+    def write(self, chunk):
+        if self.received + len(chunk) > self.file_size:
+            raise ValueError(f"Transfer {self.transfer_id} exceeds announced file size")
+
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.received += len(chunk)
+
+    # Close the file while the sender is gone, the data received so far is kept for resuming
+    def suspend(self):
+        self.file.close()
+        self.suspended_at = time.monotonic()
+
+    # Reopen the file to continue after the received data
+    def resume(self):
+        self.file = open(self.temp_path, 'ab')
+        self.suspended_at = None
+        self.reset_decompressor()
+
+    # Check if the transfer has been suspended for longer than the timeout
+    def is_expired(self, timeout):
+        return self.suspended_at is not None and time.monotonic() - self.suspended_at > timeout
+
+    def is_complete(self):
+        return self.received >= self.file_size
+
+    # Close the file and move it into the blob store, returns the blob digest
+    def finish(self):
+        self.file.close()
+        self.digest = self.hash.hexdigest()
+
+        if self.expected_digest and self.expected_digest != self.digest:
+            self.abort()
+            raise ValueError(f"Transfer {self.transfer_id} does not match its announced SHA-256")
+
+        self.blobs.add(self.temp_path, self.digest)
+
+        return self.digest
+
+    # Close the file and remove partial data
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+
+        except OSError:
+            pass